@@ -137,7 +137,8 @@ class Status(object):
 
 class ForEach(object):
     '''
-    sequence: thing to loop over (list, tuple, model, manager, queryset... not generators yet).
+    sequence: thing to loop over (list, tuple, model, manager, queryset,
+      chunked PickleDict value... not generators yet).
     func: function to call for each element
     batch_size: size of each batch
     limit: maximum number to process
@@ -147,6 +148,18 @@ class ForEach(object):
     stable_ids: for querysets, whether to get a stable list of ids first
 
     Call ``.run`` to run the batch.
+
+    A value stored in chunks by a PickleDict is processed a chunk at a
+    time, each chunk a batch:
+
+    >>> import tempfile
+    >>> from csc_utils.persist import PickleDict
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+    >>> pd.store_chunks('numbers', [range(20), range(20, 40)])
+    >>> seen = []
+    >>> status = ForEach(pd['numbers'], seen.append, limit=30, transaction=False).run()
+    >>> status.num_successful, seen == range(30)
+    (30, True)
     '''
     def __init__(self, sequence, func, batch_size=1000, limit=None, stop_on_errors=True,
                  transaction=True, status_class=Status, stable_ids=True):
@@ -167,6 +180,8 @@ class ForEach(object):
     def setup_batches(self):
         if isinstance(self.sequence, (list, tuple)):
             self.setup_list_batches()
+        elif hasattr(self.sequence, 'iter_chunks'):
+            self.setup_chunk_batches()
         else:
             self.setup_queryset_batches()
             
@@ -181,6 +196,24 @@ class ForEach(object):
     def list_batches(self):
         return chunk(enumerate(self.sequence), self.batch_size)
 
+    def setup_chunk_batches(self):
+        # A chunked value (see csc_utils.chunked) is read a chunk at a
+        # time, and each chunk is a batch, whatever the batch_size.
+        total = self.sequence.count()
+        if self.limit is not None: total = min(total, self.limit)
+        self.status.total = total
+        self.batches = self.chunk_batches
+        self.has_ids = True
+
+    def chunk_batches(self):
+        index, remaining = 0, self.status.total
+        for items in self.sequence.iter_chunks():
+            if remaining <= 0: break
+            items = items[:remaining]
+            remaining -= len(items)
+            yield itertools.izip(itertools.count(index), items)
+            index += len(items)
+
     def setup_queryset_batches(self):
         self.batches = self.queryset_batches
 
@@ -0,0 +1,183 @@
+'''
+Values stored as a sequence of separately pickled chunks.
+
+A 20-million-element list pickled as one blob has to be unpickled whole
+to read any of it, and pickled whole again to add to it. A ChunkedFile
+holds it as chunks (lists, say) instead, which can be read one at a
+time, in order or by index, and appended to without touching the chunks
+that are already there. PickleDict stores these with `store_chunks`.
+'''
+from __future__ import with_statement
+import os
+import struct
+import zlib
+import cPickle as pickle
+from csc_utils.io import open_for_atomic_overwrite, make_durable, compressor, decompressor, \
+     sniff_compression_of
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No locking between processes, then.
+
+CHUNKED_MAGIC = 'PDCHUNK1'
+
+class ChunkedFile(object):
+    '''
+    A file of chunks: a magic string, then for each chunk a header and
+    the chunk's pickle (compressed, if a compression was given when it
+    was written). The headers say how long each chunk is and how many
+    items it holds, so the index of chunks is built by reading just the
+    headers, and a chunk that was cut short by a crash is ignored.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> chunks = ChunkedFile.create(path, ([i, i + 1] for i in range(0, 6, 2)))
+    >>> len(chunks), chunks.count()
+    (3, 6)
+    >>> chunks.chunk(1)
+    [2, 3]
+    >>> chunks.append([6])
+    >>> list(ChunkedFile(path))
+    [0, 1, 2, 3, 4, 5, 6]
+    '''
+    # length of the data, number of items, CRC of the data
+    header = struct.Struct('<QII')
+
+    def __init__(self, path):
+        self.path = path
+        self.index = [] # (offset of the data, length, items, crc) for each chunk
+        self.scanned = 0
+        self.inode = None
+
+    def __repr__(self):
+        return 'ChunkedFile(%r)' % self.path
+
+    @classmethod
+    def create(cls, path, chunks, compression=None, durability=None):
+        '''
+        Atomically writes the chunks from the iterable `chunks` to `path`,
+        a chunk at a time, and returns the ChunkedFile. See
+        open_for_atomic_overwrite for `durability`.
+        '''
+        with open_for_atomic_overwrite(path, durability=durability) as f:
+            f.write(CHUNKED_MAGIC)
+            for chunk in chunks:
+                f.write(cls._encode(chunk, compression))
+        return cls(path)
+
+    @classmethod
+    def _encode(cls, chunk, compression=None):
+        data = pickle.dumps(chunk, -1)
+        if compression and compression != 'none':
+            c = compressor(compression)
+            data = c.compress(data) + c.flush()
+        return cls.header.pack(len(data), len(chunk), zlib.crc32(data) & 0xffffffff) + data
+
+    def refresh(self):
+        '''
+        Read the headers of any chunks that have been added since we
+        last looked.
+        '''
+        header = self.header
+        f = open(self.path, 'rb')
+        try:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            if st.st_ino != self.inode or size < self.scanned:
+                # Rewritten since; start again.
+                self.index, self.scanned, self.inode = [], 0, st.st_ino
+            offset = self.scanned
+            if offset == 0:
+                if f.read(len(CHUNKED_MAGIC)) != CHUNKED_MAGIC:
+                    raise ValueError("%s is not a chunked file" % self.path)
+                offset = len(CHUNKED_MAGIC)
+            f.seek(offset)
+            while offset + header.size <= size:
+                length, items, crc = header.unpack(f.read(header.size))
+                if offset + header.size + length > size:
+                    break # A chunk that's still being written.
+                self.index.append((offset + header.size, length, items, crc))
+                offset += header.size + length
+                f.seek(offset)
+            self.scanned = offset
+        finally:
+            f.close()
+
+    def __len__(self):
+        '''
+        The number of chunks.
+        '''
+        self.refresh()
+        return len(self.index)
+
+    def count(self):
+        '''
+        The number of items in all the chunks.
+        '''
+        self.refresh()
+        return sum(entry[2] for entry in self.index)
+
+    def chunk(self, i):
+        '''
+        Reads the chunk at index `i`.
+        '''
+        if i >= len(self.index) or i < 0:
+            self.refresh()
+        f = open(self.path, 'rb')
+        try:
+            return self._read(f, self.index[i])
+        finally:
+            f.close()
+
+    def _read(self, f, entry):
+        offset, length, items, crc = entry
+        f.seek(offset)
+        data = f.read(length)
+        if len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+            raise ValueError("Damaged chunk at offset %d of %s" % (offset, self.path))
+        compression = sniff_compression_of(data)
+        if compression:
+            data = decompressor(compression).decompress(data)
+        return pickle.loads(data)
+
+    def iter_chunks(self, start=0):
+        '''
+        Yields the chunks in order, from the `start`th, reading one at a
+        time.
+        '''
+        self.refresh()
+        f = open(self.path, 'rb')
+        try:
+            for entry in self.index[start:]:
+                yield self._read(f, entry)
+        finally:
+            f.close()
+
+    def __iter__(self):
+        for chunk in self.iter_chunks():
+            for item in chunk:
+                yield item
+
+    def append(self, chunk, compression=None, durability=None):
+        self.extend([chunk], compression, durability)
+
+    def extend(self, chunks, compression=None, durability=None):
+        '''
+        Appends chunks to the end of the file, leaving the ones already
+        there alone. Appends from several processes are serialized by a
+        lock on the file. See make_durable for `durability`.
+        '''
+        data = ''.join(self._encode(chunk, compression) for chunk in chunks)
+        f = open(self.path, 'r+b')
+        try:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            self.refresh()
+            # Nobody else can be writing now, so anything past the last
+            # whole chunk was left by an append that crashed.
+            f.truncate(self.scanned)
+            f.seek(self.scanned)
+            f.write(data)
+        finally:
+            f.close()
+        make_durable(self.path, durability)
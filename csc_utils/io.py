@@ -1,23 +1,374 @@
 from __future__ import with_statement
 import random
 import os
+import errno
+import zlib
+import socket
+import threading
+import time
+import logging
 from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No locking between processes, then.
+LOG = logging.getLogger(__name__)
+
+# How much uncompressed data to handle at once when compressing or
+# decompressing a stream.
+BLOCK_SIZE = 1 << 20
+
+COMPRESSIONS = ('zlib', 'gzip', 'bz2', 'lzma')
+
+# How hard atomic writes try to make sure that what they wrote survives a
+# crash of the machine: 'none' leaves it to the operating system, 'file'
+# syncs each file and its directory as it's written. (Passing a SyncGroup
+# instead syncs a batch of files at once.) DURABILITY is the default.
+DURABILITY_MODES = ('none', 'file')
+DURABILITY = 'none'
+
+# Atomic writes that are expected to be at least LARGE_WRITE bytes long
+# have their space allocated up front, so that the file isn't built out
+# of fragments, and go through a buffer of LARGE_BUFFER bytes, so that
+# the filesystem (a network filesystem, especially) sees a few big writes
+# instead of many small ones.
+LARGE_WRITE = 16 << 20
+LARGE_BUFFER = 8 << 20
+COMPRESSION_EXTENSIONS = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'lzma'}
+
+def _lzma():
+    try:
+        import lzma
+    except ImportError:
+        try:
+            from backports import lzma
+        except ImportError:
+            raise ValueError("lzma compression needs Python 3.3 or the backports.lzma package")
+    return lzma
+
+def compression_for_filename(filename):
+    '''
+    Guesses the compression of a file from its extension.
+
+    >>> compression_for_filename('tensor.pickle.gz')
+    'gzip'
+    >>> compression_for_filename('tensor.pickle') is None
+    True
+    '''
+    return COMPRESSION_EXTENSIONS.get(os.path.splitext(filename)[1])
+
+# How each kind of compressed stream starts.
+COMPRESSION_MAGIC = [('\x1f\x8b', 'gzip'), ('BZh', 'bz2'), ('\xfd7zXZ\x00', 'lzma'),
+                     ('\x78\x01', 'zlib'), ('\x78\x5e', 'zlib'), ('\x78\x9c', 'zlib'), ('\x78\xda', 'zlib')]
+
+def sniff_compression(filename):
+    '''
+    Guesses the compression of a file from its first few bytes. Returns
+    None if it doesn't look compressed.
+    '''
+    f = open(filename, 'rb')
+    try:
+        head = f.read(6)
+    finally:
+        f.close()
+    return sniff_compression_of(head)
+
+def sniff_compression_of(data):
+    '''
+    Guesses the compression of a string from how it starts.
+    '''
+    for magic, compression in COMPRESSION_MAGIC:
+        if data.startswith(magic):
+            return compression
+    return None
+
+def compressor(compression, level=None):
+    '''
+    Returns an incremental compressor (with `compress` and `flush`
+    methods) for one of the COMPRESSIONS.
+    '''
+    if compression == 'zlib':
+        return zlib.compressobj(level or 6)
+    elif compression == 'gzip':
+        return zlib.compressobj(level or 6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2Compressor(level or 9)
+    elif compression == 'lzma':
+        lzma = _lzma()
+        if level is None: return lzma.LZMACompressor()
+        return lzma.LZMACompressor(preset=level)
+    raise ValueError("Unknown compression: %r" % (compression,))
+
+def decompressor(compression):
+    '''
+    Returns an incremental decompressor (with a `decompress` method)
+    for one of the COMPRESSIONS.
+    '''
+    if compression == 'zlib':
+        return zlib.decompressobj()
+    elif compression == 'gzip':
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif compression == 'bz2':
+        import bz2
+        return bz2.BZ2Decompressor()
+    elif compression == 'lzma':
+        return _lzma().LZMADecompressor()
+    raise ValueError("Unknown compression: %r" % (compression,))
+
+class CompressedWriter(object):
+    '''
+    A write-only file object that compresses everything written to it
+    into the file `f`, a block at a time, so that neither the whole
+    uncompressed nor the whole compressed data is ever held in memory.
+    Closing it finishes the compressed stream, but doesn't close `f`.
+
+    >>> from cStringIO import StringIO
+    >>> out = StringIO()
+    >>> writer = CompressedWriter(out, 'gzip')
+    >>> for i in range(1000): writer.write('spam ')
+    >>> writer.close()
+    >>> len(out.getvalue()) < 5000
+    True
+    >>> reader = DecompressedReader(StringIO(out.getvalue()), 'gzip')
+    >>> reader.read(10)
+    'spam spam '
+    >>> len(reader.read())
+    4990
+    '''
+    def __init__(self, f, compression, level=None, block_size=BLOCK_SIZE):
+        self.f = f
+        self.compressor = compressor(compression, level)
+        self.block_size = block_size
+        self.buffer = []
+        self.buffered = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._write_block()
+
+    def _write_block(self):
+        data = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        out = self.compressor.compress(data)
+        if out: self.f.write(out)
+
+    def flush(self):
+        pass # Flushing the compressor would end the stream.
+
+    def close(self):
+        if self.closed: return
+        self._write_block()
+        self.f.write(self.compressor.flush())
+        self.closed = True
+
+class DecompressedReader(object):
+    '''
+    A read-only file object that decompresses the file `f` a block at
+    a time as it is read (or just reads it a block at a time, if
+    `compression` is None). It supports what unpickling needs: `read`
+    and `readline`.
+    '''
+    def __init__(self, f, compression, block_size=BLOCK_SIZE):
+        self.f = f
+        self.decompressor = decompressor(compression) if compression else None
+        self.block_size = block_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self, size=None, until=None):
+        '''
+        Decompress more data until there are at least `size` bytes
+        buffered, or the buffered data contains `until`, or the input
+        runs out.
+        '''
+        available = len(self.buffer) - self.pos
+        if until is not None and self.buffer.find(until, self.pos) >= 0: return
+        # The new blocks are joined onto the buffer once, at the end, so
+        # that reading a whole file doesn't copy it over and over.
+        blocks = []
+        while not self.eof:
+            if size is not None and available >= size: break
+            data = self.f.read(self.block_size)
+            if not data:
+                self.eof = True
+                break
+            out = data if self.decompressor is None else self.decompressor.decompress(data)
+            blocks.append(out)
+            available += len(out)
+            if until is not None and until in out: break
+        if blocks:
+            blocks.insert(0, self.buffer[self.pos:])
+            self.buffer = ''.join(blocks)
+            self.pos = 0
+
+    def read(self, size=-1):
+        # Unpickling reads a few bytes at a time, so the common case,
+        # where they're already buffered, comes first.
+        if size is not None and 0 <= size < len(self.buffer) - self.pos:
+            end = self.pos + size
+            data = self.buffer[self.pos:end]
+            self.pos = end
+            return data
+        if size is None or size < 0:
+            self._fill()
+        else:
+            self._fill(size=size)
+            if size < len(self.buffer) - self.pos:
+                data = self.buffer[self.pos:self.pos+size]
+                self.pos += size
+                return data
+        data = self.buffer[self.pos:]
+        self.buffer, self.pos = '', 0
+        return data
+
+    def readline(self, size=-1):
+        self._fill(until='\n')
+        end = self.buffer.find('\n', self.pos)
+        if end < 0: end = len(self.buffer)
+        else: end += 1
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        data = self.buffer[self.pos:end]
+        self.pos = end
+        return data
+
+    def close(self):
+        self.f.close()
+
+def open_compressed(filename, compression=None):
+    '''
+    Opens a file for reading, decompressing it as it is read if
+    `compression` is given or can be inferred from its extension.
+    '''
+    if compression is None:
+        compression = compression_for_filename(filename)
+    f = open(filename, 'rb')
+    if compression is None or compression == 'none':
+        return f
+    return DecompressedReader(f, compression)
+
+def _create_temporary(filename, binary=True, buffering=-1):
+    '''
+    Creates and opens a temporary file next to `filename`, with a name
+    that nobody else (in this process or another) is using. Returns its
+    name and the file object.
+    '''
+    while True:
+        tmp = '%s_tmp_%d_%08x' % (filename, os.getpid(), random.getrandbits(32))
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0666)
+        except OSError, e:
+            if e.errno == errno.EEXIST: continue
+            raise
+        return tmp, os.fdopen(fd, 'wb' if binary else 'w', buffering)
+
+def _find_fallocate():
+    # Linux's fallocate fails on filesystems that can't allocate space
+    # up front, where posix_fallocate would write zeros to the whole file
+    # instead, which is exactly what we're trying to avoid.
+    try:
+        import ctypes, ctypes.util
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        fallocate = libc.fallocate64
+    except (ImportError, OSError, AttributeError):
+        return getattr(os, 'posix_fallocate', None)
+    fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+    def allocate(fd, offset, length):
+        if fallocate(fd, 0, offset, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    return allocate
+_fallocate = _find_fallocate()
+
+def preallocate(f, size):
+    '''
+    Asks the filesystem to allocate `size` bytes for the open file `f`
+    in one go. Returns whether it could.
+    '''
+    if _fallocate is None or size <= 0: return False
+    try:
+        _fallocate(f.fileno(), 0, size)
+    except (OSError, IOError):
+        return False
+    return True
+
+def _check_durability(durability):
+    if durability is None: durability = DURABILITY
+    if not isinstance(durability, SyncGroup) and durability not in DURABILITY_MODES:
+        raise ValueError("Unknown durability: %r" % (durability,))
+    return durability
 
 @contextmanager
-def open_for_atomic_overwrite(filename, binary=True):
-    # Choose a random tempfile name because another process may be trying to do the same thing.
-    tmp = '%s_tmp_%d' % (filename, random.randrange(1000))
-    f = open(tmp, 'wb' if binary else 'w')
+def open_for_atomic_overwrite(filename, binary=True, compression=None, durability=None,
+                              size_hint=None, report=None):
+    '''
+    Yields a file object that writes to a temporary file, which is
+    renamed to `filename` if the block finishes without an error. If
+    `compression` is given, what's written is compressed on the way.
+
+    `durability` is one of DURABILITY_MODES (the default is DURABILITY),
+    or a SyncGroup, in which case the file isn't renamed into place
+    until the group is committed.
+
+    `size_hint` is how many bytes are expected to be written; a big
+    enough one gets the file preallocated and a large buffer (see
+    LARGE_WRITE). When the file is done, `report`, if given, is called
+    with its name, its size and the seconds it took, and the same goes
+    to the debug log.
+
+    >>> import tempfile
+    >>> path = tempfile.mktemp()
+    >>> def report(filename, size, seconds): print size
+    >>> with open_for_atomic_overwrite(path, size_hint=LARGE_WRITE, report=report) as f:
+    ...     f.write('spam' * 250)
+    1000
+    >>> os.path.getsize(path)
+    1000
+    '''
+    durability = _check_durability(durability)
+    start = time.time()
+    large = size_hint is not None and size_hint >= LARGE_WRITE
+    tmp, f = _create_temporary(filename, binary, LARGE_BUFFER if large else -1)
     try:
-        yield f
+        # The hint is of the uncompressed size, which is no use here.
+        preallocated = large and compression in (None, 'none') and preallocate(f, size_hint)
+        if compression is None or compression == 'none':
+            yield f
+        else:
+            writer = CompressedWriter(f, compression)
+            yield writer
+            writer.close()
+        size = f.tell()
+        if preallocated:
+            f.flush()
+            f.truncate(size) # in case less was written than was allocated
+        if durability == 'file':
+            f.flush()
+            os.fsync(f.fileno())
     except:
         f.close()
         os.unlink(tmp)
         raise
     f.close()
-    os.rename(tmp, filename)
+    if isinstance(durability, SyncGroup):
+        durability.stage(tmp, filename)
+    else:
+        os.rename(tmp, filename)
+        if durability == 'file':
+            fsync_dir(os.path.dirname(os.path.abspath(filename)))
+    seconds = time.time() - start
+    LOG.debug('Wrote %d bytes to %s in %.3fs (%.1f MB/s)', size, filename, seconds,
+              size / max(seconds, 1e-6) / 1e6)
+    if report is not None:
+        report(filename, size, seconds)
 
-def write_to_file_atomically(filename, data):
+def write_to_file_atomically(filename, data, durability=None):
     '''
     Atomically overwrite the file `filename` with the data `data`.
 
@@ -25,5 +376,236 @@ def write_to_file_atomically(filename, data):
     details are subtle. I do not guarantee that even this does it
     correctly.
     '''
-    with open_for_atomic_overwrite(filename) as f:
+    with open_for_atomic_overwrite(filename, durability=durability, size_hint=len(data)) as f:
         f.write(data)
+
+def make_durable(filename, durability=None):
+    '''
+    Does for a file that has already been written in place what
+    `durability` would have done if it had been written by
+    open_for_atomic_overwrite.
+    '''
+    durability = _check_durability(durability)
+    if isinstance(durability, SyncGroup):
+        durability.add(filename)
+    elif durability == 'file':
+        fsync_file(filename)
+        fsync_dir(os.path.dirname(os.path.abspath(filename)))
+
+class SyncGroup(object):
+    '''
+    A batch of atomic writes that are made durable together. A file
+    written with a SyncGroup as its `durability` stays under its
+    temporary name until the group is committed, which syncs all the
+    files, renames them into place, and then syncs each of their
+    directories once: one sync point for the lot, rather than two syncs
+    for every file. Leaving a `with` block commits the group, or aborts
+    it if there was an exception.
+
+    >>> import tempfile
+    >>> dir = tempfile.mkdtemp()
+    >>> with SyncGroup() as group:
+    ...     for name in 'abc':
+    ...         write_to_file_atomically(os.path.join(dir, name), name * 3, durability=group)
+    ...     len(os.listdir(dir)), len(group)
+    (3, 3)
+    >>> sorted(os.listdir(dir))
+    ['a', 'b', 'c']
+    >>> open(os.path.join(dir, 'b')).read()
+    'bbb'
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (temporary name, final name) of the files waiting to be renamed
+        self.staged = []
+        # Files that are in place already, but still need syncing.
+        self.written = []
+
+    def __len__(self):
+        return len(self.staged) + len(self.written)
+
+    def stage(self, tmp, filename):
+        with self.lock:
+            self.staged.append((tmp, filename))
+
+    def add(self, filename):
+        with self.lock:
+            self.written.append(filename)
+
+    def getsize(self, filename):
+        '''
+        The size of `filename` as it will be when the group is committed.
+        '''
+        with self.lock:
+            for tmp, name in reversed(self.staged):
+                if name == filename:
+                    return os.path.getsize(tmp)
+        return os.path.getsize(filename)
+
+    def discard(self, filename):
+        '''
+        Drop the staged writes of `filename`.
+        '''
+        with self.lock:
+            for tmp, name in self.staged:
+                if name == filename: os.unlink(tmp)
+            self.staged = [(tmp, name) for tmp, name in self.staged if name != filename]
+
+    def sync(self):
+        '''
+        Sync the contents of all the files.
+        '''
+        with self.lock:
+            for tmp, filename in self.staged:
+                fsync_file(tmp)
+            for filename in self.written:
+                fsync_file(filename)
+
+    def publish(self):
+        '''
+        Rename the staged files into place, and sync the directories of
+        all the files. Call `sync` first.
+        '''
+        with self.lock:
+            dirs = set()
+            for tmp, filename in self.staged:
+                os.rename(tmp, filename)
+            for tmp, filename in self.staged:
+                dirs.add(os.path.dirname(os.path.abspath(filename)))
+            for filename in self.written:
+                dirs.add(os.path.dirname(os.path.abspath(filename)))
+            for dir in dirs:
+                fsync_dir(dir)
+            self.staged, self.written = [], []
+
+    def commit(self):
+        self.sync()
+        self.publish()
+
+    def abort(self):
+        '''
+        Throw away the staged files.
+        '''
+        with self.lock:
+            for tmp, filename in self.staged:
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+            self.staged, self.written = [], []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.commit()
+        else:
+            self.abort()
+
+def iter_dir(path):
+    '''
+    Yields the names of the entries in the directory `path` as they are
+    read, rather than reading the whole listing first, if os.scandir
+    (or the scandir package) is available.
+    '''
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:
+        try:
+            from scandir import scandir
+        except ImportError:
+            for name in os.listdir(path):
+                yield name
+            return
+    for entry in scandir(path):
+        yield entry.name
+
+@contextmanager
+def exclusive_lock(path, on_wait=None, blocking=True):
+    '''
+    Holds an advisory lock on the file `path` (which is created, and
+    removed again afterwards) for the duration of the block, excluding
+    other processes and threads that lock the same file.
+
+    The lock belongs to an open file, so the operating system releases
+    it if its holder dies: a lock file left behind by a crashed process
+    is simply taken over. If the lock has to be waited for, `on_wait` is
+    called first with a description of the holder ("pid@host").
+
+    The block is given True; or, if `blocking` is False and someone else
+    has the lock, it is given False straight away, without the lock.
+    '''
+    while True:
+        f = open(path, 'a+')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                if not blocking:
+                    f.close()
+                    yield False
+                    return
+                if on_wait is not None:
+                    f.seek(0)
+                    on_wait(f.read().strip() or 'unknown')
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        # The holder removes the file when it's done with it, so what we
+        # locked may no longer be the lock file; if so, start again.
+        try:
+            locked = os.fstat(f.fileno()).st_ino == os.stat(path).st_ino
+        except OSError:
+            locked = False
+        if locked: break
+        f.close()
+    try:
+        f.truncate(0)
+        f.write('%d@%s' % (os.getpid(), socket.gethostname()))
+        f.flush()
+        yield True
+    finally:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        f.close()
+
+@contextmanager
+def file_lock(path, shared=False):
+    '''
+    Holds an advisory lock on the file `path` (which is created if need
+    be, and left in place) for the duration of the block: a shared lock,
+    which any number of holders can have at once, or an exclusive one.
+    '''
+    f = open(path, 'a')
+    try:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        yield
+    finally:
+        f.close()
+
+def fsync_file(filename):
+    '''
+    Waits until the contents of the file `filename` are on disk.
+    '''
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def fsync_dir(path):
+    '''
+    Waits until the entries of the directory `path` (the names of files
+    just renamed into it, say) are on disk, where the platform can.
+    '''
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass # Some filesystems can't sync a directory.
+    finally:
+        os.close(fd)
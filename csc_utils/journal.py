@@ -0,0 +1,230 @@
+'''
+Journals of changes to a stored value.
+
+Adding a few entries to a dict of millions means pickling and writing
+all of it again. A Journal instead records the changes as small delta
+records, appended to a file next to the value; reading the value means
+loading it and replaying its journal onto it, and once the journal has
+grown too big it is folded back in by rewriting the value (see
+PickleDict's `update_dict` and `extend_list`).
+
+A journal begins with the stamp of the file it applies to (its inode,
+size and mtime), so that one left over from before the value was
+rewritten is recognized and ignored.
+'''
+from __future__ import with_statement
+import os
+import errno
+import struct
+import zlib
+import cPickle as pickle
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No locking between processes, then.
+
+def file_stamp(path):
+    '''
+    The stamp of the file `path`, as a journal records it, or None if
+    there's no such file.
+    '''
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_ino, st.st_size, st.st_mtime
+
+def apply_delta(value, record):
+    '''
+    Applies a delta record to `value` in place: ('update', items,
+    removed) for a dict, or ('extend', items) for a list.
+
+    >>> d = {'a': 1, 'b': 2}
+    >>> apply_delta(d, ('update', {'c': 3}, ['a']))
+    >>> sorted(d.items())
+    [('b', 2), ('c', 3)]
+    '''
+    op = record[0]
+    if op == 'update':
+        value.update(record[1])
+        for k in record[2]:
+            value.pop(k, None)
+    elif op == 'extend':
+        value.extend(record[1])
+    else:
+        raise ValueError('Unknown delta record: %r' % (op,))
+
+class Journal(object):
+    '''
+    A file of delta records, each a header and a pickle. The headers say
+    how long each record is and hold its CRC, so that a record cut short
+    by a crash is ignored (and written over by the next append).
+
+    >>> import tempfile
+    >>> base = tempfile.mktemp()
+    >>> open(base, 'w').close()
+    >>> journal = Journal(base + '.journal')
+    >>> journal.read(file_stamp(base)) is None
+    True
+    >>> journal.append(base, [('extend', [1, 2])]) > 0
+    True
+    >>> journal.append(base, [('extend', [3])]) > 0
+    True
+    >>> journal.read(file_stamp(base))
+    [('extend', [1, 2]), ('extend', [3])]
+
+    A journal for a file that has since been rewritten is ignored:
+
+    >>> os.remove(base); open(base, 'w').write('new')
+    >>> journal.read(file_stamp(base)) is None
+    True
+    '''
+    # length of the data, CRC of the data
+    header = struct.Struct('<II')
+
+    def __init__(self, path):
+        self.path = path
+
+    def __repr__(self):
+        return 'Journal(%r)' % self.path
+
+    @classmethod
+    def _encode(cls, record):
+        data = pickle.dumps(record, -1)
+        return cls.header.pack(len(data), zlib.crc32(data) & 0xffffffff) + data
+
+    def _scan(self, f):
+        '''
+        Reads the records from the start of the open journal `f`. Returns
+        them and the offset just past the last whole one.
+        '''
+        header = self.header
+        f.seek(0)
+        records, offset = [], 0
+        while True:
+            head = f.read(header.size)
+            if len(head) < header.size: break
+            length, crc = header.unpack(head)
+            data = f.read(length)
+            if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                break # Cut short by a crash.
+            records.append(pickle.loads(data))
+            offset += header.size + length
+        return records, offset
+
+    def _base_and_end(self, f):
+        '''
+        Reads the first record of the open journal `f` (the stamp of the
+        file it's for), and just the headers of the rest. Returns that
+        record (None if there isn't a whole one) and the offset just
+        past the last whole record.
+        '''
+        header = self.header
+        size = os.fstat(f.fileno()).st_size
+        base, offset = None, 0
+        while offset + header.size <= size:
+            f.seek(offset)
+            length, crc = header.unpack(f.read(header.size))
+            end = offset + header.size + length
+            if end > size:
+                break # Cut short by a crash.
+            if offset == 0:
+                data = f.read(length)
+                if zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                base = pickle.loads(data)
+            offset = end
+        return base, offset
+
+    def read(self, base):
+        '''
+        The delta records to replay onto the file whose stamp is `base`;
+        None if there's no journal for it.
+        '''
+        try:
+            f = open(self.path, 'rb')
+        except IOError, e:
+            if e.errno == errno.ENOENT: return None
+            raise
+        try:
+            records = self._scan(f)[0]
+        finally:
+            f.close()
+        if not records or records[0] != ('base', base):
+            return None
+        return records[1:]
+
+    def size(self):
+        try:
+            return os.path.getsize(self.path)
+        except OSError:
+            return 0
+
+    @contextmanager
+    def locked(self):
+        '''
+        Holds a lock on the journal (creating it if need be) for the
+        duration of the block, which is given the open file. Appends,
+        compactions and rewrites of the value all take it, so none of
+        them lose another's records.
+        '''
+        while True:
+            f = open(self.path, 'a+b')
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            # It may have been removed (by a compaction) while we waited;
+            # if so, start again.
+            try:
+                if os.stat(self.path).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except OSError:
+                pass
+            f.close()
+        try:
+            yield f
+        finally:
+            f.close()
+
+    def append(self, base_path, records):
+        '''
+        Appends delta records for the file `base_path`, as it is once
+        the journal is locked. A journal for some other version of the
+        file is started again. Returns the new size of the journal.
+        '''
+        with self.locked() as f:
+            return self.append_locked(f, base_path, records)
+
+    def append_locked(self, f, base_path, records):
+        '''
+        Like `append`, for a caller that holds the lock already and has
+        the journal open as `f`.
+        '''
+        base = file_stamp(base_path)
+        existing, end = self._base_and_end(f)
+        if existing != ('base', base):
+            end = 0
+            records = [('base', base)] + list(records)
+        # Nobody else can be writing now, so anything past the last
+        # whole record was left by an append that crashed.
+        f.truncate(end)
+        f.seek(end)
+        f.write(''.join(self._encode(record) for record in records))
+        f.flush()
+        return os.fstat(f.fileno()).st_size
+
+    def prune(self, base):
+        '''
+        Removes the journal unless it's for the file whose stamp is
+        `base` (the current one).
+        '''
+        if not os.path.exists(self.path): return
+        with self.locked() as f:
+            if self._base_and_end(f)[0] != ('base', base):
+                self.remove()
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except OSError, e:
+            if e.errno != errno.ENOENT: raise
@@ -0,0 +1,530 @@
+'''
+A log-structured store for PickleDicts that hold many small values.
+
+A plain PickleDict uses a file (and an inode, and an atomic rename) for
+every key, which is a poor fit for millions of small cached results. A
+PackedPickleDict appends its values as records to a few large segment
+files instead, and finds them again through an index kept in memory.
+'''
+from __future__ import with_statement
+import os
+import struct
+import threading
+import time
+import zlib
+import logging
+import cPickle as pickle
+from csc_utils.io import open_for_atomic_overwrite, compressor, decompressor, sniff_compression_of
+from csc_utils.persist import PickleDict
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No locking between processes, then.
+LOG = logging.getLogger(__name__)
+
+class SegmentStore(object):
+    '''
+    A dict from keys to strings, stored as records appended to segment
+    files in a directory.
+
+    Each record is a header, the pickled key, and the data. Overwriting
+    or deleting a key appends a new record (a tombstone, for deletion);
+    the index in memory says where the live record for each key is. It
+    is rebuilt by scanning the segments, which reads only the headers
+    and keys.
+
+    When a segment reaches `segment_size` bytes, a new one is started.
+    When more than `compact_ratio` of the bytes in the full segments are
+    dead, they're compacted in a background thread: the live records
+    are copied into a single new segment, and the old ones are removed.
+
+    >>> import tempfile
+    >>> store = SegmentStore(tempfile.mkdtemp(), segment_size=100)
+    >>> for i in range(20): store.put(('key', i % 5), 'value %d' % i)
+    >>> store.get(('key', 3))
+    'value 18'
+    >>> store.delete(('key', 4))
+    >>> sorted(store.keys())
+    [('key', 0), ('key', 1), ('key', 2), ('key', 3)]
+    >>> store.compact()
+    >>> SegmentStore(store.dir).get(('key', 0))
+    'value 15'
+    '''
+    # flags, length of the key, length of the data, CRC of the data
+    header = struct.Struct('<BIQI')
+    VALUE, TOMBSTONE = 0, 1
+
+    def __init__(self, dir, segment_size=64 << 20, compact_ratio=0.5, compact_min=1 << 20, durable=False):
+        self.dir = dir # created when something is first written
+        self.segment_size = segment_size
+        self.durable = durable # sync each append to disk?
+        self.compact_ratio = compact_ratio
+        self.compact_min = compact_min
+        self.lock = threading.RLock()
+        self.index = None # key -> (segment, offset of the data, length, crc); loaded lazily
+        self.scanned = {} # segment -> how far we've read it
+        self.live_bytes = self.dead_bytes = 0
+        self.files = {} # segment -> file open for reading
+        self.compactor = None
+
+    def __repr__(self):
+        return 'SegmentStore(%r)' % self.dir
+
+    def segment_path(self, segment):
+        return os.path.join(self.dir, '%08d.seg' % segment)
+
+    def segments(self):
+        if not os.path.isdir(self.dir): return []
+        return sorted(int(name[:-4]) for name in os.listdir(self.dir)
+                      if name.endswith('.seg') and name[:-4].isdigit())
+
+    # Reading the index
+    def load(self):
+        with self.lock:
+            self._close_files()
+            self.index = {}
+            self.scanned = {}
+            self.live_bytes = self.dead_bytes = 0
+            for segment in self.segments():
+                self._scan(segment)
+
+    def _ensure_loaded(self):
+        if self.index is None:
+            self.load()
+
+    def refresh(self):
+        '''
+        Pick up records that other processes have appended. If a segment
+        we knew about has gone, it was compacted away, so start over.
+        '''
+        with self.lock:
+            if self.index is None:
+                return self.load()
+            segments = self.segments()
+            if set(self.scanned) - set(segments):
+                return self.load()
+            for segment in segments:
+                if os.path.getsize(self.segment_path(segment)) > self.scanned.get(segment, 0):
+                    self._scan(segment)
+
+    def _scan(self, segment):
+        header = self.header
+        f = open(self.segment_path(segment), 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            offset = self.scanned.get(segment, 0)
+            f.seek(offset)
+            while offset + header.size <= size:
+                flags, key_length, length, crc = header.unpack(f.read(header.size))
+                end = offset + header.size + key_length + length
+                if end > size:
+                    break # A record that's still being written.
+                key = pickle.loads(f.read(key_length))
+                f.seek(length, 1)
+                self._apply(key, flags, segment, offset + header.size + key_length, length, crc)
+                offset = end
+            self.scanned[segment] = offset
+        finally:
+            f.close()
+
+    def _apply(self, key, flags, segment, data_offset, length, crc):
+        old = self.index.pop(key, None)
+        if old is not None:
+            self.live_bytes -= old[2]
+            self.dead_bytes += old[2]
+        if flags == self.VALUE:
+            self.index[key] = (segment, data_offset, length, crc)
+            self.live_bytes += length
+
+    # The dict interface
+    def get(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            location = self.index.get(key)
+            if location is None:
+                self.refresh()
+                location = self.index.get(key)
+                if location is None:
+                    raise KeyError(key)
+            try:
+                return self._read(key, location)
+            except (IOError, OSError, ValueError):
+                # Another process may have compacted the segment away.
+                self.load()
+                if key not in self.index: raise KeyError(key)
+                return self._read(key, self.index[key])
+
+    def _read(self, key, location, files=None):
+        if files is None: files = self.files
+        segment, offset, length, crc = location
+        f = files.get(segment)
+        if f is None:
+            f = files[segment] = open(self.segment_path(segment), 'rb')
+        f.seek(offset)
+        data = f.read(length)
+        if len(data) != length or zlib.crc32(data) & 0xffffffff != crc:
+            raise ValueError("Damaged record for %r in %s" % (key, self.segment_path(segment)))
+        return data
+
+    def __contains__(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            if key not in self.index:
+                # Another process may have written it since we looked.
+                self.refresh()
+            return key in self.index
+    has_key = __contains__
+
+    def keys(self):
+        with self.lock:
+            self.refresh()
+            return self.index.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_loaded()
+            return len(self.index)
+
+    def put(self, key, data):
+        self._append([(key, self.VALUE, data)])
+
+    def put_many(self, items):
+        '''
+        Append records for all the (key, data) pairs in `items`, in one
+        write.
+        '''
+        self._append([(key, self.VALUE, data) for key, data in items])
+
+    def delete(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            if key not in self.index: raise KeyError(key)
+            self._append([(key, self.TOMBSTONE, '')])
+
+    # Writing
+    def _encode(self, key, flags, data):
+        key_data = pickle.dumps(key, -1)
+        crc = zlib.crc32(data) & 0xffffffff
+        return self.header.pack(flags, len(key_data), len(data), crc) + key_data, data, crc
+
+    def _append(self, records):
+        with self.lock:
+            self._ensure_loaded()
+            encoded = [self._encode(*record) for record in records]
+            lock_file = self._lock()
+            try:
+                # See where everyone else has got to first, so that their
+                # records come before ours in the index, as in the files.
+                self.refresh()
+                segments = self.segments()
+                segment = segments[-1] if segments else 1
+                path = self.segment_path(segment)
+                if os.path.exists(path) and os.path.getsize(path) >= self.segment_size:
+                    segment += 1
+                    path = self.segment_path(segment)
+                f = open(path, 'ab')
+                try:
+                    offset = f.tell()
+                    f.write(''.join(head + data for head, data, crc in encoded))
+                    if self.durable:
+                        f.flush()
+                        os.fsync(f.fileno())
+                finally:
+                    f.close()
+                for (key, flags, data), (head, _, crc) in zip(records, encoded):
+                    self._apply(key, flags, segment, offset + len(head), len(data), crc)
+                    offset += len(head) + len(data)
+                self.scanned[segment] = offset
+            finally:
+                self._unlock(lock_file)
+            self._maybe_compact()
+
+    def _lock(self, name='lock', blocking=True):
+        '''
+        Take a lock that's shared with other processes, if we can.
+        Returns None if `blocking` is False and someone else has it.
+        '''
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        f = open(os.path.join(self.dir, name), 'a')
+        if fcntl is not None:
+            try:
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except IOError:
+                f.close()
+                return None
+        return f
+
+    def _unlock(self, f):
+        if f is not None: f.close()
+
+    # Compaction
+    def _maybe_compact(self):
+        if self.dead_bytes < self.compact_min: return
+        if self.dead_bytes < self.compact_ratio * (self.live_bytes + self.dead_bytes): return
+        if self.compactor is not None and self.compactor.isAlive(): return
+        self.compactor = threading.Thread(target=self._compact_in_background, name='SegmentStore compactor')
+        self.compactor.setDaemon(True)
+        self.compactor.start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception:
+            LOG.error('Error compacting %s', self.dir, exc_info=True)
+
+    def compact(self):
+        '''
+        Copy the live records in all but the newest segment into one
+        segment, and remove the rest. The new segment takes the number of
+        the newest one it replaces, so it still sorts before anything
+        written since.
+        '''
+        compact_lock = self._lock('compact.lock', blocking=False)
+        if compact_lock is None: return # Someone else is doing it.
+        try:
+            with self.lock:
+                self.refresh()
+                sealed = self.segments()[:-1]
+                if not sealed: return
+                sealed_set = set(sealed)
+                live = sorted((location, key) for key, location in self.index.iteritems()
+                              if location[0] in sealed_set)
+            # The sealed segments don't change, so they can be copied
+            # without holding up everyone else.
+            target = sealed[-1]
+            moved = []
+            files = {}
+            with open_for_atomic_overwrite(self.segment_path(target) + '.compact') as out:
+                for location, key in live:
+                    data = self._read(key, location, files)
+                    head, data, crc = self._encode(key, self.VALUE, data)
+                    offset = out.tell()
+                    out.write(head)
+                    out.write(data)
+                    moved.append((key, location, (target, offset + len(head), len(data), crc)))
+            for f in files.values():
+                f.close()
+            with self.lock:
+                lock_file = self._lock()
+                try:
+                    self._close_files()
+                    os.rename(self.segment_path(target) + '.compact', self.segment_path(target))
+                    for segment in sealed[:-1]:
+                        os.remove(self.segment_path(segment))
+                        self.scanned.pop(segment, None)
+                    self.scanned[target] = os.path.getsize(self.segment_path(target))
+                    for key, old, new in moved:
+                        if self.index.get(key) == old:
+                            self.index[key] = new
+                    self.dead_bytes = 0
+                    self.live_bytes = sum(location[2] for location in self.index.itervalues())
+                finally:
+                    self._unlock(lock_file)
+        finally:
+            self._unlock(compact_lock)
+
+    def _close_files(self):
+        for f in self.files.values():
+            f.close()
+        self.files = {}
+
+    def destroy(self):
+        '''
+        Remove all the segments, and the directory.
+        '''
+        with self.lock:
+            self._close_files()
+            if os.path.isdir(self.dir):
+                for name in os.listdir(self.dir):
+                    os.remove(os.path.join(self.dir, name))
+                os.rmdir(self.dir)
+            self.index = None
+
+
+class PackedPickleDict(PickleDict):
+    '''
+    A PickleDict that keeps its values in a SegmentStore instead of a
+    file per key. It has the same interface, so `get_lazy`, `lazy` and
+    the rest work as usual; subdirectories are still directories, and
+    each is a PackedPickleDict of its own.
+
+    Values are always pickled (they can't be memory-mapped out of a
+    segment), and compressed as a whole if they're to be compressed.
+
+    >>> import tempfile
+    >>> pd = PackedPickleDict(tempfile.mkdtemp(), log=False)
+    >>> for i in range(100): pd['result', i] = i * i
+    >>> pd.get_lazy('answer', lambda: 42)
+    42
+    >>> pd = PackedPickleDict(pd.dir)
+    >>> pd['result', 9], pd['answer']
+    (81, 42)
+    >>> len(pd)
+    101
+    >>> sorted(os.listdir(pd.dir))
+    ['_backend', '_locks', '_metalog', '_segments']
+
+    A value computed by `get_lazy` in another process is found in the
+    segments, rather than computed again. (Here the processes are
+    threads with a PackedPickleDict each, so none shares an index.)
+
+    >>> calls = []
+    >>> def slow():
+    ...     calls.append(1)
+    ...     time.sleep(0.2)
+    ...     return 42
+    >>> def compute():
+    ...     PackedPickleDict(pd.dir, log=False).get_lazy('slow', slow)
+    >>> threads = [threading.Thread(target=compute) for i in range(3)]
+    >>> for t in threads: t.start()
+    >>> for t in threads: t.join()
+    >>> len(calls), pd['slow']
+    (1, 42)
+    '''
+    __slots__ = ['_segments', 'segment_size']
+    backend_name = 'packed'
+    internal_names = PickleDict.internal_names | frozenset(['_segments'])
+
+    def __init__(self, dir, segment_size=64 << 20, **kwargs):
+        super(PackedPickleDict, self).__init__(dir, **kwargs)
+        self.segment_size = segment_size
+        self._segments = SegmentStore(os.path.join(self.dir, '_segments'), segment_size=segment_size,
+                                      durable=self.durability != 'none')
+
+    def __repr__(self):
+        return 'PackedPickleDict(%r)' % self.dir
+
+    def _options(self):
+        options = super(PackedPickleDict, self)._options()
+        options['segment_size'] = self.segment_size
+        return options
+
+    def _read(self, key):
+        data = None
+        start = time.time()
+        if not (self.store_metadata and key == '_meta'):
+            try:
+                data = self._segments.get(key)
+            except KeyError:
+                pass
+        if data is None:
+            # A subdirectory, perhaps.
+            return super(PackedPickleDict, self)._read(key)
+        read = time.time()
+        if self.log: self.logger.info('Loading %r...', key)
+        if self.store_metadata:
+            compression = self.get_meta(key, 'compression')
+        else:
+            compression = sniff_compression_of(data)
+        size = len(data)
+        if compression:
+            d = decompressor(compression)
+            data = d.decompress(data)
+        value = pickle.loads(data)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, reads=1, bytes_read=size,
+                           fs_time=read - start, deserialize_time=time.time() - read)
+        if self.log: self.logger.info('Loaded %r (%s).', key, type(value))
+        return value, len(data)
+
+    def _stamp(self, key):
+        # The length and CRC of the record, which compaction doesn't change.
+        self._segments.refresh()
+        location = self._segments.index.get(key)
+        if location is None:
+            return super(PackedPickleDict, self)._stamp(key)
+        return location[2:]
+
+    def _write_data(self, key, val, compression, durability=None):
+        if self.log: self.logger.info('Saving %r... (%s)', key, type(val))
+        start = time.time()
+        data, meta = self._encode(val, compression)
+        pickled = time.time()
+        self._segments.put(key, data)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, writes=1, bytes_written=len(data),
+                           serialize_time=pickled - start, fs_time=time.time() - pickled)
+        return len(data), meta
+
+    def _encode(self, val, compression):
+        '''
+        Returns the record data for a value, and its metadata.
+        '''
+        data = pickle.dumps(val, -1)
+        if compression:
+            c = compressor(compression)
+            data = c.compress(data) + c.flush()
+        return data, dict(type=str(type(val)), codec='pickle', compression=compression)
+
+    def _stage_data(self, txn, key, val, compression):
+        data, meta = self._encode(val, compression)
+        return len(data), meta, data
+
+    def _drop_staged(self, txn, staged):
+        pass
+
+    def _publish(self, txn):
+        # All the records go in one append.
+        records = [(key, SegmentStore.VALUE, write[3]) for key, write in txn.writes.iteritems()]
+        subdirs = []
+        for key in txn.deletes:
+            if key in self._segments:
+                records.append((key, SegmentStore.TOMBSTONE, ''))
+            elif os.path.isdir(self.path_for_key(key)):
+                subdirs.append(key)
+        self._segments._append(records)
+        for key in subdirs:
+            PickleDict._remove_stored(self, key)
+        if self.store_metadata:
+            self._write_meta(dict((key, write[2]) for key, write in txn.writes.iteritems()))
+            for key in txn.deletes:
+                self._metadata.discard(key)
+
+    def _stored_stat(self, key):
+        self._segments._ensure_loaded()
+        location = self._segments.index.get(key)
+        if location is None:
+            return super(PackedPickleDict, self)._stored_stat(key)
+        return location[2], 0
+
+    def _journal(self, key):
+        # Values are small here; update_dict just rewrites them.
+        return None
+
+    def _remove_stored(self, key):
+        if key in self._segments:
+            self._segments.delete(key)
+        else:
+            super(PackedPickleDict, self)._remove_stored(key)
+
+    def _rename_stored(self, old, new):
+        if old in self._segments:
+            self._segments.put(new, self._segments.get(old))
+            self._segments.delete(old)
+        else:
+            super(PackedPickleDict, self)._rename_stored(old, new)
+
+    def _iter_stored(self):
+        # The directory only holds subdirectories, so listing it is cheap.
+        for key in super(PackedPickleDict, self)._iter_stored():
+            yield key
+        for key in self._segments.keys():
+            yield key
+
+    def _on_disk(self, key):
+        return key in self._segments or super(PackedPickleDict, self)._on_disk(key)
+
+    def _clear(self):
+        super(PackedPickleDict, self)._clear()
+        self._segments.destroy()
+
+    def compact(self):
+        '''
+        Compact the segments now, rather than waiting for it to happen
+        in the background.
+        '''
+        self._segments.compact()
@@ -1,32 +1,235 @@
 from __future__ import with_statement
-from csc_utils.io import open_for_atomic_overwrite
+from csc_utils.io import open_for_atomic_overwrite, write_to_file_atomically, open_compressed, compression_for_filename, sniff_compression, iter_dir, exclusive_lock, compressor, decompressor
+from csc_utils.io import file_lock, fsync_dir, make_durable, SyncGroup, CompressedWriter, DecompressedReader, BLOCK_SIZE
 import os.path
 import cPickle as pickle
+from csc_utils.chunked import ChunkedFile, CHUNKED_MAGIC
+from csc_utils.journal import Journal, apply_delta, file_stamp
+from csc_utils.serializers import Codec, CODECS, register_codec, codec_named
+import atexit
 import base64
+import copy
+import errno
+import hashlib
 import logging
 import itertools
+import shutil
+import tempfile
+import threading
+import time
+import weakref
+import zlib
 from UserDict import DictMixin
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:
+    fcntl = None # No locking between processes, then.
 LOG = logging.getLogger(__name__)
+_missing = object()
 
-def unpickle(f):
-    if isinstance(f, basestring): f = open(f, 'rb')
+def unpickle(f, compression=None):
+    if isinstance(f, basestring): f = open_compressed(f, compression or 'none')
     return pickle.load(f)
 
-def save_pickle(obj, filename):
-    with open_for_atomic_overwrite(filename) as f:
+def save_pickle(obj, filename, compression=None, durability=None, size_hint=None):
+    '''
+    Atomically pickles `obj` to `filename`, compressing it on the way
+    if `compression` is one of csc_utils.io.COMPRESSIONS. Returns the
+    size of the file. See open_for_atomic_overwrite for `durability`
+    and `size_hint`.
+    '''
+    with open_for_atomic_overwrite(filename, compression=compression, durability=durability,
+                                   size_hint=size_hint) as f:
         pickle.dump(obj, f, -1)
+    if isinstance(durability, SyncGroup):
+        return durability.getsize(filename)
+    return os.path.getsize(filename)
+
+# Arrays are stored in the .npy format, several to a file if need be,
+# so that they can be memory-mapped when they're loaded.
+NPY_MAGIC = '\x93NUMPY'
+NPY_ALIGNMENT = 64
+
+def is_plain_array(obj):
+    '''
+    Is `obj` a numpy array that can be stored as raw data? Subclasses
+    (which may carry extra attributes, like labels) and arrays of Python
+    objects can't be.
+    '''
+    import sys
+    if 'numpy' not in sys.modules: return False # it can't be an array, then.
+    import numpy
+    return type(obj) in (numpy.ndarray, numpy.memmap) and not obj.dtype.hasobject
+
+SPARSE_TAG = 'scipy.sparse.'
+SPARSE_COMPONENTS = {'csr': ('data', 'indices', 'indptr'),
+                     'csc': ('data', 'indices', 'indptr'),
+                     'coo': ('data', 'row', 'col')}
+
+def is_sparse_matrix(obj):
+    '''
+    Is `obj` a scipy.sparse matrix in one of the formats whose components
+    can be stored as raw arrays?
+    '''
+    import sys
+    if 'scipy.sparse' not in sys.modules: return False
+    import scipy.sparse
+    return (scipy.sparse.isspmatrix(obj) and obj.format in SPARSE_COMPONENTS
+            and not obj.dtype.hasobject)
+
+def save_arrays(arrays, filename, durability=None):
+    '''
+    Atomically writes a sequence of arrays to a file, as consecutive
+    .npy records. A file with a single array is just a .npy file.
+    Returns the size of the file.
+    '''
+    import numpy
+    from numpy.lib import format
+    arrays = [numpy.asarray(arr) for arr in arrays]
+    # Each header (and its padding) takes a few hundred bytes at most.
+    size_hint = sum(arr.nbytes + 256 for arr in arrays)
+    with open_for_atomic_overwrite(filename, durability=durability, size_hint=size_hint) as f:
+        for arr in arrays:
+            pad = -f.tell() % NPY_ALIGNMENT
+            if pad: f.write('\0' * pad)
+            format.write_array(f, arr)
         return f.tell()
 
-def get_picklecached_thing(filename, func=None, name=None):
+def load_arrays(filename, mmap_mode='c', limit=None):
+    '''
+    Loads the arrays written by `save_arrays`. If `mmap_mode` is not
+    None, the arrays are memory-mapped with that mode (see
+    `numpy.memmap`) instead of being read in: they cost no memory until
+    they're used, and the pages are shared with every other process
+    that maps the same file. If `limit` is given, only that many arrays
+    are loaded.
+    '''
+    import numpy
+    from numpy.lib import format
+    arrays = []
+    f = open(filename, 'rb')
+    try:
+        size = os.fstat(f.fileno()).st_size
+        while f.tell() < size and (limit is None or len(arrays) < limit):
+            pad = -f.tell() % NPY_ALIGNMENT
+            if pad: f.seek(pad, 1)
+            version = format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = format.read_array_header_2_0(f)
+            order = 'F' if fortran_order else 'C'
+            count = 1
+            for dim in shape: count *= dim
+            nbytes = count * dtype.itemsize
+            if mmap_mode is not None and nbytes > 0:
+                arr = numpy.memmap(filename, dtype=dtype, mode=mmap_mode, offset=f.tell(),
+                                   shape=shape, order=order)
+                f.seek(nbytes, 1)
+            else:
+                arr = numpy.fromfile(f, dtype=dtype, count=count)
+                arr = arr.reshape(shape[::-1]).transpose() if fortran_order else arr.reshape(shape)
+            arrays.append(arr)
+    finally:
+        f.close()
+    return arrays
+
+def save_array(arr, filename, durability=None):
+    return save_arrays([arr], filename, durability)
+
+def load_array(filename, mmap_mode='c'):
+    return load_arrays(filename, mmap_mode)[0]
+
+def save_sparse(mat, filename, durability=None):
+    '''
+    Saves a scipy.sparse matrix as a tag giving its format, its shape,
+    and its component arrays.
+    '''
+    import numpy
+    components = [getattr(mat, name) for name in SPARSE_COMPONENTS[mat.format]]
+    header = [numpy.array([SPARSE_TAG + mat.format]), numpy.array(mat.shape)]
+    return save_arrays(header + components, filename, durability)
+
+def load_sparse(filename, mmap_mode='c'):
+    import scipy.sparse
+    arrays = load_arrays(filename, mmap_mode)
+    format = str(arrays[0][0])[len(SPARSE_TAG):]
+    shape, components = tuple(int(n) for n in arrays[1]), arrays[2:]
+    if format == 'coo':
+        data, row, col = components
+        return scipy.sparse.coo_matrix((data, (row, col)), shape=shape, copy=False)
+    cls = getattr(scipy.sparse, format + '_matrix')
+    return cls(tuple(components), shape=shape, copy=False)
+
+class NpyCodec(Codec):
+    '''
+    Numpy arrays, as .npy data that can be memory-mapped.
+    '''
+    name = 'npy'
+    magic = NPY_MAGIC
+    compressible = False
+    raw = True
+
+    def accepts(self, val):
+        return is_plain_array(val)
+
+    def save(self, val, filename, compression=None, durability=None):
+        return save_array(val, filename, durability)
+
+    def load(self, filename, compression=None, mmap_mode='c'):
+        return load_array(filename, mmap_mode)
+
+class SparseCodec(NpyCodec):
+    '''
+    scipy.sparse matrices, as their component arrays.
+    '''
+    name = 'sparse'
+
+    def accepts(self, val):
+        return is_sparse_matrix(val)
+
+    def save(self, val, filename, compression=None, durability=None):
+        return save_sparse(val, filename, durability)
+
+    def load(self, filename, compression=None, mmap_mode='c'):
+        return load_sparse(filename, mmap_mode)
+
+register_codec(SparseCodec())
+register_codec(NpyCodec())
+
+def sniff_codec(filename):
+    '''
+    Works out how a file written by a PickleDict was encoded, for when
+    there's no metadata to say.
+    '''
+    f = open_compressed(filename, sniff_compression(filename) or 'none')
+    try:
+        head = f.read(64)
+    finally:
+        f.close()
+    if head.startswith(CHUNKED_MAGIC):
+        return 'chunked'
+    for codec in CODECS:
+        if codec.magic and not codec.raw and head.startswith(codec.magic):
+            return codec.name
+    if not head.startswith(NPY_MAGIC):
+        return 'pickle'
+    first = load_arrays(filename, mmap_mode='r', limit=1)[0]
+    if first.dtype.kind == 'S' and first.shape == (1,) and first[0].startswith(SPARSE_TAG):
+        return 'sparse'
+    return 'npy'
+
+def get_picklecached_thing(filename, func=None, name=None, compression=None):
     # This functionality is superceded by PickleDict.get_lazy.
+    #
+    # The compression is inferred from the extension (.gz, .bz2, .xz)
+    # if it isn't given.
     if name is None: name = filename
-    if filename.endswith('.gz'):
-        import gzip
-        opener = gzip.open
-    else:
-        opener = open
+    if compression is None:
+        compression = compression_for_filename(filename) or 'none'
     try:
-        f = opener(filename, 'rb')
+        f = open_compressed(filename, compression)
         LOG.info('Loading %s', name)
         result = unpickle(f)
         f.close()
@@ -35,7 +238,7 @@ def get_picklecached_thing(filename, func=None, name=None):
         LOG.info('Computing %s', name)
         result = func()
         LOG.info('Saving %s', name)
-        save_pickle(result, filename)
+        save_pickle(result, filename, compression)
     return result
 load_pickle = get_picklecached_thing
 
@@ -97,238 +300,3187 @@ def human_readable_size(sz, multiplier=1000, sizes=['B', 'kB', 'MB', 'GB']):
     return '%.2f%s' % (sz, name)
 
 
-class PickleDict(object, DictMixin):
+def estimate_size(obj, default=None):
     '''
-    A PickleDict is a dict that dumps its values as pickles in a
-    directory. It makes a convenient dumping ground for temporary
-    data.
+    Guesses how many bytes `obj` takes up in memory: its `nbytes` if it
+    is an array, the total of its component arrays if it is a
+    scipy.sparse matrix, otherwise `default` (such as the size of its
+    pickle) if that's given.
+    '''
+    nbytes = getattr(obj, 'nbytes', None)
+    if isinstance(nbytes, (int, long)):
+        return nbytes
+    parts = [getattr(obj, attr, None) for attr in ('data', 'indices', 'indptr', 'row', 'col')]
+    sizes = [part.nbytes for part in parts if isinstance(getattr(part, 'nbytes', None), (int, long))]
+    if sizes:
+        return sum(sizes)
+    if default is not None:
+        return default
+    import sys
+    return sys.getsizeof(obj)
+
+def fingerprint(obj):
+    '''
+    A cheap digest of the contents of `obj`, to tell whether it has
+    been changed in place: a CRC of the data of an array (or of each
+    component array of a sparse matrix), or of the pickle of anything
+    else.
+
+    >>> a = [1, 2]
+    >>> before = fingerprint(a)
+    >>> a.append(3)
+    >>> fingerprint(a) == before
+    False
+    '''
+    if is_plain_array(obj):
+        import numpy
+        data = numpy.ascontiguousarray(obj)
+        return obj.shape, obj.dtype.str, zlib.crc32(data.data) & 0xffffffff
+    if is_sparse_matrix(obj):
+        return (obj.format, obj.shape) + tuple(fingerprint(getattr(obj, name))
+                                               for name in SPARSE_COMPONENTS[obj.format])
+    data = pickle.dumps(obj, -1)
+    return len(data), zlib.crc32(data) & 0xffffffff
+
+def argument_hash(obj):
+    '''
+    A hex digest of `obj` (the arguments of a call, say) that's the same
+    for equal values in every process, unlike `hash` or a pickle: dicts
+    and sets are hashed in sorted order, arrays by their dtype, shape
+    and data, and OrderedSets by their items, in order.
+
+    >>> import numpy
+    >>> argument_hash(numpy.arange(3)) == argument_hash(numpy.array([0, 1, 2]))
+    True
+    >>> argument_hash({'a': 1, 'b': [2]}) == argument_hash({'b': [2], 'a': 1})
+    True
+    >>> from csc_utils.ordered_set import OrderedSet
+    >>> argument_hash(OrderedSet('ab')) == argument_hash(OrderedSet('ba'))
+    False
+    '''
+    h = hashlib.sha1()
+    _hash_into(h, obj)
+    return h.hexdigest()
+
+def _hash_into(h, obj):
+    from csc_utils.ordered_set import OrderedSet
+    if obj is None or isinstance(obj, (bool, int, long, float, complex, str, unicode)):
+        # Tagged with the type, so that 1, 1.0 and True differ.
+        h.update('%s:%r;' % (type(obj).__name__, obj))
+    elif isinstance(obj, (tuple, list)):
+        h.update('%s:%d;' % (type(obj).__name__, len(obj)))
+        for item in obj:
+            _hash_into(h, item)
+    elif isinstance(obj, OrderedSet):
+        h.update('OrderedSet:%d;' % len(obj))
+        for item in obj.items:
+            _hash_into(h, item)
+    elif isinstance(obj, dict):
+        items = sorted((argument_hash(key), argument_hash(value)) for key, value in obj.iteritems())
+        h.update('dict:%d;%s' % (len(items), ''.join(key + value for key, value in items)))
+    elif isinstance(obj, (set, frozenset)):
+        items = sorted(argument_hash(item) for item in obj)
+        h.update('set:%d;%s' % (len(items), ''.join(items)))
+    elif is_sparse_matrix(obj):
+        h.update('sparse:%s:%r;' % (obj.format, obj.shape))
+        for name in SPARSE_COMPONENTS[obj.format]:
+            _hash_into(h, getattr(obj, name))
+    elif hasattr(obj, 'dtype') and hasattr(obj, 'shape'):
+        import numpy
+        arr = numpy.asarray(obj)
+        if arr.dtype.hasobject:
+            h.update('objects:%r;' % (arr.shape,))
+            _hash_into(h, arr.ravel().tolist())
+        else:
+            if arr.dtype.byteorder == '>':
+                arr = arr.astype(arr.dtype.newbyteorder('<'))
+            arr = numpy.ascontiguousarray(arr)
+            h.update('array:%s:%r;' % (arr.dtype.str, arr.shape))
+            h.update(arr.data)
+    else:
+        # The best we can do for anything else.
+        h.update('pickle:')
+        h.update(pickle.dumps(obj, 2))
+
+def source_version(func):
+    '''
+    A version for `func` that changes when its source code does (or its
+    bytecode, if the source can't be found).
+    '''
+    import inspect
+    try:
+        source = inspect.getsource(func)
+    except (IOError, TypeError):
+        code = func.func_code
+        source = code.co_code + repr(code.co_consts)
+    return hashlib.sha1(source).hexdigest()[:12]
+
+
+class CachePolicy(object):
+    '''
+    Decides how much PickleDicts keep in memory.
+
+    By default there is no limit. With `max_entries` or `max_bytes`,
+    the least recently used values are dropped from memory (not from
+    disk) to stay under the limit. Sub-PickleDicts share their parent's
+    policy, so the limit applies to the whole tree; a policy can also be
+    shared between unrelated PickleDicts by passing the same one to
+    each. Sizes are approximate; see `estimate_size`.
 
     >>> import tempfile
-    >>> dirname = tempfile.mkdtemp()
-    >>> pd = PickleDict(dirname, extension='.pkl')
+    >>> pd = PickleDict(tempfile.mkdtemp(), cache_policy=CachePolicy(max_entries=2))
+    >>> for key in 'abc': pd[key] = key * 3
+    >>> sorted(pd.cache.keys())
+    ['b', 'c']
+    >>> pd['a'] # loaded from disk again
+    'aaa'
+    >>> sorted(pd.cache.keys())
+    ['a', 'c']
+    >>> stats = pd.cache_stats()
+    >>> stats['hits'], stats['misses'], stats['evictions'], stats['entries']
+    (0, 1, 2, 2)
 
-    Let's clear out the directory so the tests start from a known state.
-    
-    >>> pd._clear()
+    Sub-PickleDicts themselves are never evicted, so they can keep
+    caching their own values.
+    '''
+    def __init__(self, max_entries=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evictions = 0
+        self.entries = self.bytes = 0
+        # Caches can be changed by background threads (see WriterPool).
+        self.lock = threading.RLock()
+        # A circular doubly-linked list of [prev, next, cache, key, size]
+        # nodes, most recently used first.
+        self.root = root = []
+        root[:] = [root, root, None, None, 0]
+
+    def __repr__(self):
+        return 'CachePolicy(max_entries=%r, max_bytes=%r)' % (self.max_entries, self.max_bytes)
+
+    def stats(self):
+        return dict(hits=self.hits, misses=self.misses, evictions=self.evictions,
+                    entries=self.entries, bytes=self.bytes,
+                    max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def over_budget(self):
+        return ((self.max_entries is not None and self.entries > self.max_entries) or
+                (self.max_bytes is not None and self.bytes > self.max_bytes))
+
+    def link(self, cache, key, size):
+        root = self.root
+        first = root[1]
+        node = [root, first, cache, key, size]
+        first[0] = root[1] = node
+        self.entries += 1
+        self.bytes += size
+        return node
+
+    def unlink(self, node):
+        prev, next = node[0], node[1]
+        prev[1], next[0] = next, prev
+        self.entries -= 1
+        self.bytes -= node[4]
+
+    def touch(self, node):
+        root = self.root
+        prev, next = node[0], node[1]
+        prev[1], next[0] = next, prev
+        first = root[1]
+        node[0], node[1] = root, first
+        first[0] = root[1] = node
+
+    def evict(self, keep=None):
+        '''
+        Drop least recently used values until we're within budget.
+        The node `keep` (the value just added) is never dropped, even if
+        it alone is over budget.
+        '''
+        root = self.root
+        while self.over_budget():
+            node = root[0]
+            if node is root or node is keep:
+                break
+            node[2].discard(node[3])
+            self.evictions += 1
+
+
+class LRUCache(object):
+    '''
+    The in-memory cache of a PickleDict. Behaves like a dict, but keeps
+    within the limits of its CachePolicy.
+    '''
+    def __init__(self, policy=None):
+        if policy is None: policy = CachePolicy()
+        self.policy = policy
+        self.data = {}
+        self.nodes = {}
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, key):
+        with self.policy.lock:
+            value = self.data[key]
+            node = self.nodes.get(key)
+            if node is not None:
+                self.policy.touch(node)
+            return value
+
+    def lookup(self, key, default=None):
+        '''
+        Like `get`, but counts the hit or miss.
+        '''
+        with self.policy.lock:
+            if key in self.data:
+                self.policy.hits += 1
+                return self[key]
+            self.policy.misses += 1
+            return default
+
+    def __setitem__(self, key, value):
+        self.put(key, value)
+
+    def put(self, key, value, size=None, pinned=False):
+        '''
+        Cache `value`. `size` is a hint, such as the size of its pickle.
+        Pinned values are never evicted and don't count towards the
+        budget.
+        '''
+        with self.policy.lock:
+            self.discard(key)
+            self.data[key] = value
+            if not pinned:
+                node = self.policy.link(self, key, estimate_size(value, size))
+                self.nodes[key] = node
+                self.policy.evict(keep=node)
+
+    def discard(self, key):
+        with self.policy.lock:
+            node = self.nodes.pop(key, None)
+            if node is not None:
+                self.policy.unlink(node)
+            self.data.pop(key, None)
+
+    def __delitem__(self, key):
+        if key not in self.data: raise KeyError(key)
+        self.discard(key)
+
+    def pop(self, key, *default):
+        with self.policy.lock:
+            if key not in self.data:
+                if default: return default[0]
+                raise KeyError(key)
+            value = self.data[key]
+            self.discard(key)
+            return value
+
+    def get(self, key, default=None):
+        with self.policy.lock:
+            if key in self.data: return self[key]
+            return default
+
+    def keys(self): return self.data.keys()
+    def values(self): return self.data.values()
+    def items(self): return self.data.items()
+    def iteritems(self): return self.data.iteritems()
+    def itervalues(self): return self.data.itervalues()
+
+    def clear(self):
+        for key in self.data.keys():
+            self.discard(key)
+
+
+class DiskQuota(object):
+    '''
+    Limits on what a PickleDict keeps on disk, for using it as a scratch
+    cache: at most `max_bytes` of values, and none that haven't been
+    used for `ttl` seconds. The quota covers the PickleDict it's given
+    to and that PickleDict's subdirectories.
+
+    When a sweep finds the limits exceeded, values are evicted least
+    recently used first, until they take up 90% of `max_bytes`. Sweeps
+    happen every `sweep_interval` seconds in a background thread, if
+    that's given. They also happen during writes, once another 5% of
+    `max_bytes` has been written or a tenth of `ttl` has passed since
+    the last one. When a value was last used is kept in its metadata,
+    updated at most once every `resolution` seconds.
+
+    >>> import tempfile
+    >>> quota = DiskQuota(max_bytes=3000, resolution=0)
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False, quota=quota)
+    >>> for i in range(5): pd['n%d' % i] = 'x' * 1000
+    >>> sorted(pd.keys())
+    ['n3', 'n4']
+    >>> pd['n3'] == 'x' * 1000
+    True
+    >>> pd['n5'] = 'y' * 1000
+    >>> sorted(pd.keys())
+    ['n3', 'n5']
+    >>> quota.evictions
+    4
+    '''
+    # What a sweep brings the total down to, as a fraction of max_bytes.
+    low_water = 0.9
+
+    def __init__(self, max_bytes=None, ttl=None, sweep_interval=None, resolution=60):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self.resolution = resolution
+        self.owner = None
+        self.lock = threading.Lock()
+        self.sweep_lock = threading.Lock()
+        self.written = 0
+        self.last_sweep = time.time()
+        self.evictions = 0
+        # Whether another sweep has been asked for while one was under
+        # way, and whether the last one had to skip values that were
+        # being written.
+        self.again = False
+        self.deferred = False
+        self.sweeper = None
+        self.stopped = threading.Event()
+
+    def __repr__(self):
+        return 'DiskQuota(max_bytes=%r, ttl=%r)' % (self.max_bytes, self.ttl)
+
+    def attach(self, pd):
+        '''
+        The first PickleDict this is given to is the one it sweeps.
+        '''
+        with self.lock:
+            if self.owner is not None: return
+            self.owner = pd
+        if self.sweep_interval:
+            self.sweeper = threading.Thread(target=self._sweep_periodically, name='DiskQuota sweeper')
+            self.sweeper.setDaemon(True)
+            self.sweeper.start()
+
+    def _sweep_periodically(self):
+        while True:
+            self.stopped.wait(self.sweep_interval)
+            if self.stopped.isSet(): return
+            try:
+                self.sweep()
+            except Exception:
+                LOG.error('Error sweeping %r', self.owner, exc_info=True)
+
+    def stop(self):
+        '''
+        Stop the background sweeper, if there is one.
+        '''
+        self.stopped.set()
+
+    def note_write(self, size):
+        '''
+        Count a write, and sweep if one is due.
+        '''
+        with self.lock:
+            self.written += size or 0
+            due = self.max_bytes is not None and self.written >= self.max_bytes / 20.0
+            if self.ttl is not None and time.time() - self.last_sweep >= self.ttl / 10.0:
+                due = True
+        if due:
+            self.sweep()
+
+    def sweep(self):
+        '''
+        Evict values until the limits are met. Returns how many were
+        evicted. If another thread is already sweeping, it sweeps again
+        when it's done, rather than this one waiting.
+        '''
+        if self.owner is None: return 0
+        with self.lock:
+            if not self.sweep_lock.acquire(False):
+                self.again = True
+                return 0
+        evicted = 0
+        try:
+            while True:
+                evicted += self._sweep()
+                with self.lock:
+                    if not self.again:
+                        self.sweep_lock.release()
+                        return evicted
+                    self.again = False
+        except:
+            self.sweep_lock.release()
+            raise
+
+    def _sweep(self):
+        with self.lock:
+            self.written = 0
+            self.last_sweep = now = time.time()
+            self.deferred = False
+        entries = sorted(self.owner._disk_entries(), key=lambda entry: entry[0])
+        total = sum(entry[1] for entry in entries)
+        target = None
+        if self.max_bytes is not None and total > self.max_bytes:
+            target = self.max_bytes * self.low_water
+        evicted = 0
+        for atime, size, pd, key in entries:
+            expired = self.ttl is not None and now - atime > self.ttl
+            if not expired and (target is None or total <= target):
+                break # Everything after this was used more recently.
+            if pd._evict(key):
+                total -= size
+                evicted += 1
+            else:
+                # Being written; try again once it has been.
+                self.deferred = True
+        self.evictions += evicted
+        if evicted:
+            LOG.info('Evicted %d values from %s; %d bytes left', evicted, self.owner.dir, total)
+        return evicted
+
+class Generations(object):
+    '''
+    Versions of a whole set of values (a model's matrices, say) that are
+    swapped in at once, without a pause while they load. Each generation
+    is a PickleDict in _gen/<n>, and _gen/current names the live one.
+    `build` writes a new generation to the side and then switches
+    _gen/current to it, atomically; a process reading through its
+    Generations keeps serving the generation it has until it notices the
+    switch (checking at most every `check_interval` seconds) and has
+    loaded the new generation's values in a background thread: the keys
+    in `prefetch`, or 'all' of them, or by default the ones it had
+    cached from the old one.
+
+    Each process holds a shared lock on the generations it's using (or
+    building), and a generation that isn't live and that nobody holds
+    is deleted.
+
+    >>> import tempfile
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+    >>> gens = pd.generations()
+    >>> with gens.build() as new:
+    ...     new['model'] = 'v1'
+    >>> reader = PickleDict(pd.dir, log=False).generations(check_interval=3600)
+    >>> reader['model']
+    'v1'
+    >>> with gens.build() as new:
+    ...     new['model'] = 'v2'
+    >>> reader['model']
+    'v1'
+    >>> reader.refresh(wait=True)
+    >>> reader['model']
+    'v2'
+    >>> gens.close()
+    >>> sorted(os.listdir(os.path.join(pd.dir, '_gen')))
+    ['2', '2.lock', 'current']
+    '''
+    def __init__(self, pd, prefetch=None, check_interval=1.0, workers=None):
+        self.pd = pd
+        self.dir = os.path.join(pd.dir, GENERATIONS_DIRNAME)
+        self.prefetch = prefetch
+        self.check_interval = check_interval
+        self.workers = workers
+        self.lock = threading.Lock()
+        self.number = self.current = None
+        self.loader = None
+        self.last_check = 0
+        # The open lock files of the generations we hold, by number.
+        self._held = {}
+        try:
+            os.mkdir(self.dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+
+    def __repr__(self):
+        return 'Generations(%r)' % self.dir
+
+    def _path(self, number):
+        return os.path.join(self.dir, str(number))
+
+    def live_number(self):
+        '''
+        The number of the live generation, or None if there isn't one.
+        '''
+        try:
+            f = open(os.path.join(self.dir, GENERATION_POINTER_FILENAME), 'r')
+        except IOError, e:
+            if e.errno == errno.ENOENT: return None
+            raise
+        try:
+            return int(f.read())
+        finally:
+            f.close()
+
+    def _hold(self, number):
+        '''
+        Take a shared lock on a generation.
+        '''
+        while True:
+            f = open(self._path(number) + '.lock', 'a')
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+            # It may have been collected while we waited.
+            try:
+                if os.stat(f.name).st_ino == os.fstat(f.fileno()).st_ino:
+                    break
+            except OSError:
+                pass
+            f.close()
+        with self.lock:
+            if number in self._held:
+                f.close()
+            else:
+                self._held[number] = f
+
+    def _release(self, number):
+        with self.lock:
+            f = self._held.pop(number, None)
+        if f is not None:
+            f.close()
+
+    def _open(self, number):
+        '''
+        Hold generation `number` and open it, or return None if it has
+        been deleted.
+        '''
+        self._hold(number)
+        try:
+            if os.path.isdir(self._path(number)):
+                return self.pd._subdict(self._path(number))
+        except:
+            self._release(number)
+            raise
+        self._release(number)
+        return None
+
+    @contextmanager
+    def build(self, publish=True):
+        '''
+        The block is given a new, empty generation to fill in. If it
+        ends without an exception, the new generation is made live
+        (unless `publish` is False; see `publish`); if it raises one,
+        the new generation is thrown away.
+        '''
+        numbers = [int(name.split('.')[0]) for name in iter_dir(self.dir) if name[0].isdigit()]
+        number = max(numbers or [0]) + 1
+        while True:
+            # Held before it exists, so it can't be collected.
+            self._hold(number)
+            try:
+                os.mkdir(self._path(number))
+                break
+            except OSError, e:
+                self._release(number)
+                if e.errno != errno.EEXIST: raise
+                number += 1
+        try:
+            new = self.pd._subdict(self._path(number))
+            yield new
+            new.flush()
+        except:
+            self._release(number)
+            self.collect()
+            raise
+        if publish:
+            self.publish(number)
+        if number != self.number:
+            self._release(number)
+
+    def publish(self, number):
+        '''
+        Make generation `number` the live one.
+        '''
+        durability = 'none' if self.pd.durability == 'none' else 'file'
+        write_to_file_atomically(os.path.join(self.dir, GENERATION_POINTER_FILENAME), str(number), durability)
+        self.collect()
+
+    def collect(self):
+        '''
+        Delete the generations that aren't live and aren't in use.
+        Returns their numbers.
+        '''
+        if fcntl is None: return []
+        live = self.live_number()
+        collected = []
+        for name in list(iter_dir(self.dir)):
+            if not name.endswith('.lock'): continue
+            number = int(name[:-len('.lock')])
+            if number == live or number in self._held: continue
+            f = open(os.path.join(self.dir, name), 'a')
+            try:
+                try:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue # In use.
+                if self.live_number() == number: continue
+                shutil.rmtree(self._path(number), ignore_errors=True)
+                os.remove(f.name)
+                collected.append(number)
+            finally:
+                f.close()
+        if collected:
+            LOG.info('Deleted generations %s of %s', collected, self.pd.dir)
+        return collected
+
+    def refresh(self, wait=False):
+        '''
+        If another generation has been made live, start loading it in
+        the background, and switch to it once it has loaded. With
+        `wait`, wait for that. (The first generation is loaded right
+        away, as there's nothing else to serve.)
+        '''
+        self.last_check = time.time()
+        number = self.live_number()
+        with self.lock:
+            if number is None or number == self.number or self.loader is not None:
+                loader = self.loader
+                number = None
+            else:
+                loader = self.loader = threading.Thread(target=self._load, args=(number,),
+                                                        name='Generation %d loader' % number)
+                loader.setDaemon(True)
+        if number is not None:
+            if self.current is None:
+                self._load(number)
+                loader = None
+            else:
+                loader.start()
+        if wait and loader is not None:
+            loader.join()
+
+    def _load(self, number):
+        try:
+            new = self._open(number)
+            if new is None: return # Already replaced and collected.
+            old = self.current
+            keys = self.prefetch
+            if keys == 'all':
+                keys = list(new)
+            elif keys is None and old is not None:
+                keys = [k for k, v in old.cache.items() if not isinstance(v, (PickleDict, ChunkedFile))]
+            keys = [k for k in keys or () if k in new]
+            start = time.time()
+            new.get_many(keys, self.workers)
+            LOG.info('Loaded %d values of generation %d of %s in %.1fs',
+                     len(keys), number, self.pd.dir, time.time() - start)
+            with self.lock:
+                old_number = self.number
+                self.current, self.number = new, number
+        except Exception:
+            LOG.error('Error loading generation %d of %s', number, self.pd.dir, exc_info=True)
+            self._release(number)
+            return
+        finally:
+            with self.lock:
+                self.loader = None
+        if old is not None:
+            old.clear_cache()
+            self._release(old_number)
+            self.collect()
+
+    def _live(self):
+        if self.current is None or time.time() - self.last_check >= self.check_interval:
+            self.refresh()
+        if self.current is None:
+            raise KeyError('No generation of %s has been published' % self.pd.dir)
+        return self.current
+
+    def __getitem__(self, key):
+        return self._live()[key]
+
+    def __contains__(self, key):
+        try:
+            return key in self._live()
+        except KeyError:
+            return False
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def close(self):
+        '''
+        Stop using every generation, so that they can be collected.
+        '''
+        with self.lock:
+            self.current = self.number = None
+        for number in list(self._held):
+            self._release(number)
+        self.collect()
+
+
+def parallel_map(func, items, workers=None):
+    '''
+    Returns [func(item) for item in items], but computed by `workers`
+    threads at once. Useful when `func` mostly waits on I/O. If any call
+    raises an exception, the first one is re-raised.
+
+    >>> parallel_map(lambda x: x * 2, range(5), workers=3)
+    [0, 2, 4, 6, 8]
+    '''
+    items = list(items)
+    if not workers or workers <= 1 or len(items) <= 1:
+        return [func(item) for item in items]
+    import sys
+    results = [None] * len(items)
+    errors = []
+    indices = iter(xrange(len(items)))
+    lock = threading.Lock()
+    def work():
+        while not errors:
+            with lock:
+                try:
+                    i = indices.next()
+                except StopIteration:
+                    return
+            try:
+                results[i] = func(items[i])
+            except Exception:
+                errors.append(sys.exc_info())
+    threads = [threading.Thread(target=work) for i in xrange(min(workers, len(items)))]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class _Load(object):
+    '''
+    A read of a key that's under way, which other threads can wait for
+    rather than reading the key again.
+    '''
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def finish(self, result=None, error=None):
+        self.result, self.error = result, error
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error[0], self.error[1], self.error[2]
+        return self.result
+
+
+class Transaction(object):
+    '''
+    The values stored and keys deleted in a `PickleDict.transaction`
+    block, which are staged until the block ends and then published
+    together.
+    '''
+    def __init__(self, pd):
+        self.pd = pd
+        self.thread = threading.currentThread()
+        # key -> (value, size, metadata, what the backend staged)
+        self.writes = {}
+        self.deletes = set()
+        # The directory that values are staged in, if the backend needs
+        # one, and the open file whose lock shows that it's in use.
+        self.dir = None
+        self.lock_file = None
+        self.count = 0
+        # The staged files are written in this, and synced all at once.
+        self.group = SyncGroup()
+
+
+class IOStats(object):
+    '''
+    Counts, for each key of a PickleDict and its sub-PickleDicts, how
+    often it was read, written, found in the cache or computed, how many
+    bytes that moved and how long it took. Times are in seconds, split
+    into time spent on the filesystem, pickling and unpickling, and in
+    `get_lazy` thunks. (Loading a memory-mapped array is all filesystem
+    time; with a custom `load_pickle` or `save_pickle`, it's all
+    pickling time. Otherwise, pickles are read and written a block at a
+    time, and only the reading and writing of the blocks is filesystem
+    time; compressing and decompressing them is pickling time.)
+
+    Entries are keyed by (directory, key).
+
+    >>> import tempfile
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False, stats=True)
+    >>> pd.get_lazy('answer', lambda: 42)
+    42
+    >>> pd.clear_cache()
+    >>> pd['answer'], pd['answer']
+    (42, 42)
+    >>> counts = pd.stats.as_dict()[pd.dir, 'answer']
+    >>> counts['writes'], counts['reads'], counts['hits'], counts['misses']
+    (1, 1, 2, 1)
+    >>> counts['bytes_read'] == counts['bytes_written'] > 0
+    True
+    >>> pd.stats.dump(tempfile.mktemp())
+    '''
+    fields = ('hits', 'misses', 'reads', 'bytes_read', 'writes', 'bytes_written',
+              'fs_time', 'serialize_time', 'deserialize_time', 'compute_time')
+    time_fields = ('fs_time', 'serialize_time', 'deserialize_time', 'compute_time')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def add(self, dir, key, **amounts):
+        with self.lock:
+            counts = self.counts.get((dir, key))
+            if counts is None:
+                counts = self.counts[dir, key] = dict.fromkeys(self.fields, 0)
+            for field, amount in amounts.iteritems():
+                counts[field] += amount
+
+    def as_dict(self):
+        '''
+        Returns a dict from (directory, key) to a dict of counts.
+        '''
+        with self.lock:
+            return dict((name, dict(counts)) for name, counts in self.counts.iteritems())
+
+    def totals(self):
+        totals = dict.fromkeys(self.fields, 0)
+        for counts in self.as_dict().itervalues():
+            for field in self.fields:
+                totals[field] += counts[field]
+        return totals
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def dump(self, filename):
+        '''
+        Writes the counts to `filename` as a tab-separated table, the
+        keys that took the most time first.
+        '''
+        def total_time(item):
+            return sum(item[1][field] for field in self.time_fields)
+        lines = ['\t'.join(self.fields + ('key',))]
+        for (dir, key), counts in sorted(self.as_dict().items(), key=total_time, reverse=True):
+            row = [('%.6f' if field in self.time_fields else '%d') % counts[field] for field in self.fields]
+            lines.append('\t'.join(row + [os.path.join(dir, repr(key))]))
+        write_to_file_atomically(filename, '\n'.join(lines) + '\n')
+
+
+class WriterPool(object):
+    '''
+    Background threads that write values for PickleDicts in
+    write-behind mode (see the `write_behind` argument to PickleDict).
+    A PickleDict shares its pool with its sub-PickleDicts.
+
+    At most `max_pending` writes wait in the queue; after that, storing
+    a value blocks until there's room. Errors are kept in the list that
+    was submitted with the write (each PickleDict has its own), and
+    raised by the next `flush` of that list. `close` stops the threads,
+    once the queue is empty; anything submitted after that is written
+    right away, in the thread that submits it.
+    '''
+    def __init__(self, workers=2, max_pending=64):
+        import Queue
+        self.queue = Queue.Queue(max_pending)
+        # Guards the pending writes of the PickleDicts using this pool.
+        self.lock = threading.RLock()
+        # Writes to the same key are serialized through one of these.
+        self.key_locks = [threading.Lock() for i in xrange(64)]
+        self.errors = []
+        self.threads = []
+        for i in xrange(workers):
+            thread = threading.Thread(target=self._work, name='PickleDict writer %d' % i)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+        self.closed = False
+        # Don't lose writes just because the program ended.
+        _open_writer_pools.add(self)
+
+    def __repr__(self):
+        return 'WriterPool(workers=%d)' % len(self.threads)
+
+    def key_lock(self, key):
+        return self.key_locks[hash(key) % len(self.key_locks)]
+
+    def submit(self, description, func, args=(), errors=None):
+        '''
+        Queues a call of `func(*args)`. An error it raises is added to
+        `errors` (by default, the pool's own list).
+        '''
+        if errors is None: errors = self.errors
+        if self.closed:
+            self._run(description, func, args, errors)
+        else:
+            self.queue.put((description, func, args, errors))
+
+    def _run(self, description, func, args, errors):
+        import sys
+        try:
+            func(*args)
+        except Exception:
+            LOG.error('Error in background write of %s', description, exc_info=True)
+            errors.append(sys.exc_info())
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                return
+            self._run(*item)
+            self.queue.task_done()
+
+    def flush(self, errors=None):
+        '''
+        Waits until every queued write is done, then raises the first
+        error in `errors` (by default, the pool's own list), if any, and
+        empties it.
+        '''
+        self.queue.join()
+        if errors is None: errors = self.errors
+        if errors:
+            error = errors[0]
+            del errors[:]
+            raise error[0], error[1], error[2]
+
+    def close(self):
+        '''
+        Waits until every queued write is done, then stops the threads.
+        '''
+        if self.closed: return
+        self.queue.join()
+        self.closed = True
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        _open_writer_pools.discard(self)
+
+_open_writer_pools = weakref.WeakSet()
+
+def _finish_writes():
+    for pool in list(_open_writer_pools):
+        pool.queue.join()
+atexit.register(_finish_writes)
+
+
+class _TimedFile(object):
+    '''
+    Wraps a file, adding up the time spent reading from and writing to
+    it. Unless `buffered` is False, writes are gathered into blocks
+    first, so that the time measured is the file's and not the timing's.
+    '''
+    def __init__(self, f, buffered=True):
+        self.f = f
+        self.buffered = buffered
+        self.time = 0.0
+        self.blocks = []
+        self.size = 0
+
+    def read(self, size=-1):
+        start = time.time()
+        try:
+            return self.f.read(size)
+        finally:
+            self.time += time.time() - start
+
+    def write(self, data):
+        if not self.buffered:
+            return self._write(data)
+        self.blocks.append(data)
+        self.size += len(data)
+        if self.size >= BLOCK_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.blocks:
+            data = ''.join(self.blocks)
+            self.blocks, self.size = [], 0
+            self._write(data)
+
+    def _write(self, data):
+        start = time.time()
+        try:
+            self.f.write(data)
+        finally:
+            self.time += time.time() - start
+
+    def close(self):
+        self.f.close()
+
+
+class KeyIndex(object):
+    '''
+    An index from the non-string keys of a PickleDict to the names of
+    the files they are stored under.
+
+    Such keys are stored under their pickle, base64-encoded. Pickles
+    are not canonical, though (see `PickleDict.path_for_key`), so the
+    filename for an existing key can't simply be recomputed; it has to
+    be found. The index keeps a dict from keys to filenames, so that
+    finding one costs a hash lookup instead of decoding every filename
+    in the directory.
+
+    The index is saved in the directory as an append-only log of
+    pickled records. When it is loaded it is reconciled against the
+    directory listing, so that files written by other processes (or by
+    other versions of Python) are picked up, and a missing or damaged
+    log is just rebuilt.
+
+    >>> import tempfile
+    >>> dirname = tempfile.mkdtemp()
+    >>> pd = PickleDict(dirname)
+    >>> pd['a', 1] = 'x'
+
+    A file for a key that was pickled differently is still found:
+
+    >>> name = pd.special_character + base64.urlsafe_b64encode(pickle.dumps(('b', 2), 0))
+    >>> _ = save_pickle('y', os.path.join(dirname, name))
+    >>> pd = PickleDict(dirname)
+    >>> pd['b', 2]
+    'y'
+    >>> pd.path_for_key(('b', 2)) == os.path.join(dirname, name)
+    True
+
+    The log itself is not one of the keys:
+
+    >>> sorted(pd.keys())
+    [('a', 1), ('b', 2)]
+    '''
+    filename = '_keyindex'
+
+    def __init__(self, dir, special_character, extension, list_names=None, stamp_path=None):
+        self.dir = dir
+        self.path = os.path.join(dir, self.filename)
+        self.special_character = special_character
+        self.extension = extension
+        # Where the filenames come from, and which directory's mtime
+        # changes when files are added; these differ in a sharded layout.
+        self.list_names = list_names or (lambda: iter_dir(self.dir))
+        self.stamp_path = stamp_path or dir
+        # Loaded lazily, because plain string keys never need the index.
+        self.names_by_key = None
+        self.keys_by_name = None
+        self.mtime = None
+        self.lock = threading.RLock()
+
+    def decode(self, name):
+        return pickle.loads(base64.urlsafe_b64decode(name[1:]))
+
+    def key_for_name(self, name):
+        if self.keys_by_name is not None and name in self.keys_by_name:
+            return self.keys_by_name[name]
+        return self.decode(name)
+
+    def lookup(self, key):
+        '''
+        Returns the name that `key` is stored under, or None if it isn't
+        stored.
+        '''
+        with self.lock:
+            if self.names_by_key is None:
+                self.load()
+            name = self.names_by_key.get(key)
+            if name is None and self._dir_mtime() != self.mtime:
+                # Someone else has been writing to the directory.
+                self._append(self.sync())
+                name = self.names_by_key.get(key)
+            return name
+
+    def add(self, name, key):
+        with self.lock:
+            if self.names_by_key is None:
+                self.load()
+            if self.keys_by_name.get(name, self) == key:
+                return
+            self._add(name, key)
+            self._append([('+', name, key)])
+
+    def remove(self, name):
+        with self.lock:
+            if self.names_by_key is None or name not in self.keys_by_name:
+                return
+            self._discard(name)
+            self._append([('-', name)])
+
+    def touched(self):
+        '''
+        Called when this process changed the directory in a way that
+        doesn't affect the index, so that the change doesn't force a
+        resync.
+        '''
+        with self.lock:
+            if self.mtime is not None:
+                self.mtime = self._dir_mtime()
+
+    def load(self):
+        self.names_by_key, self.keys_by_name = {}, {}
+        if os.path.exists(self.path):
+            f = open(self.path, 'rb')
+            try:
+                while True:
+                    try:
+                        record = pickle.load(f)
+                    except Exception:
+                        # EOF, or a record truncated by a crash. Either
+                        # way, sync() makes up for anything missing.
+                        break
+                    if record[0] == '+':
+                        self._add(record[1], record[2])
+                    else:
+                        self._discard(record[1])
+            finally:
+                f.close()
+        if self.sync():
+            self.compact()
+
+    def sync(self):
+        '''
+        Brings the index up to date with the directory. Only filenames
+        that aren't already in the index get decoded.
+
+        Returns the list of changes, as log records.
+        '''
+        self.mtime = self._dir_mtime()
+        on_disk = set()
+        for name in self.list_names():
+            if not name.startswith(self.special_character): continue
+            if self.extension and name.endswith(self.extension):
+                name = name[:-len(self.extension)]
+            on_disk.add(name)
+        changes = []
+        for name in on_disk:
+            if name in self.keys_by_name: continue
+            try:
+                key = self.decode(name)
+            except Exception:
+                continue # Not one of ours.
+            self._add(name, key)
+            changes.append(('+', name, key))
+        for name in self.keys_by_name.keys():
+            if name not in on_disk:
+                self._discard(name)
+                changes.append(('-', name))
+        return changes
+
+    def compact(self):
+        '''
+        Rewrite the log with just the current entries.
+        '''
+        with open_for_atomic_overwrite(self.path) as f:
+            for name, key in self.keys_by_name.iteritems():
+                pickle.dump(('+', name, key), f, -1)
+        self.mtime = self._dir_mtime()
+
+    def destroy(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        self.names_by_key = self.keys_by_name = self.mtime = None
+
+    def _add(self, name, key):
+        self._discard(name)
+        self.names_by_key[key] = name
+        self.keys_by_name[name] = key
+
+    def _discard(self, name):
+        if name in self.keys_by_name:
+            key = self.keys_by_name.pop(name)
+            if self.names_by_key.get(key) == name:
+                del self.names_by_key[key]
+
+    def _append(self, records):
+        if not records: return
+        data = ''.join(pickle.dumps(record, -1) for record in records)
+        f = open(self.path, 'ab')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        # Our own changes to the directory don't make the index stale.
+        self.mtime = self._dir_mtime()
+
+    def _dir_mtime(self):
+        try:
+            return os.stat(self.stamp_path).st_mtime
+        except OSError:
+            return None # No shards yet.
+
+class MetaLog(object):
+    '''
+    The metadata of a PickleDict: a dict from keys to dicts of
+    metadata, kept in memory and saved in the directory as a single
+    append-only log of pickled records.
+
+    The log is read once, the first time metadata is needed, so
+    opening a PickleDict costs nothing however many keys it has, and
+    looking up metadata doesn't touch the filesystem. Each change
+    appends a record; a batch of changes appends them all in one write.
+    When the log has grown to `compact_ratio` times the number of keys
+    it describes, it is compacted into a single record. Changes made by
+    other processes are picked up by `refresh`.
+
+    Setting a single field appends a record of just that field, which
+    is merged into the metadata when the log is read; so an instance
+    that hasn't seen the latest metadata of a key doesn't undo it.
+
+    >>> import tempfile
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+    >>> pd.set_many(dict(('n%d' % i, i) for i in range(10)))
+    >>> sorted(name for name in os.listdir(pd.dir) if name.startswith('_'))
+    ['_metalog']
+    >>> PickleDict(pd.dir).get_meta('n3', 'type') == str(int)
+    True
+
+    Metadata written by older versions, as a _meta directory with a
+    pickle for each key, is moved into the log:
+
+    >>> MetaPickleDict(os.path.join(pd.dir, '_meta'))['n3'] = {'type': 'old'}
+    >>> PickleDict(pd.dir).get_meta('n3', 'type')
+    'old'
+    >>> os.path.exists(os.path.join(pd.dir, '_meta'))
+    False
+
+    >>> stale = PickleDict(pd.dir)
+    >>> stale.get_meta('n3', 'type')
+    'old'
+    >>> pd.set_meta('n3', 'type', 'new')
+    >>> stale.set_meta('n3', 'note', 'hi')
+    >>> fresh = PickleDict(pd.dir)
+    >>> fresh.get_meta('n3', 'type'), fresh.get_meta('n3', 'note')
+    ('new', 'hi')
+    '''
+    filename = '_metalog'
+    legacy_dirname = '_meta'
+    compact_ratio = 4
+    compact_min = 1000
+
+    def __init__(self, dir):
+        self.dir = dir
+        self.path = os.path.join(dir, self.filename)
+        self.lock = threading.RLock()
+        self.entries = None # loaded lazily
+        # Where we've read the log up to, and which file that was (it's
+        # replaced when it's compacted).
+        self.offset = 0
+        self.inode = None
+        self.records = 0
+
+    def __repr__(self):
+        return 'MetaLog(%r)' % self.dir
+
+    def load(self):
+        with self.lock:
+            self.entries = {}
+            self.offset = self.records = 0
+            self.inode = None
+            self._read_records()
+            legacy = os.path.join(self.dir, self.legacy_dirname)
+            if os.path.isdir(legacy):
+                self._migrate(legacy)
+
+    def _ensure_loaded(self):
+        if self.entries is None:
+            self.load()
+
+    def refresh(self):
+        '''
+        Pick up changes that other processes have made to the log. This
+        costs a stat() if there are none.
+        '''
+        with self.lock:
+            if self.entries is None:
+                return self.load()
+            try:
+                st = os.stat(self.path)
+            except OSError:
+                if self.inode is not None: self.load() # deleted
+                return
+            if st.st_ino != self.inode or st.st_size < self.offset:
+                self.load()
+            elif st.st_size > self.offset:
+                self._read_records()
+
+    def _read_records(self):
+        try:
+            f = open(self.path, 'rb')
+        except IOError:
+            return
+        try:
+            self.inode = os.fstat(f.fileno()).st_ino
+            f.seek(self.offset)
+            while True:
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    # The end, or a record that's still being written.
+                    break
+                self._apply(record)
+                self.records += 1
+                self.offset = f.tell()
+        finally:
+            f.close()
+
+    def _apply(self, record):
+        if record[0] == 'set':
+            self.entries[record[1]] = record[2]
+        elif record[0] == 'field':
+            self.entries.setdefault(record[1], {})[record[2]] = record[3]
+        elif record[0] == 'del':
+            self.entries.pop(record[1], None)
+        elif record[0] == 'all':
+            self.entries = dict(record[1])
+
+    def _append(self, records):
+        data = ''.join(pickle.dumps(record, -1) for record in records)
+        while True:
+            f = open(self.path, 'ab')
+            try:
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+                    if os.fstat(f.fileno()).st_ino != os.stat(self.path).st_ino:
+                        continue # It was compacted while we waited; use the new one.
+                start = f.tell()
+                f.write(data)
+                f.flush()
+                end = f.tell()
+            finally:
+                f.close()
+            break
+        if self.inode is None or start == self.offset:
+            # Nobody else wrote in between, so we're still up to date.
+            self.inode = os.stat(self.path).st_ino
+            self.offset = end
+        self.records += len(records)
+        if self.records > max(self.compact_min, self.compact_ratio * len(self.entries)):
+            self.compact()
+
+    def compact(self, keep=None):
+        '''
+        Rewrite the log as a single record. If `keep` is given, only the
+        metadata for those keys is kept.
+        '''
+        with self.lock:
+            f = None
+            if os.path.exists(self.path):
+                # Hold the lock on the old log while we replace it, so no
+                # one appends to it in the meantime.
+                f = open(self.path, 'ab')
+                if fcntl is not None:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                self.refresh()
+                if keep is not None:
+                    self.entries = dict((key, meta) for key, meta in self.entries.iteritems()
+                                        if key in keep)
+                with open_for_atomic_overwrite(self.path) as out:
+                    pickle.dump(('all', self.entries), out, -1)
+                    self.offset = out.tell()
+                self.inode = os.stat(self.path).st_ino
+                self.records = 1
+            finally:
+                if f is not None: f.close()
+
+    def _migrate(self, legacy):
+        legacy_meta = MetaPickleDict(legacy)
+        for key in legacy_meta.keys():
+            self.entries[key] = legacy_meta[key]
+        self.compact()
+        legacy_meta._clear()
+        os.rmdir(legacy)
+
+    def destroy(self):
+        with self.lock:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            self.entries = None
+
+    # The dict interface.
+    def __getitem__(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            return dict(self.entries[key])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_field(self, key, meta_key, default=None):
+        with self.lock:
+            self._ensure_loaded()
+            return self.entries.get(key, {}).get(meta_key, default)
+
+    def __setitem__(self, key, meta):
+        self.update({key: meta})
+
+    def update(self, metas):
+        with self.lock:
+            self._ensure_loaded()
+            records = []
+            for key, meta in metas.iteritems():
+                self.entries[key] = dict(meta)
+                records.append(('set', key, self.entries[key]))
+            if records: self._append(records)
+
+    def set_field(self, key, meta_key, value):
+        with self.lock:
+            self._ensure_loaded()
+            record = ('field', key, meta_key, value)
+            self._apply(record)
+            self._append([record])
+
+    def __delitem__(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            if key not in self.entries: raise KeyError(key)
+            self.discard(key)
+
+    def discard(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            if key in self.entries:
+                del self.entries[key]
+                self._append([('del', key)])
+
+    def rename(self, old, new):
+        with self.lock:
+            self._ensure_loaded()
+            meta = self.entries.pop(old)
+            self.entries[new] = meta
+            self._append([('del', old), ('set', new, meta)])
+
+    def __contains__(self, key):
+        with self.lock:
+            self._ensure_loaded()
+            return key in self.entries
+    has_key = __contains__
+
+    def keys(self):
+        with self.lock:
+            self._ensure_loaded()
+            return self.entries.keys()
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def iteritems(self):
+        with self.lock:
+            self._ensure_loaded()
+            return iter([(key, dict(meta)) for key, meta in self.entries.iteritems()])
+
+    def items(self):
+        return list(self.iteritems())
+
+
+# A sharded PickleDict directory keeps its files in
+# _shards/<first hex digits of a hash of the filename>/, so that no one
+# directory gets too big, and says so in its _layout file.
+LAYOUT_FILENAME = '_layout'
+# A directory whose values are stored some other way than as files (see
+# PickleDict's `backend`) names the backend in its _backend file.
+BACKEND_FILENAME = '_backend'
+SHARDS_DIRNAME = '_shards'
+# Where the locks that stop two processes computing the same lazy value
+# at once are kept.
+LOCKS_DIRNAME = '_locks'
+# Where transactions stage their values, each in a directory of its own,
+# and the lock that publishing them takes.
+TXN_DIRNAME = '_txn'
+PUBLISH_LOCK_FILENAME = 'publish.lock'
+# How old a staging directory with nobody using it has to be before it's
+# thrown away, so that one that has only just been made is left alone.
+STALE_STAGING_AGE = 60
+# Where the generations of a PickleDict's values are kept (see
+# Generations), and the file that names the live one.
+GENERATIONS_DIRNAME = '_gen'
+GENERATION_POINTER_FILENAME = 'current'
+# Where the journals of changes to dict and list values are kept (see
+# PickleDict.update_dict). A journal is folded back into its value when
+# it's bigger than JOURNAL_RATIO times the value, or JOURNAL_MIN_SIZE,
+# whichever is more.
+JOURNALS_DIRNAME = '_journals'
+JOURNAL_RATIO = 0.25
+JOURNAL_MIN_SIZE = 64 << 10
+
+def shard_for_name(name, width):
+    '''
+    The shard that the file `name` (without its extension) goes in.
+    It depends only on the name, so every process agrees on it.
+
+    >>> shard_for_name('abc', 2)
+    '90'
+    '''
+    return hashlib.md5(name).hexdigest()[:width]
+
+def read_layout(dir):
+    '''
+    Returns the shard width of a PickleDict directory (0 if it's flat),
+    and whether it is still being migrated to that layout.
+    '''
+    path = os.path.join(dir, LAYOUT_FILENAME)
+    if not os.path.exists(path):
+        return 0, False
+    f = open(path)
+    try:
+        words = f.read().split() # sharded <width> [migrating]
+    finally:
+        f.close()
+    return int(words[1]), 'migrating' in words[2:]
+
+def write_layout(dir, width, migrating=False):
+    write_to_file_atomically(os.path.join(dir, LAYOUT_FILENAME),
+                             'sharded %d%s\n' % (width, ' migrating' if migrating else ''))
+
+def read_backend(dir):
+    '''
+    Returns the name of the backend that a PickleDict directory is
+    stored with, or None if it's stored as plain files.
+    '''
+    try:
+        f = open(os.path.join(dir, BACKEND_FILENAME))
+    except IOError, e:
+        if e.errno == errno.ENOENT: return None
+        raise
+    try:
+        return f.read().strip() or None
+    finally:
+        f.close()
+
+def write_backend(dir, name):
+    if read_backend(dir) != name:
+        write_to_file_atomically(os.path.join(dir, BACKEND_FILENAME), name + '\n')
+
+class PickleDict(object, DictMixin):
+    '''
+    A PickleDict is a dict that dumps its values as pickles in a
+    directory. It makes a convenient dumping ground for temporary
+    data.
+
+    >>> import tempfile
+    >>> dirname = tempfile.mkdtemp()
+    >>> pd = PickleDict(dirname, extension='.pkl')
+
+    Let's clear out the directory so the tests start from a known state.
+    
+    >>> pd._clear()
+
+    >>> pd['abc'] = 123
+    >>> pd['abc']
+    123
+
+    It keeps an internal cache, so to make sure it's actually storing
+    persistently, let's make a new one.
+
+    >>> pd = PickleDict(dirname, extension='.pkl')
+    >>> pd['abc']
+    123
+
+    It behaves like a dictionary:
+
+    >>> pd.keys()
+    ['abc']
+    >>> pd.items()
+    [('abc', 123)]
+    >>> 'abc' in pd
+    True
+    >>> '' in pd
+    False
+    >>> 'blue' in pd
+    False
+
+    If you're just using string keys, you can use the item-to-attr
+    adaptor `d`:
+
+    >>> pd.d.abc
+    123
+    >>> pd.d.key = 'val'
+    >>> del pd.d.abc
+
+    But unlike a normal Python dict, if you change the contents of a
+    list or dict or Tensor that you've pickled, PickleDict won't know
+    that you changed it, unless you tell it:
+
+    >>> pd.d.a = [1, 2, 3]
+    >>> pd.d.a.append(4)
+    >>> pd.d.a = pd.d.a # Force a re-store
+
+    Or you can explicitly say that something changed:
+
+    >>> pd.changed('a')
+    ['a']
+    >>> written = pd.changed() # re-writes everything that's in the cache.
+
+    (unless it was opened with `track_changes`; see `changed`.)
+    
+    PickleDict actually supports any hashable item as a key, by
+    pickling then base64-encoding the key (prepending a `:`). If you
+    see a bunch of odd-looking files, that's where they came from.
+
+    >>> pd[1,2,3] = 4,5,6
+    >>> pd[':abc'] = 'abc' # just to test...
+    >>> pd.clear_cache()
+    >>> ':abc' in pd.keys()
+    True
+
+    Subdirectories are also supported:
+
+    >>> subdir = pd.mkdir('sub')
+    >>> pd['sub'][7,8] = 9, 10
+    >>> subdir[7,8]
+    (9, 10)
+
+    And you can rename things:
+
+    >>> pd.rename('sub', 'dir2')
+    >>> pd['dir2'][7, 8]
+    (9, 10)
+
+    ...and delete subdirectories also:
+
+    >>> del pd['dir2']
+    >>> 'dir2' in pd
+    False
+
+    It can also lazily compute an expensive function only if the
+    result is not already pickled. (This replaces
+    get_picklecached_thing.)
+
+    >>> def thunk():
+    ...     print 'Expensive calculation...'
+    ...     return 42
+    ... 
+    >>> pd.get_lazy('the_answer', thunk)
+    Expensive calculation...
+    42
+    >>> pd.get_lazy('the_answer', thunk)
+    42
+    >>> 'the_answer' in pd
+    True
+
+    Metadata is stored as dictionaries, in a log file in the
+    directory (see MetaLog), and can be looked up as `pd['_meta']`. One
+    thing stored is the type of the object, so you don't have to load
+    it to see what type it is.
+
+    >>> pd['_meta']['the_answer']['type'] == str(int)
+    True
+
+    There's a friendlier interface to getting metadata too:
+
+    >>> pd.get_meta('the_answer', 'type') == str(int)
+    True
+    >>> pd.get_meta('the_answer', 'unknown_key', 'default value')
+    'default value'
+    >>> pd.set_meta('the_answer', 'unknown_key', 'known value')
+    >>> pd.get_meta('the_answer', 'unknown_key', 'default value')
+    'known value'
+
+    Numpy arrays and scipy.sparse matrices aren't pickled. They're
+    stored as raw .npy data, and memory-mapped when they're loaded
+    (copy-on-write, unless you give another `mmap_mode`), so that
+    processes that load the same array share its memory:
+
+    >>> import numpy
+    >>> pd['array'] = numpy.arange(6).reshape(2, 3)
+    >>> pd.clear_cache()
+    >>> pd['array']
+    memmap([[0, 1, 2],
+            [3, 4, 5]])
+    >>> pd.get_meta('array', 'codec')
+    'npy'
+
+    Values can be compressed, either all of them (with the
+    `compression` argument) or one key at a time:
+
+    >>> pd.store('big', range(1000), compression='bz2')
+    >>> pd.clear_cache()
+    >>> pd['big'][-1]
+    999
+    >>> pd.get_meta('big', 'compression')
+    'bz2'
+
+    How hard writes try to survive a crash of the machine is up to
+    `durability`: 'none' (the default) leaves it to the operating
+    system, 'file' syncs each file as it's written, and 'group' does
+    that too, except that the values written together by `set_many`
+    are synced all at once (see csc_utils.io.SyncGroup).
+
+    Values can also be written in the background, by a pool of
+    `write_behind` threads. They're available right away; `flush` waits
+    until they're on disk, and raises any error that happened while
+    writing them. `close` (or leaving a `with` block) does that too,
+    then stops the threads.
+
+    >>> with PickleDict(dirname, extension='.pkl', write_behind=2) as wpd:
+    ...     for i in range(10): wpd['n%d' % i] = i
+    ...     wpd['n3']
+    3
+    >>> PickleDict(dirname, extension='.pkl')['n9']
+    9
+
+    A directory that will hold millions of keys can be `sharded`: its
+    files are spread over subdirectories by a hash of their names (256
+    of them, or 16 ** `sharded` if it's a number). A directory that's
+    already flat stays flat until it's migrated with
+    `migrate_to_sharded`.
+
+    >>> spd = PickleDict(tempfile.mkdtemp(), sharded=True, log=False)
+    >>> spd.update(('n%d' % i, i) for i in range(100))
+    >>> sorted(os.listdir(spd.dir))
+    ['_layout', '_metalog', '_shards']
+    >>> spd = PickleDict(spd.dir)
+    >>> len(spd), spd['n42']
+    (100, 42)
+
+    The values can also be stored some other way, by giving a `backend`:
+    'packed' (see csc_utils.packed_store) or 'sqlite' (see
+    csc_utils.sqlite_store), which suit many small values. A directory
+    that was written with one of them is opened with it again.
+
+    When several processes share a directory, `coherence` makes each of
+    them notice values that the others have rewritten: a cached value is
+    checked against its file (at most once every `coherence` seconds),
+    and only reloaded if the file has changed.
+
+    >>> reader = PickleDict(dirname, extension='.pkl', coherence=0)
+    >>> reader['n1']
+    1
+    >>> PickleDict(dirname, extension='.pkl')['n1'] = 'one'
+    >>> reader['n1']
+    'one'
+
+    A PickleDict used as a scratch cache can be given a `quota` (see
+    DiskQuota), to evict the least recently used values when it gets too
+    big, or values that haven't been used for too long.
+    '''
+    special_character = '+'
+    # How big a value's journal can get, relative to the value, before
+    # it's folded back in (see update_dict).
+    journal_ratio = JOURNAL_RATIO
+    # The other ways of storing values, for the `backend` argument: the
+    # module and class. A directory stored one of these ways says so in
+    # its _backend file.
+    backends = {'packed': ('csc_utils.packed_store', 'PackedPickleDict'),
+                'sqlite': ('csc_utils.sqlite_store', 'SqlitePickleDict')}
+    backend_name = None
+    # Names in the directory that hold PickleDict's own bookkeeping
+    # rather than values.
+    internal_names = frozenset(['_meta', MetaLog.filename, KeyIndex.filename, LAYOUT_FILENAME, BACKEND_FILENAME, SHARDS_DIRNAME,
+                                LOCKS_DIRNAME, TXN_DIRNAME, JOURNALS_DIRNAME, GENERATIONS_DIRNAME])
+    __slots__ = ['logger', 'log', 'dir', 'store_metadata', 'cache', 'extension', 'load_pickle', 'save_pickle',
+                 'store_arrays', 'mmap_mode', 'compression', 'writer', '_key_index', '_pending',
+                 '_metadata', '_shard_width', '_migrating', 'coherence', '_stamps',
+                 'track_changes', '_fingerprints', 'stats', '_loads', '_loads_lock',
+                 '_listings', '_txn', 'durability', 'quota', 'codecs',
+                 '_owns_writer', '_write_errors']
+    
+    def __init__(self, dir, store_metadata=True, log=True, extension='', load_pickle=load_pickle, save_pickle=save_pickle,
+                 cache_policy=None, store_arrays=True, mmap_mode='c', compression=None, write_behind=None,
+                 sharded=False, coherence=None, track_changes=False, stats=None, backend=None,
+                 durability='none', quota=None, codecs=None):
+        # `backend` was dealt with by __new__.
+        self.logger = logging.getLogger('csc_utils.persist.PickleDict')
+        self.log = log
+        self.dir = os.path.abspath(os.path.expanduser(dir))
+        self.extension = extension
+        self.store_metadata = store_metadata
+        self.load_pickle = load_pickle
+        self.save_pickle = save_pickle
+        self.store_arrays = store_arrays
+        self.mmap_mode = mmap_mode
+        self.compression = compression
+        # The codecs to try before pickling (csc_utils.serializers.CODECS,
+        # including any registered later, by default).
+        self.codecs = CODECS if codecs is None else codecs
+        if durability not in ('none', 'file', 'group'):
+            raise ValueError("Unknown durability: %r" % (durability,))
+        self.durability = durability
+        # write_behind is a number of writer threads, or a WriterPool to share.
+        # A pool it makes for itself, it closes when it's closed.
+        self._owns_writer = isinstance(write_behind, (int, long)) and write_behind > 0
+        if self._owns_writer:
+            write_behind = WriterPool(write_behind)
+        self.writer = write_behind or None
+        # Errors in writing its values in the background, for `flush`.
+        self._write_errors = []
+        # key -> [generation, value, compression, extra metadata], for
+        # values that the writer hasn't written yet.
+        self._pending = {}
+        # Seconds between checks that a cached value's file hasn't
+        # changed, or None to trust the cache; key -> [stamp, time checked].
+        self.coherence = coherence
+        self._stamps = {}
+        # key -> fingerprint of the cached value as it was stored.
+        self.track_changes = track_changes
+        self._fingerprints = {}
+        # An IOStats to count reads, writes and time in, or None.
+        if stats is True: stats = IOStats()
+        self.stats = stats or None
+        # key -> _Load, for reads that are under way.
+        self._loads = {}
+        self._loads_lock = threading.Lock()
+        # directory -> (its mtime, the keys in it), so that listing the
+        # keys again doesn't have to read and decode the directory again.
+        self._listings = {}
+        # The Transaction that's open, if any.
+        self._txn = None
+        # A DiskQuota to keep to, or None.
+        self.quota = quota
+        if quota is not None: quota.attach(self)
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+        if self.backend_name is not None:
+            write_backend(self.dir, self.backend_name)
+        self._shard_width, self._migrating = self._open_layout(sharded)
+        self._key_index = self._make_key_index()
+        self.cache = LRUCache(cache_policy)
+        self._metadata = MetaLog(self.dir) if store_metadata else None
+        self._recover_transactions()
+
+    def __new__(cls, dir, *args, **kwargs):
+        if cls is PickleDict:
+            cls = cls._backend_class(dir, kwargs.get('backend'))
+        return object.__new__(cls)
+
+    @classmethod
+    def _backend_class(cls, dir, backend):
+        if backend is None:
+            # A directory that exists already says how it's stored.
+            backend = read_backend(os.path.abspath(os.path.expanduser(dir)))
+        if backend is None or backend == 'files':
+            return cls
+        if backend not in cls.backends:
+            raise ValueError("Unknown PickleDict backend: %r" % backend)
+        module, classname = cls.backends[backend]
+        return getattr(__import__(module, {}, {}, [classname]), classname)
+
+    def __repr__(self):
+        return 'PickleDict(%r)' % self.dir
+
+    def _open_layout(self, sharded):
+        '''
+        Returns the shard width and migration state of the directory. The
+        directory's own _layout file decides, if it has one; `sharded`
+        only applies to a directory that doesn't hold any values yet.
+        '''
+        width, migrating = read_layout(self.dir)
+        if width or not sharded:
+            return width, migrating
+        if any(name not in self.internal_names for name in iter_dir(self.dir)):
+            self.logger.warn('%s already has values in it; use migrate_to_sharded to shard it.', self.dir)
+            return 0, False
+        width = 2 if sharded is True else int(sharded)
+        write_layout(self.dir, width)
+        return width, False
+
+    def _make_key_index(self):
+        stamp_path = None
+        if self._shard_width:
+            stamp_path = os.path.join(self.dir, SHARDS_DIRNAME)
+        return KeyIndex(self.dir, self.special_character, self.extension,
+                        list_names=self._list_names, stamp_path=stamp_path)
+
+    @property
+    def d(self): return ItemToAttrAdaptor(self)
+
+    def path_for_key(self, key):
+        # Pickles are not canonical. For example, the tuple
+        # ('BroadcastName',) pickles to both
+        # '\x80\x02U\rBroadcastName\x85q\x01.' and
+        # '\x80\x02U\rBroadcastNameq\x01\x85q\x02.'. Both were
+        # cPickle.dumps(key, -1). I think one was from Py2.5 and the
+        # other Py2.6, but I'm not sure. In any case, the only thing
+        # we can rely on is that _un_pickling produces __eq__ual
+        # results, so the filename for an existing key is looked up
+        # in the KeyIndex rather than recomputed.
+        if not self._is_special_key(key):
+            return self._path_for_name(key)
+        name = self._key_index.lookup(key)
+        if name is None:
+            # Not stored yet. Make a new name.
+            name = self.special_character+base64.urlsafe_b64encode(pickle.dumps(key, -1))
+        return self._path_for_name(name)
+
+    def _path_for_name(self, name):
+        if not self._shard_width:
+            return os.path.join(self.dir, name)
+        path = os.path.join(self.dir, SHARDS_DIRNAME, shard_for_name(name, self._shard_width), name)
+        if self._migrating and not self._exists(path):
+            # It may not have been moved yet.
+            flat = os.path.join(self.dir, name)
+            if self._exists(flat):
+                return flat
+        return path
+
+    def _exists(self, path):
+        return os.path.exists(path) or os.path.exists(path + self.extension)
+
+    def _make_shard(self, path):
+        '''
+        Make sure the shard directory that `path` is in exists.
+        '''
+        if not self._shard_width: return
+        shard = os.path.dirname(path)
+        if os.path.isdir(shard): return
+        if not os.path.exists(os.path.join(self.dir, LAYOUT_FILENAME)):
+            # It was cleared.
+            write_layout(self.dir, self._shard_width)
+        try:
+            os.makedirs(shard)
+        except OSError:
+            if not os.path.isdir(shard): raise
+
+    def key_for_path(self, path):
+        if self.extension and path.endswith(self.extension):
+            path = path[:-len(self.extension)]
+        if path.startswith(self.special_character):
+            return self._key_index.key_for_name(path)
+        return path
+
+    def _is_special_key(self, key):
+        return not isinstance(key, basestring) or key.startswith(self.special_character) or '/' in key
+
+    def _register_key(self, key, path):
+        '''
+        Record that `key` is now stored at `path`.
+        '''
+        self._listings.pop(os.path.dirname(path), None)
+        if self._is_special_key(key):
+            self._key_index.add(os.path.basename(path), key)
+        else:
+            self._key_index.touched()
+
+    def _unregister_key(self, key, path):
+        self._listings.pop(os.path.dirname(path), None)
+        if self._is_special_key(key):
+            self._key_index.remove(os.path.basename(path))
+
+    def clear_cache(self):
+        for value in self.cache.values():
+            if isinstance(value, PickleDict):
+                value.clear_cache()
+        self.cache.clear()
+        self._stamps.clear()
+        self._fingerprints.clear()
+
+    def cache_stats(self):
+        '''
+        Returns the hit, miss and eviction counts and the current size of
+        the cache, as a dict. These are shared with sub-PickleDicts.
+        '''
+        return self.cache.policy.stats()
+
+    def _load(self, key):
+        '''
+        Just load some data, bypassing the cache.
+        '''
+        return self._read(key)[0]
+
+    def _read(self, key):
+        '''
+        Load some data, bypassing the cache. Returns the data and the
+        size of its file, if it came from one.
+        '''
+        path = self.path_for_key(key)
+        if self.store_metadata and key == '_meta':
+            return self._metadata, None
+
+        if os.path.isdir(path):
+            # Keep sub-PickleDict objects in cache, so that they
+            # can cache their own data.
+            return self._subdict(path), None
+        # Otherwise, expect an actual pickle object, so use the extension.
+        path = path + self.extension
+        if not os.path.exists(path):
+            raise KeyError(key)
+        try:
+            return self._read_file(key, path)
+        except (IOError, OSError), e:
+            if e.errno == errno.ENOENT:
+                # Removed (evicted, say) since we looked.
+                raise KeyError(key)
+            raise
+
+    def _read_file(self, key, path):
+        if self.store_metadata:
+            # Another process may have just rewritten it, or journaled
+            # a change to it.
+            self._metadata.refresh()
+        journal = self._journal(key)
+        if journal is None or not self._journaled(key):
+            return self._load_file(key, path)
+        while True:
+            # Make sure that the journal replayed is the one for the
+            # version of the file that was loaded.
+            base = file_stamp(path)
+            data, size = self._load_file(key, path)
+            records = journal.read(base)
+            if file_stamp(path) == base: break
+        for record in records or ():
+            apply_delta(data, record)
+        return data, size
+
+    def _load_file(self, key, path):
+        if self.log: self.logger.info('Loading %r...', key)
+        codec, compression = self._codec_of(key, path)
+        if codec == 'chunked':
+            # Just a handle; the chunks are read as they're asked for.
+            return ChunkedFile(path), None
+        start = time.time()
+        if codec != 'pickle':
+            codec = codec_named(codec, self.codecs)
+            data = codec.load(path, compression, self.mmap_mode)
+            times = {'fs_time' if codec.raw else 'deserialize_time': time.time() - start}
+        elif self.stats is not None and self.load_pickle is load_pickle:
+            data, times = self._timed_unpickle(path, compression)
+        elif compression:
+            data = self.load_pickle(path, compression=compression)
+            times = dict(deserialize_time=time.time() - start)
+        else:
+            data = self.load_pickle(path)
+            times = dict(deserialize_time=time.time() - start)
+        size = os.path.getsize(path)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, reads=1, bytes_read=size, **times)
+        if self.log: self.logger.info('Loaded %r (%s).', key, type(data))
+        return data, size
+
+    def _timed_unpickle(self, path, compression):
+        '''
+        Unpickles a file a block at a time, timing the reading of the
+        blocks separately.
+        '''
+        start = time.time()
+        compression = compression or compression_for_filename(path)
+        if compression == 'none': compression = None
+        if compression is None:
+            # cPickle reads a real file much faster than anything else,
+            # so time reading through it first (which leaves it in the
+            # page cache), then unpickle it.
+            f = open(path, 'rb')
+            try:
+                while f.read(BLOCK_SIZE): pass
+                read = time.time()
+                f.seek(0)
+                data = pickle.load(f)
+            finally:
+                f.close()
+            return data, dict(fs_time=read - start, deserialize_time=time.time() - read)
+        f = _TimedFile(open(path, 'rb'))
+        try:
+            data = pickle.load(DecompressedReader(f, compression))
+        finally:
+            f.close()
+        total = time.time() - start
+        return data, dict(fs_time=f.time, deserialize_time=total - f.time)
+
+    def _subdict(self, path):
+        return type(self)(path, **self._options())
+
+    def _options(self):
+        '''
+        The constructor arguments that sub-PickleDicts inherit.
+        '''
+        return dict(store_metadata=self.store_metadata,
+                    extension=self.extension,
+                    load_pickle=self.load_pickle,
+                    save_pickle=self.save_pickle,
+                    cache_policy=self.cache.policy,
+                    store_arrays=self.store_arrays,
+                    mmap_mode=self.mmap_mode,
+                    compression=self.compression,
+                    write_behind=self.writer,
+                    sharded=self._shard_width,
+                    coherence=self.coherence,
+                    track_changes=self.track_changes,
+                    stats=self.stats,
+                    durability=self.durability,
+                    quota=self.quota,
+                    codecs=self.codecs)
+
+    def _codec_for(self, val, compression=None):
+        '''
+        Decides how to encode a value: with the first of the PickleDict's
+        `codecs` that accepts it (arrays and sparse matrices as raw data
+        that can be memory-mapped, plain structures with marshal; see
+        csc_utils.serializers), or else as a pickle. A PickleDict with
+        its own save_pickle or load_pickle pickles everything with them.
+        '''
+        if self.save_pickle is not save_pickle or self.load_pickle is not load_pickle:
+            return 'pickle'
+        for codec in self.codecs:
+            if codec.raw and not self.store_arrays: continue
+            if compression and not codec.compressible: continue
+            if codec.accepts(val): return codec.name
+        return 'pickle'
+
+    def _codec_of(self, key, path):
+        '''
+        Finds out how the value for `key`, stored at `path`, was encoded
+        and compressed.
+        '''
+        meta = {}
+        if self.store_metadata:
+            # (_read_file has just refreshed it.)
+            meta = self._metadata.get(key, {})
+        if 'codec' in meta:
+            return meta['codec'], meta.get('compression')
+        if self.load_pickle is not load_pickle:
+            # Someone else's load_pickle gets its files just as they are,
+            # except for the chunked files that we write ourselves.
+            f = open(path, 'rb')
+            try:
+                head = f.read(len(CHUNKED_MAGIC))
+            finally:
+                f.close()
+            return ('chunked' if head == CHUNKED_MAGIC else 'pickle'), None
+        return sniff_codec(path), sniff_compression(path)
+        
+        
+    def __getitem__(self, key):
+        if self.store_metadata and key == '_meta':
+            return self._load(key)
+        data = self._staged(key)
+        if data is not _missing:
+            return data
+        data = self._lookup(key)
+        if data is _missing:
+            data = self._fetch(key)
+        if self.quota is not None and not isinstance(data, PickleDict):
+            self._touch(key)
+        return data
+
+    def _touch(self, key):
+        '''
+        Record that `key` was just used, if we haven't lately.
+        '''
+        if not self.store_metadata: return
+        now = time.time()
+        last = self.get_meta(key, 'atime')
+        if last is None or now - last > self.quota.resolution:
+            try:
+                self.set_meta(key, 'atime', now)
+            except KeyError:
+                pass
+
+    def _fetch(self, key, load=None):
+        '''
+        Reads `key` into the cache and returns its value, or waits for a
+        read of it that's already under way. `load` is the _Load that
+        was registered for this read by `prefetch`, if any.
+        '''
+        if load is None:
+            with self._loads_lock:
+                # A read may have finished since we looked in the cache.
+                data = self.cache.get(key, _missing)
+                if data is not _missing:
+                    return data
+                load = self._loads.get(key)
+                waiting = load is not None
+                if not waiting:
+                    load = self._loads[key] = _Load()
+            if waiting:
+                return load.wait()
+        data = self._unwritten(key)
+        if data is not _missing:
+            # Dropped from the cache (by clear_cache, say) before it was
+            # written; it's still only in memory.
+            with self._loads_lock:
+                if self._loads.get(key) is load:
+                    del self._loads[key]
+                    self.cache.put(key, data, pinned=True)
+            load.finish(data)
+            return data
+        try:
+            data, size, stamp = self._read_stamped(key)
+        except Exception:
+            import sys
+            with self._loads_lock:
+                if self._loads.get(key) is load: del self._loads[key]
+            load.finish(error=sys.exc_info())
+            raise
+        with self._loads_lock:
+            # Unless it was written while we were reading it.
+            if self._loads.get(key) is load:
+                del self._loads[key]
+                self._cache(key, data, size, stamp)
+        load.finish(data)
+        return data
+
+    def _staged(self, key):
+        '''
+        The value that this thread's transaction has stored under `key`,
+        or _missing if it hasn't; raises KeyError if it has deleted it.
+        Staged values are kept out of the cache, which other threads
+        share, until they're published.
+        '''
+        txn = self._current_transaction()
+        if txn is None:
+            return _missing
+        if key in txn.deletes:
+            raise KeyError(key)
+        if key in txn.writes:
+            return txn.writes[key][0]
+        return _missing
+
+    def _unwritten(self, key):
+        '''
+        The value stored under `key` that hasn't been written yet, or
+        _missing if there isn't one.
+        '''
+        if self.writer is None:
+            return _missing
+        with self.writer.lock:
+            pending = self._pending.get(key)
+        if pending is None:
+            return _missing
+        return pending[1]
+
+    def _forget_load(self, key):
+        '''
+        Stop a read of `key` that's under way from caching what it read,
+        because it's being replaced.
+        '''
+        with self._loads_lock:
+            self._loads.pop(key, None)
+
+    def prefetch(self, keys, workers=4):
+        '''
+        Starts loading `keys` into the cache, with `workers` threads in
+        the background, and returns right away. Looking up one of the
+        keys before it's loaded waits for it to be loaded, rather than
+        loading it again. Errors (such as missing keys) are raised when
+        the key is looked up.
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd.update(('n%d' % i, i) for i in range(10))
+        >>> pd.clear_cache()
+        >>> pd.prefetch(['n1', 'n2', 'n3', 'missing'])
+        >>> pd['n3']
+        3
+        >>> pd['missing']
+        Traceback (most recent call last):
+          ...
+        KeyError: 'missing'
+        '''
+        loads = []
+        with self._loads_lock:
+            for key in keys:
+                if key in self._loads or key in self.cache: continue
+                load = self._loads[key] = _Load()
+                loads.append((key, load))
+        def fetch(item):
+            key, load = item
+            try:
+                self._fetch(key, load)
+            except Exception:
+                pass # It's raised again when someone asks for it.
+        def run():
+            parallel_map(fetch, loads, workers)
+        thread = threading.Thread(target=run, name='PickleDict prefetch')
+        thread.setDaemon(True)
+        thread.start()
+
+    def load_all(self, workers=4):
+        '''
+        Loads every value into the cache, including the values in
+        subdirectories, with `workers` threads at once.
+        '''
+        for value in self.get_many(self.keys(), workers).itervalues():
+            if isinstance(value, PickleDict):
+                value.load_all(workers)
+
+    def _lookup(self, key):
+        '''
+        Returns the cached value for `key`, or _missing if it isn't
+        cached or its file has changed since it was.
+        '''
+        data = self.cache.lookup(key, _missing)
+        if self.stats is not None:
+            if data is _missing:
+                self.stats.add(self.dir, key, misses=1)
+            else:
+                self.stats.add(self.dir, key, hits=1)
+        if data is _missing or self.coherence is None:
+            return data
+        entry = self._stamps.get(key)
+        if entry is None:
+            return data # Not from a file (a subdirectory, or pending).
+        now = time.time()
+        if now - entry[1] < self.coherence:
+            return data
+        if self._stamp(key) != entry[0]:
+            if self.log: self.logger.info('%r has changed on disk.', key)
+            self.cache.discard(key)
+            return _missing
+        entry[1] = now
+        return data
+
+    def _read_stamped(self, key):
+        '''
+        Like _read, but also returns the stamp of the file as it was
+        before reading it (so that a change made while reading it isn't
+        missed), if coherence is being checked.
+        '''
+        stamp = None
+        if self.coherence is not None:
+            stamp = self._stamp(key)
+        data, size = self._read(key)
+        return data, size, stamp
+
+    def _stamp(self, key):
+        '''
+        Something that changes whenever the value of `key` is rewritten:
+        the inode, size and mtime of its file, and the size of its
+        journal. None if there's no file.
+        '''
+        try:
+            st = os.stat(self.path_for_key(key) + self.extension)
+        except OSError:
+            return None
+        journal = self._journal(key)
+        if journal is None:
+            return st.st_ino, st.st_size, st.st_mtime, 0
+        if self.store_metadata:
+            self._metadata.refresh()
+        return st.st_ino, st.st_size, st.st_mtime, journal.size() if self._journaled(key) else 0
+
+    def _cache(self, key, data, size=None, stamp=None):
+        self.cache.put(key, data, size, pinned=isinstance(data, PickleDict))
+        if stamp is not None:
+            self._stamps[key] = [stamp, time.time()]
+        else:
+            self._stamps.pop(key, None)
+        if self.track_changes and not isinstance(data, (PickleDict, ChunkedFile)):
+            self._fingerprints[key] = fingerprint(data)
+
+    def _cache_written(self, key, data, size=None):
+        '''
+        Cache a value that we've just written.
+        '''
+        self._forget_load(key)
+        stamp = None
+        if self.coherence is not None:
+            # If another process rewrote it in the meantime, we miss
+            # that until it changes again.
+            stamp = self._stamp(key)
+        self._cache(key, data, size, stamp)
+
+    def _uncache(self, key):
+        '''
+        Drop `key` from the cache, if it's there.
+        '''
+        self._forget_load(key)
+        data = self.cache.pop(key, None)
+        self._stamps.pop(key, None)
+        self._fingerprints.pop(key, None)
+        if isinstance(data, PickleDict):
+            data.clear_cache()
+    
+    def __setitem__(self, key, val):
+        self.store(key, val)
+
+    def store(self, key, val, compression=None):
+        '''
+        Stores `val` under `key`, like `pd[key] = val`, but with a
+        choice of compression for this key (one of
+        csc_utils.io.COMPRESSIONS, or 'none'); the default is the
+        PickleDict's `compression`.
+        '''
+        self._check_key(key)
+        if compression is None: compression = self.compression
+        if compression == 'none': compression = None
+        txn = self._current_transaction()
+        if txn is not None:
+            self._stage(txn, key, val, compression)
+            return
+        if self.writer is None:
+            size = self._write(key, val, compression)
+            self._cache_written(key, val, size)
+            if self.quota is not None: self.quota.note_write(size)
+            return
+        # Write-behind: keep the value in memory (where it can't be
+        # evicted) until the writer has written it.
+        with self.writer.lock:
+            generation = self._pending.get(key, [0])[0] + 1
+            self._pending[key] = [generation, val, compression, {}]
+            self._forget_load(key)
+            self.cache.put(key, val, pinned=True)
+            self._stamps.pop(key, None)
+            self._fingerprints.pop(key, None)
+        self.writer.submit(repr(key), self._write_behind, (key, generation), self._write_errors)
+
+    def _write_behind(self, key, generation):
+        '''
+        Write a pending value, unless it has been overwritten or deleted
+        since.
+        '''
+        with self.writer.key_lock((self.dir, key)):
+            with self.writer.lock:
+                pending = self._pending.get(key)
+                if pending is None or pending[0] != generation: return
+                val, compression = pending[1], pending[2]
+            size = self._write(key, val, compression, pending=pending)
+            with self.writer.lock:
+                if self._pending.get(key) is pending:
+                    del self._pending[key]
+                    if self.cache.get(key, _missing) is val:
+                        self._cache_written(key, val, size)
+                drained = not self._pending
+        if self.quota is not None:
+            self.quota.note_write(size)
+            if drained and self.quota.deferred:
+                # A sweep skipped values that were still being written.
+                self.quota.sweep()
+
+    def _check_key(self, key):
+        '''
+        Refuses to store anything under one of the names that hold the
+        PickleDict's own bookkeeping.
+
+        >>> import tempfile
+        >>> PickleDict(tempfile.mkdtemp(), log=False)['_layout'] = 'x'
+        Traceback (most recent call last):
+            ...
+        ValueError: '_layout' is reserved for PickleDict's own use
+        '''
+        if not isinstance(key, basestring): return
+        if key == '_meta' and not self.store_metadata: return
+        if key in self.internal_names or key + self.extension in self.internal_names:
+            raise ValueError("%r is reserved for PickleDict's own use" % (key,))
+
+    def _write(self, key, val, compression, pending=None):
+        '''
+        Write a value and its metadata to disk. Returns the size of the
+        file, if known.
+
+        `pending` is the record of a write-behind; its metadata is
+        written under the writer's lock, and only if it hasn't been
+        superseded, so that metadata set in the meantime isn't lost.
+        '''
+        size, meta = self._write_data(key, val, compression)
+        if self.store_metadata:
+            if pending is None:
+                self._write_meta({key: meta})
+            else:
+                with self.writer.lock:
+                    if self._pending.get(key) is pending:
+                        meta.update(pending[3])
+                        self._write_meta({key: meta})
+        return size
+
+    def _write_data(self, key, val, compression, durability=None):
+        '''
+        Write just a value. Returns the size of the file (if known) and
+        the metadata that should be stored for it. `durability` is a
+        SyncGroup to write it in, if it's part of a batch.
+        '''
+        path = self.path_for_key(key)
+        self._make_shard(path)
+        result = self._save(key, val, compression, path + self.extension, durability)
+        self._register_key(key, path)
+        if self._journaled(key):
+            # The changes journaled for the old value are in the new one.
+            self._journal(key).prune(file_stamp(path + self.extension))
+        return result
+
+    def _save(self, key, val, compression, filename, durability=None):
+        '''
+        Write the value of `key` to the file `filename`. Returns what
+        _write_data does.
+        '''
+        if durability is None:
+            durability = self._single_durability()
+        if self.log: self.logger.info('Saving %r... (%s)', key, type(val))
+        codec = self._codec_for(val, compression)
+        start = time.time()
+        if codec != 'pickle':
+            encoder = codec_named(codec, self.codecs)
+            size = encoder.save(val, filename, compression, durability)
+            times = {'fs_time' if encoder.raw else 'serialize_time': time.time() - start}
+        elif self.stats is not None and self.save_pickle is save_pickle:
+            size, times = self._timed_pickle(val, filename, compression, durability)
+        elif self.save_pickle is save_pickle:
+            # An array that has to be pickled (a subclass, say) is about
+            # as big as its data.
+            size_hint = getattr(val, 'nbytes', None)
+            if not isinstance(size_hint, (int, long)): size_hint = None
+            size = save_pickle(val, filename, compression, durability, size_hint)
+            times = dict(serialize_time=time.time() - start)
+        else:
+            # Someone else's save_pickle doesn't know about durability.
+            if compression:
+                size = self.save_pickle(val, filename, compression=compression)
+            else:
+                size = self.save_pickle(val, filename)
+            make_durable(filename, durability)
+            times = dict(serialize_time=time.time() - start)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, writes=1, bytes_written=size or 0, **times)
+        if self.log:
+            if isinstance(size, int):
+                self.logger.info('Saved %r (%s)', key, human_readable_size(size))
+            else:
+                self.logger.info('Saved %r', key)
+
+        meta = {}
+        meta['type'] = str(type(val))
+        meta['codec'] = codec
+        meta['compression'] = compression
+        if not isinstance(size, (int, long)):
+            size = None
+        return size, meta
+
+    def _timed_pickle(self, val, path, compression, durability=None):
+        '''
+        Pickles a value to a file a block at a time, timing the writing
+        of the blocks separately.
+        '''
+        start = time.time()
+        with open_for_atomic_overwrite(path, compression=compression, durability=durability) as f:
+            if isinstance(f, CompressedWriter):
+                # It writes a block at a time already.
+                timed = f.f = _TimedFile(f.f, buffered=False)
+                out = f
+            else:
+                timed = out = _TimedFile(f)
+            pickling = time.time()
+            pickle.dump(val, out, -1)
+            if out is timed: timed.flush()
+            serialize_time = time.time() - pickling - timed.time
+        if isinstance(durability, SyncGroup):
+            size = durability.getsize(path)
+        else:
+            size = os.path.getsize(path)
+        return size, dict(serialize_time=serialize_time, fs_time=time.time() - start - serialize_time)
+
+    def store_chunks(self, key, chunks, compression=None):
+        '''
+        Stores the chunks from the iterable `chunks` (lists, say) under
+        `key` as a chunked value, writing them one at a time. Loading the
+        key gives a ChunkedFile, which reads the chunks as they're asked
+        for (see `iter_chunks` and `get_chunk`), and `append_chunks`
+        adds to it without rewriting what's there.
+
+        >>> import tempfile
+        >>> from csc_utils.batch import chunk
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd.store_chunks('squares', (list(c) for c in chunk((i * i for i in xrange(10)), 4)))
+        >>> pd.append_chunks('squares', [[100, 121]])
+        >>> [len(c) for c in pd.iter_chunks('squares')]
+        [4, 4, 2, 2]
+        >>> pd.get_chunk('squares', 3)
+        [100, 121]
+        >>> PickleDict(pd.dir)['squares'].count()
+        12
+
+        The chunks are written to the file as they come, so they can't
+        be held back until a transaction ends:
+
+        >>> with pd.transaction():
+        ...     pd.store_chunks('cubes', [[1, 8]])
+        Traceback (most recent call last):
+            ...
+        RuntimeError: Chunked values can't be stored inside a transaction
+        '''
+        self._check_key(key)
+        self._check_chunks_allowed()
+        if compression is None: compression = self.compression
+        if compression == 'none': compression = None
+        self.flush()
+        path = self.path_for_key(key)
+        self._make_shard(path)
+        value = ChunkedFile.create(path + self.extension, chunks, compression, self._single_durability())
+        self._register_key(key, path)
+        if self.store_metadata:
+            self._write_meta({key: dict(type=str(ChunkedFile), codec='chunked', compression=compression)})
+        self._cache_written(key, value)
+
+    def append_chunks(self, key, chunks, compression=None):
+        '''
+        Appends chunks to the chunked value of `key`, creating it if
+        it isn't stored yet.
+        '''
+        self._check_chunks_allowed()
+        if key not in self:
+            return self.store_chunks(key, chunks, compression)
+        if compression is None:
+            compression = self.get_meta(key, 'compression', self.compression)
+        self._chunked(key).extend(chunks, compression, self._single_durability())
+
+    def _check_chunks_allowed(self):
+        if self._current_transaction() is not None:
+            raise RuntimeError("Chunked values can't be stored inside a transaction")
+
+    def _single_durability(self):
+        # A value written on its own is a group of one.
+        return 'file' if self.durability == 'group' else self.durability
+
+    def iter_chunks(self, key, start=0):
+        '''
+        Yields the chunks of the chunked value of `key` in order,
+        reading one at a time.
+        '''
+        return self._chunked(key).iter_chunks(start)
+
+    def get_chunk(self, key, i):
+        return self._chunked(key).chunk(i)
+
+    def _chunked(self, key):
+        value = self[key]
+        if not isinstance(value, ChunkedFile):
+            raise TypeError('%r is not a chunked value' % (key,))
+        return value
+
+    def update_dict(self, key, items=(), removed=()):
+        '''
+        Adds `items` (a dict or a sequence of pairs) to the dict stored
+        under `key`, and removes the keys in `removed`, without
+        rewriting the whole dict: the change is appended to a journal,
+        which is replayed onto the dict whenever it's loaded, and folded
+        back into it (see `compact_journal`) once it has grown to more
+        than `journal_ratio` times its size.
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd['stats'] = dict(('n%d' % i, i) for i in range(1000))
+        >>> pd.update_dict('stats', {'n1000': 1000}, removed=['n0'])
+        >>> pd['stats']['n1000'], 'n0' in pd['stats']
+        (1000, False)
+        >>> pd.extend_list('log', ['started'])
+        >>> pd.extend_list('log', ['stopped'])
+        >>> other = PickleDict(pd.dir)
+        >>> len(other['stats']), other['log']
+        (1000, ['started', 'stopped'])
+        >>> pd.compact_journal('stats')
+        >>> sorted(os.listdir(os.path.join(pd.dir, '_journals')))
+        ['log']
+        '''
+        self._change_value(key, dict, ('update', dict(items), list(removed)))
+
+    def extend_list(self, key, items):
+        '''
+        Appends `items` to the list stored under `key`, journaling the
+        change like `update_dict`.
+        '''
+        self._change_value(key, list, ('extend', list(items)))
+
+    def _change_value(self, key, kind, record):
+        '''
+        Applies a delta record to the `kind` of value stored under `key`
+        (an empty one, if there's none yet).
+        '''
+        self.flush()
+        cached = self.cache.get(key, _missing)
+        if cached is not _missing and not isinstance(cached, kind):
+            raise TypeError('%r is not a %s' % (key, kind.__name__))
+        path = self.path_for_key(key) + self.extension
+        journal = self._journal(key)
+        if journal is None or self._current_transaction() is not None or not os.path.isfile(path):
+            # Nothing to journal against; write the whole value.
+            value = self[key] if key in self else kind()
+            if not isinstance(value, kind):
+                raise TypeError('%r is not a %s' % (key, kind.__name__))
+            if self._current_transaction() is not None:
+                # Other threads may be reading the published value.
+                value = copy.copy(value)
+            apply_delta(value, record)
+            self.store(key, value, self.get_meta(key, 'compression'))
+            return
+        if self.store_metadata and self.get_meta(key, 'type', str(kind)) != str(kind):
+            raise TypeError('%r is not a %s' % (key, kind.__name__))
+        try:
+            os.mkdir(os.path.dirname(journal.path))
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+        with journal.locked() as f:
+            size = journal.append_locked(f, path, [record])
+            # Flagged while we hold the journal, so that a compaction
+            # (which clears the flag) can't come in between.
+            if self.store_metadata:
+                self._metadata.refresh()
+                if not self._journaled(key):
+                    self.set_meta(key, 'journaled', True)
+        if cached is not _missing:
+            apply_delta(cached, record)
+            self._cache_written(key, cached)
+        base = file_stamp(path)
+        if base is not None and size > max(self.journal_ratio * base[1], JOURNAL_MIN_SIZE):
+            self.compact_journal(key)
+
+    def compact_journal(self, key):
+        '''
+        Folds the journal of changes to the value of `key` (see
+        `update_dict`) back into it, by rewriting it. Its metadata, such
+        as the version `get_lazy` stored it with, is kept.
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd.get_lazy('counts', lambda: {'a': 1}, version=2)
+        {'a': 1}
+        >>> pd.update_dict('counts', {'b': 2})
+        >>> pd.compact_journal('counts')
+        >>> sorted(PickleDict(pd.dir).get_lazy('counts', dict, version=2).items())
+        [('a', 1), ('b', 2)]
+        '''
+        journal = self._journal(key)
+        if journal is None or not os.path.exists(journal.path): return
+        with journal.locked():
+            # Nobody can add to the journal while we hold it.
+            value, size = self._read(key)
+            path = self.path_for_key(key)
+            size, meta = self._save(key, value, self.get_meta(key, 'compression'), path + self.extension)
+            journal.remove()
+            if self.store_metadata:
+                # It's the same value, so keep its version and the rest.
+                self._metadata.refresh()
+                merged = self._metadata.get(key, {})
+                merged.update(meta)
+                merged.pop('journaled', None)
+                self._write_meta({key: merged})
+        self._cache_written(key, value, size)
+
+    def _journal(self, key):
+        '''
+        The Journal of changes to the value of `key` (whether or not it
+        has one yet), or None if values stored this way can't have one.
+        '''
+        name = os.path.basename(self.path_for_key(key)) + self.extension
+        return Journal(os.path.join(self.dir, JOURNALS_DIRNAME, name))
+
+    def _journaled(self, key):
+        '''
+        Might the value of `key` have a journal? Its metadata says so,
+        if there is metadata; otherwise, any value might, once there's a
+        journal at all.
+        '''
+        if self.store_metadata:
+            return self._metadata.get_field(key, 'journaled', False)
+        return os.path.isdir(os.path.join(self.dir, JOURNALS_DIRNAME))
+
+    def _write_meta(self, metas):
+        '''
+        Replace the metadata of several keys at once.
+        '''
+        self._metadata.update(self._mark_used(metas))
 
-    >>> pd['abc'] = 123
-    >>> pd['abc']
-    123
+    def _mark_used(self, metas):
+        '''
+        Records in the metadata of keys that were just written that they
+        were used now, if there's a quota to keep to. Returns `metas`.
+        '''
+        if self.quota is not None:
+            now = time.time()
+            for meta in metas.itervalues():
+                meta['atime'] = now
+        return metas
 
-    It keeps an internal cache, so to make sure it's actually storing
-    persistently, let's make a new one.
+    def set_many(self, mapping, compression=None, workers=None):
+        '''
+        Stores all the items of `mapping` (a dict, or a sequence of
+        pairs). The metadata for the whole batch is written at the end,
+        in one go, and with `workers` the values are written by that
+        many threads at once.
 
-    >>> pd = PickleDict(dirname, extension='.pkl')
-    >>> pd['abc']
-    123
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd.set_many(dict(('n%d' % i, i) for i in range(100)), workers=4)
+        >>> pd = PickleDict(pd.dir)
+        >>> sorted(pd.get_many(['n1', 'n99'], workers=2).items())
+        [('n1', 1), ('n99', 99)]
+        >>> pd.get_meta('n42', 'type') == str(int)
+        True
+        '''
+        items = mapping.items() if hasattr(mapping, 'items') else list(mapping)
+        for key, val in items:
+            self._check_key(key)
+        if compression is None: compression = self.compression
+        if compression == 'none': compression = None
+        if self.writer is not None or self._current_transaction() is not None:
+            # The writer does it all in the background anyway, or the
+            # transaction will publish it all at once.
+            for key, val in items:
+                self.store(key, val, compression)
+            return
 
-    It behaves like a dictionary:
+        group = SyncGroup() if self.durability == 'group' else None
+        def write(item):
+            key, val = item
+            if group is None:
+                return self._write_data(key, val, compression)
+            return self._write_data(key, val, compression, group)
+        try:
+            results = parallel_map(write, items, workers)
+        except:
+            if group is not None: group.abort()
+            raise
+        if group is not None:
+            group.commit()
+        if self.store_metadata:
+            self._write_meta(dict((key, meta) for (key, val), (size, meta) in zip(items, results)))
+        for (key, val), (size, meta) in zip(items, results):
+            self._cache_written(key, val, size)
+        if self.quota is not None:
+            self.quota.note_write(sum(size or 0 for size, meta in results))
 
-    >>> pd.keys()
-    ['abc']
-    >>> pd.items()
-    [('abc', 123)]
-    >>> 'abc' in pd
-    True
-    >>> '' in pd
-    False
-    >>> 'blue' in pd
-    False
+    def get_many(self, keys, workers=None):
+        '''
+        Returns a dict of the values of all the given `keys`. Values that
+        aren't cached are loaded by `workers` threads at once, if given.
+        Raises KeyError if any key is missing.
+        '''
+        result = {}
+        to_load = []
+        for key in keys:
+            data = self._staged(key)
+            if data is _missing:
+                data = self._lookup(key)
+            if data is _missing:
+                to_load.append(key)
+            else:
+                result[key] = data
+        for key, data in zip(to_load, parallel_map(self._fetch, to_load, workers)):
+            result[key] = data
+        return result
 
-    If you're just using string keys, you can use the item-to-attr
-    adaptor `d`:
+    def update(self, other=None, **kwargs):
+        '''
+        Like dict.update, but stores the items in one batch (see
+        `set_many`).
+        '''
+        items = []
+        if other is not None:
+            items.extend(other.items() if hasattr(other, 'items') else other)
+        items.extend(kwargs.items())
+        self.set_many(items)
 
-    >>> pd.d.abc
-    123
-    >>> pd.d.key = 'val'
-    >>> del pd.d.abc
+    def flush(self):
+        '''
+        In write-behind mode, wait until all pending writes are on disk,
+        raising the first error that happened while writing, if any.
+        Otherwise, there's nothing to do.
+        '''
+        if self.writer is not None:
+            self.writer.flush(self._write_errors)
 
-    But unlike a normal Python dict, if you change the contents of a
-    list or dict or Tensor that you've pickled, PickleDict won't know
-    that you changed it, unless you tell it:
+    def close(self):
+        '''
+        Flushes, then stops the write-behind threads, if this PickleDict
+        started them itself. Values stored after that are written right
+        away.
+        '''
+        try:
+            self.flush()
+        finally:
+            if self._owns_writer:
+                self.writer.close()
+                self.writer = None
+                self._owns_writer = False
 
-    >>> pd.d.a = [1, 2, 3]
-    >>> pd.d.a.append(4)
-    >>> pd.d.a = pd.d.a # Force a re-store
+    def __enter__(self):
+        return self
 
-    Or you can explicitly say that something changed:
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        else:
+            # Don't hide the exception that's already happening.
+            try:
+                self.close()
+            except Exception:
+                self.logger.error('Error in background write', exc_info=True)
 
-    >>> pd.changed('a')
-    >>> pd.changed() # re-writes everything that's in the cache.
-    
-    PickleDict actually supports any hashable item as a key, by
-    pickling then base64-encoding the key (prepending a `:`). If you
-    see a bunch of odd-looking files, that's where they came from.
+    @contextmanager
+    def transaction(self):
+        '''
+        Stages the values that this thread stores, and the keys it
+        deletes, inside the block, and publishes them all together when
+        it ends: a reader sees all of them or none of them, even if this
+        process dies part way through, and their files are synced to
+        disk as a group, rather than one at a time. If the block raises
+        an exception, none of them are published.
 
-    >>> pd[1,2,3] = 4,5,6
-    >>> pd[':abc'] = 'abc' # just to test...
-    >>> pd.clear_cache()
-    >>> ':abc' in pd.keys()
-    True
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd['a'] = 1
+        >>> with pd.transaction():
+        ...     pd['a'] = 2
+        ...     pd['b'] = 3
+        ...     pd['a'], PickleDict(pd.dir).keys()
+        (2, ['a'])
+        >>> other = PickleDict(pd.dir)
+        >>> other['a'], other['b']
+        (2, 3)
+        >>> try:
+        ...     with pd.transaction():
+        ...         del pd['a']
+        ...         raise ValueError
+        ... except ValueError:
+        ...     pass
+        >>> 'a' in pd
+        True
 
-    Subdirectories are also supported:
+        Other threads don't see the staged values either:
 
-    >>> subdir = pd.mkdir('sub')
-    >>> pd['sub'][7,8] = 9, 10
-    >>> subdir[7,8]
-    (9, 10)
+        >>> seen = []
+        >>> with pd.transaction():
+        ...     pd['a'] = 'staged'
+        ...     reader = threading.Thread(target=lambda: seen.append(pd['a']))
+        ...     reader.start(); reader.join()
+        >>> seen, pd['a']
+        ([2], 'staged')
 
-    And you can rename things:
+        To read several keys as of the same moment, read them inside
+        `snapshot`.
+        '''
+        if self._current_transaction() is not None:
+            raise RuntimeError("PickleDict transactions can't be nested")
+        self.flush()
+        txn = self._txn = Transaction(self)
+        try:
+            yield txn
+        except:
+            self._txn = None
+            self._abandon(txn)
+            raise
+        self._txn = None
+        try:
+            self._commit(txn)
+        except:
+            self._abandon(txn)
+            raise
+        self._end_staging(txn)
 
-    >>> pd.rename('sub', 'dir2')
-    >>> pd['dir2'][7, 8]
-    (9, 10)
+    def generations(self, prefetch=None, check_interval=1.0, workers=None):
+        '''
+        Versions of this PickleDict's values that can be swapped in as a
+        whole, while they're in use; see Generations.
+        '''
+        return Generations(self, prefetch, check_interval, workers)
 
-    ...and delete subdirectories also:
+    def snapshot(self):
+        '''
+        Returns a context manager that holds off the publishing of
+        transactions, by any process, while it's in effect, so that the
+        keys read inside it are all as of the same moment. (So don't
+        end a transaction inside it.)
+        '''
+        return file_lock(self._publish_lock_path(), shared=True)
 
-    >>> del pd['dir2']
-    >>> 'dir2' in pd
-    False
+    def _current_transaction(self):
+        txn = self._txn
+        if txn is not None and txn.thread is threading.currentThread():
+            return txn
+        return None
 
-    It can also lazily compute an expensive function only if the
-    result is not already pickled. (This replaces
-    get_picklecached_thing.)
+    def _stage(self, txn, key, val, compression):
+        size, meta, staged = self._stage_data(txn, key, val, compression)
+        self._unstage(txn, key)
+        txn.deletes.discard(key)
+        # Readers in this thread see it right away (see _staged); others
+        # go on seeing the cached value until it's published.
+        txn.writes[key] = (val, size, meta, staged)
 
-    >>> def thunk():
-    ...     print 'Expensive calculation...'
-    ...     return 42
-    ... 
-    >>> pd.get_lazy('the_answer', thunk)
-    Expensive calculation...
-    42
-    >>> pd.get_lazy('the_answer', thunk)
-    42
-    >>> 'the_answer' in pd
-    True
+    def _stage_delete(self, txn, key):
+        self._unstage(txn, key)
+        txn.deletes.add(key)
 
-    Metadata is stored in a _meta subdirectory, as pickled
-    dictionaries. One thing stored is the type of the object, so you
-    don't have to load it to see what type it is.
+    def _unstage(self, txn, key):
+        write = txn.writes.pop(key, None)
+        if write is not None:
+            self._drop_staged(txn, write[3])
 
-    >>> pd['_meta']['the_answer']['type'] == str(int)
-    True
+    def _stage_data(self, txn, key, val, compression):
+        '''
+        Write a value where it can be published from. Returns the size
+        and metadata, as _write_data does, and what was staged.
+        '''
+        filename = os.path.join(self._staging_dir(txn), str(txn.count))
+        txn.count += 1
+        size, meta = self._save(key, val, compression, filename, txn.group)
+        return size, meta, filename
 
-    There's a friendlier interface to getting metadata too:
+    def _drop_staged(self, txn, staged):
+        txn.group.discard(staged)
 
-    >>> pd.get_meta('the_answer', 'type') == str(int)
-    True
-    >>> pd.get_meta('the_answer', 'unknown_key', 'default value')
-    'default value'
-    >>> pd.set_meta('the_answer', 'unknown_key', 'known value')
-    >>> pd.get_meta('the_answer', 'unknown_key', 'default value')
-    'known value'
-    
-    '''
-    special_character = '+'
-    __slots__ = ['logger', 'log', 'dir', 'store_metadata', 'cache', 'extension', 'load_pickle', 'save_pickle']
-    
-    def __init__(self, dir, store_metadata=True, log=True, extension='', load_pickle=load_pickle, save_pickle=save_pickle):
-        self.logger = logging.getLogger('csc_utils.persist.PickleDict')
-        self.log = log
-        self.dir = os.path.abspath(os.path.expanduser(dir))
-        self.extension = extension
-        self.store_metadata = store_metadata
-        self.load_pickle = load_pickle
-        self.save_pickle = save_pickle
-        if not os.path.isdir(self.dir):
-            os.makedirs(self.dir)
-        self.clear_cache()
-        if store_metadata:
-            self['_meta']
-            self.cleanup_meta()
+    def _staging_dir(self, txn):
+        if txn.dir is None:
+            root = os.path.join(self.dir, TXN_DIRNAME)
+            if not os.path.isdir(root):
+                try:
+                    os.mkdir(root)
+                except OSError:
+                    if not os.path.isdir(root): raise
+            txn.dir = tempfile.mkdtemp(dir=root)
+            txn.lock_file = open(os.path.join(txn.dir, 'lock'), 'w')
+            if fcntl is not None:
+                fcntl.flock(txn.lock_file.fileno(), fcntl.LOCK_EX)
+        return txn.dir
 
-    def __repr__(self):
-        return 'PickleDict(%r)' % self.dir
+    def _publish_lock_path(self):
+        root = os.path.join(self.dir, TXN_DIRNAME)
+        if not os.path.isdir(root):
+            try:
+                os.mkdir(root)
+            except OSError:
+                if not os.path.isdir(root): raise
+        return os.path.join(root, PUBLISH_LOCK_FILENAME)
 
-    @property
-    def d(self): return ItemToAttrAdaptor(self)
+    def _commit(self, txn):
+        if not (txn.writes or txn.deletes): return
+        with file_lock(self._publish_lock_path()):
+            self._publish(txn)
+        for key, (val, size, meta, staged) in txn.writes.iteritems():
+            self._cache_written(key, val, size)
+        for key in txn.deletes:
+            self._uncache(key)
+        if self.quota is not None:
+            self.quota.note_write(sum(write[1] or 0 for write in txn.writes.itervalues()))
 
-    def path_for_key(self, key):
-        # FIXME: This method is hugely inefficient but for the moment necessary.
-        #
-        # Details: Pickles are not canonical. For example, the tuple
-        # ('BroadcastName',) pickles to both
-        # '\x80\x02U\rBroadcastName\x85q\x01.' and
-        # '\x80\x02U\rBroadcastNameq\x01\x85q\x02.'. Both were
-        # cPickle.dumps(key, -1). I think one was from Py2.5 and the
-        # other Py2.6, but I'm not sure. In any case, the only thing
-        # we can rely on is that _un_pickling produces __eq__ual
-        # results.
-        #
-        # The right way to solve this probably involves using the
-        # hash() as the key to a second collection.
-        if not isinstance(key, basestring) or key.startswith(self.special_character) or '/' in key:
-            for filename in os.listdir(self.dir):
-                if not filename.startswith(self.special_character): continue
-                if self.extension and filename.endswith(self.extension):
-                    filename = filename[:-len(self.extension)]
-                if self.key_for_path(filename) == key:
-                    key = filename
-                    break
+    def _publish(self, txn):
+        '''
+        Make the staged writes and deletions of `txn` take effect. The
+        staged files are synced, then a commit record saying what to
+        rename and remove, so that if we die part way through, the next
+        PickleDict to open the directory can finish the job.
+        '''
+        renames, removes = [], []
+        for key, (val, size, meta, staged) in txn.writes.iteritems():
+            path = self.path_for_key(key)
+            self._make_shard(path)
+            renames.append((staged, path + self.extension))
+        for key in txn.deletes:
+            path = self.path_for_key(key)
+            if os.path.isdir(path):
+                # A subdirectory goes in one rename, too: out of the way,
+                # into the staging directory, which is removed afterwards.
+                renames.append((path, os.path.join(self._staging_dir(txn), str(txn.count))))
+                txn.count += 1
             else:
-                # Didn't break out of the loop, so key wasn't found. Make a new one.
-                key = self.special_character+base64.urlsafe_b64encode(pickle.dumps(key, -1))
-        return os.path.join(self.dir, key)
+                removes.append(path + self.extension)
+        txn.group.commit()
+        record = dict(renames=[(self._relative(staged), self._relative(target)) for staged, target in renames],
+                      removes=[self._relative(target) for target in removes],
+                      deletes=list(txn.deletes), metas={})
+        if self.store_metadata:
+            record['metas'] = dict((key, write[2]) for key, write in txn.writes.iteritems())
+        commit = os.path.join(self._staging_dir(txn), 'commit')
+        write_to_file_atomically(commit, pickle.dumps(record, -1), durability='file')
+        # That was the moment of commitment; now carry it out.
+        self._apply_commit(record)
+        os.remove(commit)
+        fsync_dir(txn.dir)
+        for key in txn.writes:
+            self._register_key(key, self.path_for_key(key))
+        for key in txn.deletes:
+            self._unregister_key(key, self.path_for_key(key))
 
-    def key_for_path(self, path):
-        if self.extension and path.endswith(self.extension):
-            path = path[:-len(self.extension)]
-        if path.startswith(self.special_character):
-            return pickle.loads(base64.urlsafe_b64decode(path[1:]))
-        return path
+    def _relative(self, path):
+        return os.path.relpath(path, self.dir)
 
-    def clear_cache(self):
-        self.cache = {}
+    def _apply_commit(self, record):
+        '''
+        Carry out a commit record. Parts of it may have been done already.
+        '''
+        dirs = set()
+        for staged, target in record['renames']:
+            staged, target = os.path.join(self.dir, staged), os.path.join(self.dir, target)
+            if os.path.exists(staged):
+                os.rename(staged, target)
+            dirs.add(os.path.dirname(target))
+        for target in record['removes']:
+            target = os.path.join(self.dir, target)
+            if os.path.exists(target):
+                os.remove(target)
+            dirs.add(os.path.dirname(target))
+        for dir in dirs:
+            fsync_dir(dir)
+        if self.store_metadata:
+            self._write_meta(record['metas'])
+            for key in record['deletes']:
+                self._metadata.discard(key)
 
-    def _load(self, key):
+    def _abandon(self, txn):
+        txn.group.abort()
+        self._end_staging(txn)
+
+    def _end_staging(self, txn):
+        if txn.dir is not None:
+            if not os.path.exists(os.path.join(txn.dir, 'commit')):
+                shutil.rmtree(txn.dir, ignore_errors=True)
+            # Otherwise it failed part way through publishing, and the
+            # next PickleDict to open the directory finishes it.
+            txn.lock_file.close()
+            txn.dir = txn.lock_file = None
+
+    def _recover_transactions(self):
         '''
-        Just load some data, bypassing the cache.
+        Finish publishing transactions whose processes died part way
+        through, and throw away ones that never got that far.
         '''
-        path = self.path_for_key(key)
-        if self.store_metadata and key == '_meta':
-            return MetaPickleDict(path)
+        root = os.path.join(self.dir, TXN_DIRNAME)
+        if fcntl is None or not os.path.isdir(root): return
+        for name in list(iter_dir(root)):
+            staging = os.path.join(root, name)
+            if not os.path.isdir(staging): continue
+            try:
+                lock_file = open(os.path.join(staging, 'lock'), 'r')
+            except IOError:
+                continue
+            try:
+                try:
+                    fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except (IOError, OSError):
+                    continue # Still in use.
+                commit = os.path.join(staging, 'commit')
+                if os.path.exists(commit):
+                    with file_lock(self._publish_lock_path()):
+                        if os.path.exists(commit):
+                            self.logger.warn('Finishing an interrupted transaction in %s', self.dir)
+                            f = open(commit, 'rb')
+                            try:
+                                record = pickle.load(f)
+                            finally:
+                                f.close()
+                            self._apply_commit(record)
+                            os.remove(commit)
+                elif time.time() - os.path.getmtime(staging) < STALE_STAGING_AGE:
+                    continue
+                shutil.rmtree(staging, ignore_errors=True)
+            finally:
+                lock_file.close()
 
-        if os.path.isdir(path):
-            # Keep sub-PickleDict objects in cache, so that they
-            # can cache their own data.
-            return PickleDict(path, store_metadata=self.store_metadata,
-                              extension=self.extension,
-                              load_pickle=self.load_pickle,
-                              save_pickle=self.save_pickle)
-        # Otherwise, expect an actual pickle object, so use the extension.
-        path = path + self.extension
-        if not os.path.exists(path):
-            raise KeyError(key)
-        if self.log: self.logger.info('Loading %r...', key)
-        data = self.load_pickle(path)
-        if self.log: self.logger.info('Loaded %r (%s).', key, type(data))
-        return data
-        
-        
-    def __getitem__(self, key):
-        if key in self.cache:
-            return self.cache[key]
+    def __delitem__(self, key):
+        txn = self._current_transaction()
+        if txn is not None:
+            if key not in self: raise KeyError(key)
+            self._stage_delete(txn, key)
+            return
+        if self.writer is not None:
+            # Wait for a write of this key that's already started, and
+            # cancel one that hasn't.
+            with self.writer.key_lock((self.dir, key)):
+                with self.writer.lock:
+                    pending = self._pending.pop(key, None)
+                    if pending is not None:
+                        self._uncache(key)
+                if pending is not None and not self._on_disk(key):
+                    return
+                self._delete(key)
         else:
-            data = self._load(key)
-            if not isinstance(data, MetaPickleDict): self.cache[key] = data
-            return data
-    
-    def __setitem__(self, key, val):
-        if self.log: self.logger.info('Saving %r... (%s)', key, type(val))
-        self.cache[key] = val
-        size = self.save_pickle(val, self.path_for_key(key) + self.extension)
-        if self.log:
-            if isinstance(size, int):
-                self.logger.info('Saved %r (%s)', key, human_readable_size(size))
-            else:
-                self.logger.info('Saved %r', key)
+            self._delete(key)
 
+    def _delete(self, key):
+        self._remove_stored(key)
+        self._uncache(key)
         if self.store_metadata:
-            meta = {}
-            meta['type'] = str(type(val))
-            self['_meta'][key] = meta
+            self._metadata.discard(key)
 
-    def __delitem__(self, key):
+    def _remove_stored(self, key):
         path = self.path_for_key(key)
         if os.path.isdir(path):
             self[key]._clear()
@@ -342,32 +3494,86 @@ class PickleDict(object, DictMixin):
                 os.rmdir(path)
         else:
             os.remove(path + self.extension)
-        self.cache.pop(key, None) # don't fail if it's not cached.
+            if self._journaled(key):
+                self._journal(key).remove()
+        self._unregister_key(key, path)
         
     def _clear(self):
         '''
         Clear everything in the directory.
         '''
-        for key in self:
+        self.flush()
+        for key in self.keys():
             del self[key]
-        if '_meta' in self:
-            del self['_meta']
+        if self.store_metadata:
+            self._metadata.destroy()
+        self._key_index.destroy()
+        self._listings.clear()
+        if self._shard_width:
+            self._remove_shards()
+        locks = os.path.join(self.dir, LOCKS_DIRNAME)
+        if os.path.isdir(locks):
+            os.rmdir(locks)
+        shutil.rmtree(os.path.join(self.dir, TXN_DIRNAME), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.dir, JOURNALS_DIRNAME), ignore_errors=True)
+        shutil.rmtree(os.path.join(self.dir, GENERATIONS_DIRNAME), ignore_errors=True)
+
+    def _remove_shards(self):
+        shards = os.path.join(self.dir, SHARDS_DIRNAME)
+        if os.path.isdir(shards):
+            for shard in list(iter_dir(shards)):
+                os.rmdir(os.path.join(shards, shard))
+            os.rmdir(shards)
+        layout = os.path.join(self.dir, LAYOUT_FILENAME)
+        if os.path.exists(layout):
+            os.remove(layout)
     
     def clear(self):
         raise NotImplementedError("`clear`? Do you really mean that? If so, run _clear instead.")
     
     def changed(self, name=None, ignore_not_present=False):
+        '''
+        Rewrites the value of `name`, or of every cached key, after it
+        has been changed in place. Returns the keys that were written.
+
+        If the PickleDict was opened with `track_changes`, a fingerprint
+        of each value is taken when it's loaded or stored, and
+        `changed()` only rewrites the values that no longer match
+        theirs:
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False, track_changes=True)
+        >>> pd['a'] = [1, 2]
+        >>> pd['b'] = [3]
+        >>> pd['a'].append(3)
+        >>> pd.changed()
+        ['a']
+        >>> pd.changed()
+        []
+        >>> PickleDict(pd.dir)['a']
+        [1, 2, 3]
+        '''
         if name is None:
-            for k, v in self.cache.iteritems():
-                if not isinstance(v, PickleDict):
-                    self[k] = v
+            written = []
+            for k, v in self.cache.items():
+                if isinstance(v, (PickleDict, ChunkedFile)): continue
+                if self.track_changes and self._fingerprints.get(k) == fingerprint(v): continue
+                self[k] = v
+                written.append(k)
+            if self.log: self.logger.info('changed: rewrote %d values', len(written))
+            return written
         else:
             if name not in self.cache and not ignore_not_present:
                 raise KeyError('%s was not cached (so it could not have been changed in memory).' % name)
             self[name] = self.cache[name]
+            return [name]
         
     def mkdir(self, name):
-        os.mkdir(self.path_for_key(name))
+        self._check_key(name)
+        path = self.path_for_key(name)
+        self._make_shard(path)
+        os.mkdir(path)
+        self._register_key(name, path)
         return self[name]
 
     def subdir(self, name):
@@ -377,23 +3583,100 @@ class PickleDict(object, DictMixin):
         return self[name]
 
     def rename(self, old, new):
+        self._check_key(new)
+        self.flush()
+        self._rename_stored(old, new)
+        if old in self.cache:
+            if not isinstance(self.cache.get(old), (PickleDict, ChunkedFile)):
+                self._cache_written(new, self.cache.get(old))
+            self._uncache(old)
+        if self.store_metadata and old in self._metadata:
+            self._metadata.rename(old, new)
+
+    def _rename_stored(self, old, new):
         old_path = self.path_for_key(old)
         new_path = self.path_for_key(new)
-        if not os.path.isdir(old_path):
-            old_path = old_path + self.extension
-            new_path = new_path + self.extension
-        os.rename(old_path, new_path)
+        self._make_shard(new_path)
+        if os.path.isdir(old_path):
+            os.rename(old_path, new_path)
+        else:
+            journaled = self._journaled(old)
+            old_journal = self._journal(old)
+            os.rename(old_path + self.extension, new_path + self.extension)
+            if journaled and os.path.exists(old_journal.path):
+                os.rename(old_journal.path, self._journal(new).path)
+        self._unregister_key(old, old_path)
+        self._register_key(new, new_path)
 
-        if old in self.cache:
-            if not isinstance(self.cache[old], PickleDict):
-                self.cache[new] = self.cache[old]
-            del self.cache[old]
-        if '_meta' in self and old in self['_meta']:
-            self['_meta'].rename(old, new)
+    def __iter__(self):
+        pending = set(self._pending)
+        deleted = ()
+        txn = self._current_transaction()
+        if txn is not None:
+            pending.update(txn.writes)
+            deleted = txn.deletes
+        for key in self._iter_stored():
+            if key in deleted: continue
+            pending.discard(key)
+            yield key
+        # Values that haven't been written yet.
+        for key in pending:
+            yield key
 
+    def _iter_stored(self):
+        for dir in self._listing_dirs():
+            for key in self._dir_keys(dir):
+                yield key
 
-    def __iter__(self):
-        return (self.key_for_path(filename) for filename in os.listdir(self.dir) if filename != '_meta')
+    def _listing_dirs(self):
+        '''
+        The directories that values are stored in: this one, or its
+        shards.
+        '''
+        if not self._shard_width or self._migrating:
+            yield self.dir
+        if self._shard_width:
+            shards = os.path.join(self.dir, SHARDS_DIRNAME)
+            if not os.path.isdir(shards): return
+            for shard in iter_dir(shards):
+                yield os.path.join(shards, shard)
+
+    def _dir_keys(self, dir):
+        '''
+        The keys stored in `dir`. The list is kept until the directory's
+        mtime changes or we change the directory ourselves.
+        '''
+        try:
+            mtime = os.stat(dir).st_mtime
+        except OSError:
+            return []
+        listing = self._listings.get(dir)
+        if listing is not None and listing[0] == mtime:
+            return listing[1]
+        started = time.time()
+        keys = [self.key_for_path(filename) for filename in iter_dir(dir)
+                if filename not in self.internal_names]
+        # A change made in the same tick of the clock as the mtime we saw
+        # wouldn't change it, so only trust an mtime that's in the past.
+        if mtime < started - 1:
+            self._listings[dir] = (mtime, keys)
+        return keys
+
+    def _list_names(self):
+        '''
+        Yields the names of the files (and subdirectories) that hold
+        values, a directory at a time, without listing them all first.
+        '''
+        if not self._shard_width or self._migrating:
+            for filename in iter_dir(self.dir):
+                if filename not in self.internal_names:
+                    yield filename
+        if self._shard_width:
+            shards = os.path.join(self.dir, SHARDS_DIRNAME)
+            if not os.path.isdir(shards): return
+            for shard in iter_dir(shards):
+                for filename in iter_dir(os.path.join(shards, shard)):
+                    yield filename
 
     def keys(self):
         return list(self.__iter__())
@@ -403,50 +3686,233 @@ class PickleDict(object, DictMixin):
             return False # Otherwise would match the directory itself.
         if self.store_metadata and key == '_meta':
             return True
-        path = self.path_for_key(key)
-        return os.path.exists(path) or os.path.exists(path+self.extension)
+        if key in self._pending:
+            return True
+        txn = self._current_transaction()
+        if txn is not None:
+            if key in txn.writes: return True
+            if key in txn.deletes: return False
+        return self._on_disk(key)
 
-    def get_meta(self, key, meta_key, default_value=None):
+    def _on_disk(self, key):
+        return self._exists(self.path_for_key(key))
+
+    def _disk_entries(self):
+        '''
+        Yields (time last used, size, PickleDict, key) for every value
+        stored here and in subdirectories, for DiskQuota to sweep.
+        '''
+        for key in list(self._iter_stored()):
+            if os.path.isdir(self.path_for_key(key)):
+                for entry in self[key]._disk_entries():
+                    yield entry
+                continue
+            stat = self._stored_stat(key)
+            if stat is None: continue # gone already
+            size, mtime = stat
+            atime = self.get_meta(key, 'atime')
+            yield (mtime if atime is None else atime), size, self, key
+
+    def _stored_stat(self, key):
+        '''
+        The size and modification time of the stored value of `key`, or
+        None if it isn't stored.
+        '''
         try:
-            return self['_meta'][key][meta_key]
-        except KeyError:
+            st = os.stat(self.path_for_key(key) + self.extension)
+        except OSError:
+            return None
+        return st.st_size, st.st_mtime
+
+    def _evict(self, key):
+        '''
+        Remove the value of `key` to make room, unless it's being
+        written or computed right now. Returns whether it was removed.
+
+        Readers that already have the file open can go on reading it
+        (or using its memory map); a `get_lazy` of it computes it again.
+        '''
+        if key in self._pending: return False
+        txn = self._txn
+        if txn is not None and key in txn.writes: return False
+        with self._compute_lock(key, blocking=False) as locked:
+            if not locked: return False
+            try:
+                self._remove_stored(key)
+            except (OSError, KeyError):
+                return False # Someone else got there first.
+            self._uncache(key)
+            if self.store_metadata:
+                self._metadata.discard(key)
+        if self.log: self.logger.info('Evicted %r', key)
+        return True
+
+    def migrate_to_sharded(self, width=2):
+        '''
+        Converts the directory, and its subdirectories, from the flat
+        layout to the sharded one, in place, a file at a time. Values
+        can still be read meanwhile by PickleDicts opened after it
+        starts, and if it's interrupted, running it again finishes the
+        job. Nothing else should write to the directory while it runs,
+        and PickleDicts that were already open should be reopened.
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> pd.update(('n%d' % i, i) for i in range(50))
+        >>> pd.mkdir('sub')['x'] = 1
+        >>> pd.migrate_to_sharded()
+        >>> sorted(os.listdir(pd.dir))
+        ['_layout', '_metalog', '_shards']
+        >>> pd = PickleDict(pd.dir)
+        >>> len(pd), pd['n7'], pd['sub']['x']
+        (51, 7, 1)
+        >>> pd['sub'].path_for_key('x') == os.path.join(pd['sub'].dir, '_shards', shard_for_name('x', 2), 'x')
+        True
+        '''
+        self.flush()
+        # Cached subdirectories are about to move.
+        self.clear_cache()
+        current, migrating = read_layout(self.dir)
+        if current and not migrating: return
+        width = current or width
+        write_layout(self.dir, width, migrating=True)
+        self._shard_width, self._migrating = width, True
+        self._key_index = self._make_key_index()
+        self._listings.clear()
+        moved = True
+        while moved:
+            # Entries removed during a listing may confuse it; go round
+            # again until there's nothing left to move.
+            moved = False
+            for filename in iter_dir(self.dir):
+                if filename in self.internal_names: continue
+                name = filename
+                if self.extension and name.endswith(self.extension):
+                    name = name[:-len(self.extension)]
+                target = os.path.join(self.dir, SHARDS_DIRNAME, shard_for_name(name, width), filename)
+                self._make_shard(target)
+                os.rename(os.path.join(self.dir, filename), target)
+                moved = True
+        self._migrating = False
+        options = dict(self._options(), sharded=False)
+        for key in self._iter_stored():
+            path = self.path_for_key(key)
+            if os.path.isdir(path):
+                type(self)(path, **options).migrate_to_sharded(width)
+        write_layout(self.dir, width)
+
+    def get_meta(self, key, meta_key, default_value=None):
+        if self.writer is not None:
+            with self.writer.lock:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    if meta_key == 'type' and meta_key not in pending[3]:
+                        return str(type(pending[1]))
+                    return pending[3].get(meta_key, default_value)
+        if not self.store_metadata:
             return default_value
+        return self._metadata.get_field(key, meta_key, default_value)
 
     def set_meta(self, key, meta_key, value):
         if not self.store_metadata: return
-        meta = self['_meta']
-        meta_for_key = meta.get(key, {})
-        meta_for_key[meta_key] = value
-        meta[key] = meta_for_key
+        if self.writer is not None:
+            with self.writer.lock:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    # It'll be written along with the value.
+                    pending[3][meta_key] = value
+                    return
+        self._metadata.set_field(key, meta_key, value)
         
     def cleanup_meta(self):
-        meta = self['_meta']
+        '''
+        Drop the metadata of keys that are no longer stored (because
+        their files were removed behind our back), and compact the log.
+        '''
+        if not self.store_metadata: return
         keys = set(self.iterkeys())
-        for m in meta.keys():
-            if m not in keys:
-                self.logger.info('Removing orphan metadata for %r' % m)
-                del meta[m]
+        orphans = [m for m in self._metadata.keys() if m not in keys]
+        for m in orphans:
+            self.logger.info('Removing orphan metadata for %r' % m)
+        self._metadata.compact(keep=keys)
 
     # this is the replacement for get_picklecached_thing:
     def get_lazy(self, key, thunk, version=None):
+        '''
+        Returns the value of `key`, if it's stored with this `version`;
+        otherwise calls `thunk` and stores what it returns. Only one
+        process (or thread) computes a key at a time; the others wait
+        for it, then load what it stored.
+
+        >>> import tempfile
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> calls = []
+        >>> def slow():
+        ...     calls.append(1)
+        ...     time.sleep(0.2)
+        ...     return 42
+        >>> threads = [threading.Thread(target=pd.get_lazy, args=('answer', slow)) for i in range(4)]
+        >>> for t in threads: t.start()
+        >>> for t in threads: t.join()
+        >>> len(calls), pd['answer']
+        (1, 42)
+        '''
         if version is not None and not self.store_metadata:
             raise ValueError("Can't store version if we're not storing metadata.")
         if version is None: version = 0
-        
+        found = self._get_stored(key, version)
+        if found is not _missing:
+            return found
+        with self._compute_lock(key):
+            # Someone else may have computed it while we waited.
+            self._uncache(key)
+            found = self._get_stored(key, version)
+            if found is not _missing:
+                return found
+            if self.log: self.logger.info('get_lazy: computing %r.' % (key,))
+            return self._compute(key, thunk, version)
+
+    def _get_stored(self, key, version):
+        '''
+        Returns the value of `key` if it's stored with this `version`,
+        otherwise _missing.
+        '''
+        if self.store_metadata:
+            # Another process may have computed it since we last looked.
+            self._metadata.refresh()
         if key in self and self.get_meta(key, 'version', 0) == version:
-            #logging.info('get_lazy: found %r.' % (key,))
             try:
                 return self[key]
             except:
                 if self.log: self.logger.warn("Error loading %r; recomputing.", key)
+        return _missing
 
-        if self.log: self.logger.info('get_lazy: computing %r.' % (key,))
-        return self._compute(key, thunk, version)
+    def _compute_lock(self, key, blocking=True):
+        '''
+        A lock, shared with other processes, to hold while computing the
+        value of `key` (see csc_utils.io.exclusive_lock).
+        '''
+        locks = os.path.join(self.dir, LOCKS_DIRNAME)
+        if not os.path.isdir(locks):
+            try:
+                os.mkdir(locks)
+            except OSError:
+                if not os.path.isdir(locks): raise
+        def on_wait(holder):
+            if self.log: self.logger.info('Waiting for %s to compute %r...', holder, key)
+        name = os.path.basename(self.path_for_key(key))
+        return exclusive_lock(os.path.join(locks, name + '.lock'), on_wait, blocking)
 
     def _compute(self, key, thunk, version):
+        start = time.time()
         result = thunk()
+        if self.stats is not None:
+            self.stats.add(self.dir, key, compute_time=time.time() - start)
         self[key] = result
         self.set_meta(key, 'version', version if version is not None else 0)
+        if self.writer is not None:
+            # Whoever is waiting for it will look on disk.
+            self.flush()
         return self[key]
 
     def lazy(self, name=None, version=None):
@@ -507,7 +3973,8 @@ class PickleDict(object, DictMixin):
                 return self.get_lazy(key, thunk, version)
             
             def recalculate():
-                return self._compute(key, thunk, version)
+                with self._compute_lock(key):
+                    return self._compute(key, thunk, version)
             recalculate.__doc__ = 'Unconditionally recalculates %s, and stores and returns the result.' % key
             f.recalculate = recalculate
             f.func = thunk
@@ -515,6 +3982,58 @@ class PickleDict(object, DictMixin):
             return f
         return dec
 
+    def memoize(self, name=None, version=None):
+        '''
+        Like `lazy`, but for functions with arguments. Each call's result
+        is stored in the subdirectory `name` (the function's name, by
+        default) under the `argument_hash` of its arguments, and loaded
+        from there, rather than computed, next time, in this process or
+        any other. If `version` is 'source', it's the `source_version`
+        of the function, so changing the function forgets its results.
+
+        >>> import tempfile, numpy
+        >>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+        >>> @pd.memoize(version='source')
+        ... def norm(vec, scale=1):
+        ...     print 'Computing...'
+        ...     return float(numpy.sqrt((vec ** 2).sum())) * scale
+        >>> norm(numpy.array([3.0, 4.0]))
+        Computing...
+        5.0
+        >>> norm(numpy.array([3.0, 4.0]))
+        5.0
+        >>> norm(numpy.array([3.0, 4.0]), scale=2)
+        Computing...
+        10.0
+        >>> len(pd['norm'])
+        2
+        '''
+        from functools import wraps
+        def dec(func):
+            key = name or func.__name__
+            func_version = source_version(func) if version == 'source' else version
+
+            def arg_key(args, kwargs):
+                return argument_hash((args, kwargs))
+
+            @wraps(func)
+            def f(*args, **kwargs):
+                return self.subdir(key).get_lazy(arg_key(args, kwargs), lambda: func(*args, **kwargs),
+                                                 func_version)
+
+            def recalculate(*args, **kwargs):
+                results = self.subdir(key)
+                arg = arg_key(args, kwargs)
+                with results._compute_lock(arg):
+                    return results._compute(arg, lambda: func(*args, **kwargs), func_version)
+            recalculate.__doc__ = 'Unconditionally recalculates %s for the given arguments.' % key
+            f.recalculate = recalculate
+            f.func = func
+            f.key = key
+            f.version = func_version
+            return f
+        return dec
+
     def lazy_dir(self, name=None):
         from functools import wraps
         def dec(thunk):
@@ -546,6 +4065,10 @@ class PickleDict(object, DictMixin):
         return thunk
 
 class MetaPickleDict(PickleDict):
+    '''
+    How metadata used to be stored: a PickleDict in the _meta
+    subdirectory. MetaLog still reads it, to migrate it.
+    '''
     def __init__(self, dir):
         super(MetaPickleDict, self).__init__(dir, store_metadata=False, log=False)
         
@@ -0,0 +1,213 @@
+'''
+Codecs: the ways a PickleDict can write a value to a file, other than
+pickling it.
+
+cPickle is general but slow. A value made only of plain Python types
+(strings, numbers, lists, tuples, dicts and sets of them) loads several
+times faster with `marshal`, and an `array.array` is just its raw
+buffer. When a value is stored, the first codec in CODECS that accepts
+it is used, and its name goes in the value's metadata, so that loading
+it goes straight to the same codec. Anything no codec accepts is
+pickled as before.
+
+A codec for another type is a Codec subclass, put in CODECS with
+`register_codec` (divisi2's SparseMatrix might be written as its
+component arrays and labels, say):
+
+>>> class Point(object):
+...     def __init__(self, x, y): self.x, self.y = x, y
+>>> class PointCodec(Codec):
+...     name = 'point'
+...     magic = 'POINT1\\n'
+...     def accepts(self, val): return isinstance(val, Point)
+...     def dumps(self, val): return '%r %r' % (val.x, val.y)
+...     def loads(self, data): return Point(*map(float, data.split()))
+>>> codec = register_codec(PointCodec())
+>>> import tempfile
+>>> from csc_utils.persist import PickleDict
+>>> pd = PickleDict(tempfile.mkdtemp(), log=False)
+>>> pd['p'] = Point(1, 2)
+>>> pd['numbers'] = {'a': [1, 2.5, None], 'b': (u'c', set([3]))}
+>>> pd.get_meta('p', 'codec'), pd.get_meta('numbers', 'codec')
+('point', 'marshal')
+>>> pd.clear_cache()
+>>> pd['p'].y, pd['numbers']['b']
+(2.0, (u'c', set([3])))
+>>> CODECS.remove(codec)
+'''
+from __future__ import with_statement
+import os
+import sys
+import array
+import marshal
+from csc_utils.io import open_for_atomic_overwrite, open_compressed, SyncGroup
+
+class Codec(object):
+    '''
+    A way of writing values to a file and reading them back. A subclass
+    gives its `name` (which is stored in the metadata), says which
+    values it `accepts`, and either encodes them as a string (`dumps`
+    and `loads`, which get a file that starts with its `magic`, so that
+    it can be recognized without metadata) or overrides `save` and
+    `load` to deal with the file itself.
+    '''
+    name = None
+    magic = None
+    # Can its files be compressed as a whole?
+    compressible = True
+    # Is it raw array data, to be memory-mapped? (Not used if a
+    # PickleDict's store_arrays is off.)
+    raw = False
+
+    def __repr__(self):
+        return '<%s %r>' % (type(self).__name__, self.name)
+
+    def accepts(self, val):
+        return False
+
+    def dumps(self, val):
+        raise NotImplementedError
+
+    def loads(self, data):
+        raise NotImplementedError
+
+    def save(self, val, filename, compression=None, durability=None):
+        '''
+        Atomically writes `val` to `filename`. Returns the size of the
+        file.
+        '''
+        data = self.dumps(val)
+        with open_for_atomic_overwrite(filename, compression=compression, durability=durability,
+                                       size_hint=len(data)) as f:
+            f.write(self.magic)
+            f.write(data)
+        if isinstance(durability, SyncGroup):
+            return durability.getsize(filename)
+        return os.path.getsize(filename)
+
+    def load(self, filename, compression=None, mmap_mode=None):
+        f = open_compressed(filename, compression or 'none')
+        try:
+            if f.read(len(self.magic)) != self.magic:
+                raise ValueError("%s wasn't written by the %s codec" % (filename, self.name))
+            data = f.read()
+        finally:
+            f.close()
+        return self.loads(data)
+
+
+PLAIN_SCALARS = frozenset([type(None), bool, int, long, float, complex, str, unicode])
+PLAIN_CONTAINERS = frozenset([list, tuple, set, frozenset])
+# The containers whose identity matters, because they can be changed.
+MUTABLE_CONTAINERS = frozenset([list, dict, set])
+# How deeply nested a plain value can be (well short of marshal's own
+# limit).
+MAX_PLAIN_DEPTH = 500
+
+def is_plain(val):
+    '''
+    Is `val` made only of plain Python types, which marshal can write
+    without losing anything? (Subclasses, such as numpy's scalar types,
+    aren't plain: marshal would turn them into their base types.) Nor is
+    a value that holds the same list, dict or set twice, or itself,
+    which marshal would write as separate copies, or one nested more
+    than MAX_PLAIN_DEPTH deep.
+
+    >>> is_plain({'a': [1, 2.5, (None, u'b')]})
+    True
+    >>> import numpy
+    >>> is_plain([1, numpy.float64(2)])
+    False
+    >>> shared = [1]
+    >>> is_plain([shared, shared])
+    False
+    >>> looped = []; looped.append(looped)
+    >>> is_plain(looped)
+    False
+    '''
+    seen = set()
+    stack = [(val, 0)]
+    while stack:
+        val, depth = stack.pop()
+        t = type(val)
+        if t in PLAIN_SCALARS:
+            continue
+        if depth >= MAX_PLAIN_DEPTH:
+            return False
+        if t in MUTABLE_CONTAINERS:
+            if id(val) in seen:
+                return False
+            seen.add(id(val))
+        if t is dict:
+            items = val.keys() + val.values()
+        elif t in PLAIN_CONTAINERS:
+            items = val
+        else:
+            return False
+        # The common case, a container of scalars, is checked in C.
+        if set(map(type, items)) <= PLAIN_SCALARS:
+            continue
+        stack.extend((item, depth + 1) for item in items)
+    return True
+
+class MarshalCodec(Codec):
+    '''
+    Plain structures of strings and numbers, with `marshal`.
+    '''
+    name = 'marshal'
+    magic = 'PDMRSH1\n'
+
+    def accepts(self, val):
+        return (type(val) in PLAIN_CONTAINERS or type(val) is dict) and is_plain(val)
+
+    def dumps(self, val):
+        return marshal.dumps(val, 2)
+
+    def loads(self, data):
+        return marshal.loads(data)
+
+class ArrayCodec(Codec):
+    '''
+    `array.array`s, as their type code, byte order and raw buffer.
+    '''
+    name = 'array'
+    magic = 'PDARRY1\n'
+    byteorder = '<' if sys.byteorder == 'little' else '>'
+
+    def accepts(self, val):
+        return type(val) is array.array
+
+    def dumps(self, val):
+        return val.typecode + self.byteorder + val.tostring()
+
+    def loads(self, data):
+        arr = array.array(data[0])
+        arr.fromstring(data[2:])
+        if data[1] != self.byteorder:
+            arr.byteswap()
+        return arr
+
+
+# The codecs that PickleDicts try, in order. (csc_utils.persist adds
+# the ones for numpy arrays and scipy.sparse matrices.)
+CODECS = [ArrayCodec(), MarshalCodec()]
+
+def register_codec(codec, first=True):
+    '''
+    Adds a Codec to CODECS: first, so that it's tried before the others,
+    unless `first` is False. Returns the codec.
+    '''
+    if first:
+        CODECS.insert(0, codec)
+    else:
+        CODECS.append(codec)
+    return codec
+
+def codec_named(name, codecs=None):
+    '''
+    Finds a codec by name, in `codecs` or else in CODECS.
+    '''
+    for codec in list(codecs or ()) + CODECS:
+        if codec.name == name:
+            return codec
+    raise ValueError("Unknown codec: %r" % (name,))
@@ -0,0 +1,391 @@
+'''
+A PickleDict backend that keeps its values in a SQLite database.
+
+Like PackedPickleDict, this is for directories of many small values,
+where a file per key is wasteful. The values (and their metadata) are
+rows in a single database in the directory, written in WAL mode so that
+readers in other processes aren't blocked by a writer, and `set_many`
+writes its whole batch in one transaction.
+
+Open one with `PickleDict(dir, backend='sqlite')`, or directly.
+'''
+from __future__ import with_statement
+import os
+import time
+import zlib
+import threading
+import logging
+import pickletools
+import sqlite3
+import cPickle as pickle
+from csc_utils.io import compressor, decompressor, sniff_compression_of
+from csc_utils.persist import PickleDict
+LOG = logging.getLogger(__name__)
+
+def encode_key(key):
+    '''
+    The bytes that `key` is stored under. Pickles aren't canonical (see
+    PickleDict.path_for_key), but the difference is in memo opcodes that
+    pickletools.optimize takes out.
+
+    >>> encode_key(('BroadcastName',)) == encode_key(pickle.loads('\\x80\\x02U\\rBroadcastNameq\\x01\\x85q\\x02.'))
+    True
+    '''
+    return sqlite3.Binary(pickletools.optimize(pickle.dumps(key, 2)))
+
+def decode_key(data):
+    return pickle.loads(str(data))
+
+
+class SqliteDatabase(object):
+    '''
+    A SQLite database file, with a connection for each thread that uses
+    it (sqlite3 connections can't be shared between threads).
+    '''
+    schema = ['CREATE TABLE IF NOT EXISTS pickle_values (key BLOB PRIMARY KEY, value BLOB NOT NULL, crc INTEGER NOT NULL)',
+              'CREATE TABLE IF NOT EXISTS pickle_meta (key BLOB PRIMARY KEY, meta BLOB NOT NULL)']
+
+    def __init__(self, path, timeout=60, synchronous='NORMAL'):
+        self.path = path
+        self.timeout = timeout
+        self.synchronous = synchronous
+        self.local = threading.local()
+
+    def __repr__(self):
+        return 'SqliteDatabase(%r)' % self.path
+
+    def connection(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=self.timeout)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=%s' % self.synchronous)
+            with conn:
+                for statement in self.schema:
+                    conn.execute(statement)
+            self.local.conn = conn
+        return conn
+
+    def execute(self, sql, args=()):
+        '''
+        Runs one statement and returns all the rows it produced,
+        committing if it changed anything.
+        '''
+        conn = self.connection()
+        with conn:
+            return conn.execute(sql, args).fetchall()
+
+    def close(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self.local.conn = None
+
+    def destroy(self):
+        '''
+        Removes the database. Only this thread's connection is closed;
+        don't use it from other threads afterwards.
+        '''
+        self.close()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.path + suffix):
+                os.remove(self.path + suffix)
+
+
+class SqliteMeta(object):
+    '''
+    The metadata of a SqlitePickleDict, in the pickle_meta table of its
+    database. It has the same interface as MetaLog; `update` can take
+    part in a transaction that's already open.
+    '''
+    def __init__(self, db):
+        self.db = db
+
+    def __repr__(self):
+        return 'SqliteMeta(%r)' % self.db.path
+
+    def refresh(self):
+        pass # Every lookup reads the database.
+
+    def compact(self, keep=None):
+        '''
+        Drop the metadata of keys that aren't in `keep`.
+        '''
+        if keep is None: return
+        for key in self.keys():
+            if key not in keep:
+                self.discard(key)
+
+    def destroy(self):
+        if os.path.exists(self.db.path):
+            self.db.execute('DELETE FROM pickle_meta')
+
+    def __getitem__(self, key):
+        rows = self.db.execute('SELECT meta FROM pickle_meta WHERE key = ?', (encode_key(key),))
+        if not rows: raise KeyError(key)
+        return pickle.loads(str(rows[0][0]))
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def get_field(self, key, meta_key, default=None):
+        return self.get(key, {}).get(meta_key, default)
+
+    def __setitem__(self, key, meta):
+        self.update({key: meta})
+
+    def update(self, metas, conn=None):
+        rows = [(encode_key(key), sqlite3.Binary(pickle.dumps(dict(meta), -1)))
+                for key, meta in metas.iteritems()]
+        if conn is None:
+            conn = self.db.connection()
+            with conn:
+                conn.executemany('INSERT OR REPLACE INTO pickle_meta VALUES (?, ?)', rows)
+        else:
+            conn.executemany('INSERT OR REPLACE INTO pickle_meta VALUES (?, ?)', rows)
+
+    def set_field(self, key, meta_key, value):
+        conn = self.db.connection()
+        with conn:
+            # Take the write lock before reading, so that no one else's
+            # change to the same metadata is lost.
+            conn.execute('UPDATE pickle_meta SET meta = meta WHERE key = ?', (encode_key(key),))
+            rows = conn.execute('SELECT meta FROM pickle_meta WHERE key = ?', (encode_key(key),)).fetchall()
+            meta = pickle.loads(str(rows[0][0])) if rows else {}
+            meta[meta_key] = value
+            self.update({key: meta}, conn)
+
+    def __delitem__(self, key):
+        if key not in self: raise KeyError(key)
+        self.discard(key)
+
+    def discard(self, key):
+        self.db.execute('DELETE FROM pickle_meta WHERE key = ?', (encode_key(key),))
+
+    def rename(self, old, new):
+        conn = self.db.connection()
+        with conn:
+            conn.execute('DELETE FROM pickle_meta WHERE key = ?', (encode_key(new),))
+            conn.execute('UPDATE pickle_meta SET key = ? WHERE key = ?', (encode_key(new), encode_key(old)))
+
+    def __contains__(self, key):
+        return bool(self.db.execute('SELECT 1 FROM pickle_meta WHERE key = ?', (encode_key(key),)))
+    has_key = __contains__
+
+    def keys(self):
+        return [decode_key(row[0]) for row in self.db.execute('SELECT key FROM pickle_meta')]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM pickle_meta')[0][0]
+
+    def iteritems(self):
+        rows = self.db.execute('SELECT key, meta FROM pickle_meta')
+        return iter([(decode_key(key), pickle.loads(str(meta))) for key, meta in rows])
+
+    def items(self):
+        return list(self.iteritems())
+
+
+class SqlitePickleDict(PickleDict):
+    '''
+    A PickleDict whose values are rows in a SQLite database,
+    `_sqlite.db` in its directory, rather than files. Metadata, `_meta`,
+    `get_lazy`, `lazy` and the rest work as usual; subdirectories are
+    still directories, and each is a SqlitePickleDict of its own.
+
+    Values are always pickled, and compressed as a whole if they're to
+    be compressed.
+
+    >>> import tempfile
+    >>> pd = PickleDict(tempfile.mkdtemp(), log=False, backend='sqlite')
+    >>> type(pd).__name__
+    'SqlitePickleDict'
+    >>> pd.set_many(dict((('result', i), i * i) for i in range(100)))
+    >>> pd.get_lazy('answer', lambda: 42)
+    42
+    >>> pd = PickleDict(pd.dir)
+    >>> pd['result', 9], pd['answer'], pd.get_meta('answer', 'type') == str(int)
+    (81, 42, True)
+    >>> len(pd)
+    101
+    >>> sorted(name for name in os.listdir(pd.dir) if not name.startswith('_sqlite.db-'))
+    ['_backend', '_locks', '_sqlite.db']
+    '''
+    __slots__ = ['_db', 'timeout']
+    backend_name = 'sqlite'
+    filename = '_sqlite.db'
+    internal_names = PickleDict.internal_names | frozenset([filename, filename + '-wal', filename + '-shm',
+                                                            filename + '-journal'])
+
+    def __init__(self, dir, timeout=60, **kwargs):
+        super(SqlitePickleDict, self).__init__(dir, **kwargs)
+        self.timeout = timeout
+        # In WAL mode, NORMAL only risks the last transactions if the
+        # machine crashes; FULL syncs every one.
+        synchronous = 'NORMAL' if self.durability == 'none' else 'FULL'
+        self._db = SqliteDatabase(os.path.join(self.dir, self.filename), timeout=timeout,
+                                  synchronous=synchronous)
+        if self.store_metadata:
+            self._metadata = SqliteMeta(self._db)
+
+    def __repr__(self):
+        return 'SqlitePickleDict(%r)' % self.dir
+
+    def _options(self):
+        options = super(SqlitePickleDict, self)._options()
+        options['timeout'] = self.timeout
+        return options
+
+    def _select(self, key, columns='value'):
+        if not os.path.exists(self._db.path): return None
+        rows = self._db.execute('SELECT %s FROM pickle_values WHERE key = ?' % columns, (encode_key(key),))
+        return rows[0] if rows else None
+
+    def _read(self, key):
+        row = None
+        start = time.time()
+        if not (self.store_metadata and key == '_meta'):
+            row = self._select(key)
+        if row is None:
+            # A subdirectory, perhaps.
+            return super(SqlitePickleDict, self)._read(key)
+        data = str(row[0])
+        read = time.time()
+        if self.log: self.logger.info('Loading %r...', key)
+        if self.store_metadata:
+            compression = self.get_meta(key, 'compression')
+        else:
+            compression = sniff_compression_of(data)
+        size = len(data)
+        if compression:
+            data = decompressor(compression).decompress(data)
+        value = pickle.loads(data)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, reads=1, bytes_read=size,
+                           fs_time=read - start, deserialize_time=time.time() - read)
+        if self.log: self.logger.info('Loaded %r (%s).', key, type(value))
+        return value, size
+
+    def _encode(self, key, val, compression):
+        '''
+        Returns the row for a value, and its metadata.
+        '''
+        data = pickle.dumps(val, -1)
+        if compression:
+            c = compressor(compression)
+            data = c.compress(data) + c.flush()
+        row = (encode_key(key), sqlite3.Binary(data), zlib.crc32(data) & 0xffffffff)
+        return row, dict(type=str(type(val)), codec='pickle', compression=compression)
+
+    def _write_data(self, key, val, compression, durability=None):
+        if self.log: self.logger.info('Saving %r... (%s)', key, type(val))
+        start = time.time()
+        row, meta = self._encode(key, val, compression)
+        pickled = time.time()
+        self._db.execute('INSERT OR REPLACE INTO pickle_values VALUES (?, ?, ?)', row)
+        if self.stats is not None:
+            self.stats.add(self.dir, key, writes=1, bytes_written=len(row[1]),
+                           serialize_time=pickled - start, fs_time=time.time() - pickled)
+        return len(row[1]), meta
+
+    def set_many(self, mapping, compression=None, workers=None):
+        '''
+        Stores all the items of `mapping`, and their metadata, in one
+        transaction: other processes see all of them or none of them.
+        (`workers` is ignored; SQLite writes one thing at a time.)
+        '''
+        if self.writer is not None:
+            return super(SqlitePickleDict, self).set_many(mapping, compression)
+        items = mapping.items() if hasattr(mapping, 'items') else list(mapping)
+        for key, val in items:
+            self._check_key(key)
+        if compression is None: compression = self.compression
+        if compression == 'none': compression = None
+        encoded = [self._encode(key, val, compression) for key, val in items]
+        conn = self._db.connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO pickle_values VALUES (?, ?, ?)',
+                             [row for row, meta in encoded])
+            if self.store_metadata:
+                metas = dict((key, meta) for (key, val), (row, meta) in zip(items, encoded))
+                self._metadata.update(self._mark_used(metas), conn)
+        for (key, val), (row, meta) in zip(items, encoded):
+            self._cache_written(key, val, len(row[1]))
+        if self.quota is not None:
+            self.quota.note_write(sum(len(row[1]) for row, meta in encoded))
+
+    def _stage_data(self, txn, key, val, compression):
+        row, meta = self._encode(key, val, compression)
+        return len(row[1]), meta, row
+
+    def _drop_staged(self, txn, staged):
+        pass
+
+    def _publish(self, txn):
+        # One SQLite transaction does it.
+        subdirs = [key for key in txn.deletes
+                   if self._select(key, '1') is None and os.path.isdir(self.path_for_key(key))]
+        deleted = [(encode_key(key),) for key in txn.deletes]
+        conn = self._db.connection()
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO pickle_values VALUES (?, ?, ?)',
+                             [write[3] for write in txn.writes.itervalues()])
+            conn.executemany('DELETE FROM pickle_values WHERE key = ?', deleted)
+            if self.store_metadata:
+                metas = dict((key, write[2]) for key, write in txn.writes.iteritems())
+                self._metadata.update(self._mark_used(metas), conn)
+                conn.executemany('DELETE FROM pickle_meta WHERE key = ?', deleted)
+        for key in subdirs:
+            PickleDict._remove_stored(self, key)
+
+    def _stamp(self, key):
+        row = self._select(key, 'length(value), crc')
+        if row is None:
+            return super(SqlitePickleDict, self)._stamp(key)
+        return tuple(row)
+
+    def _stored_stat(self, key):
+        row = self._select(key, 'length(value)')
+        if row is None:
+            return super(SqlitePickleDict, self)._stored_stat(key)
+        return row[0], 0
+
+    def _journal(self, key):
+        # Values are small here; update_dict just rewrites them.
+        return None
+
+    def _remove_stored(self, key):
+        if self._select(key, '1') is not None:
+            self._db.execute('DELETE FROM pickle_values WHERE key = ?', (encode_key(key),))
+        else:
+            super(SqlitePickleDict, self)._remove_stored(key)
+
+    def _rename_stored(self, old, new):
+        if self._select(old, '1') is not None:
+            conn = self._db.connection()
+            with conn:
+                conn.execute('DELETE FROM pickle_values WHERE key = ?', (encode_key(new),))
+                conn.execute('UPDATE pickle_values SET key = ? WHERE key = ?', (encode_key(new), encode_key(old)))
+        else:
+            super(SqlitePickleDict, self)._rename_stored(old, new)
+
+    def _iter_stored(self):
+        # The directory only holds subdirectories, so listing it is cheap.
+        for key in super(SqlitePickleDict, self)._iter_stored():
+            yield key
+        if os.path.exists(self._db.path):
+            for row in self._db.execute('SELECT key FROM pickle_values'):
+                yield decode_key(row[0])
+
+    def _on_disk(self, key):
+        return self._select(key, '1') is not None or super(SqlitePickleDict, self)._on_disk(key)
+
+    def _clear(self):
+        super(SqlitePickleDict, self)._clear()
+        self._db.destroy()